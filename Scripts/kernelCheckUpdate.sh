@@ -3,11 +3,12 @@
 #
 # See LICENSE file for copyright and license details
 #
-# Automatic SD card files updater. Checks if version.txt file matches the version.txt file in /bootfiles/ inside Raspbian chroot
-# If they don't match, then it copies in new files from the /bootfiles folder of the Raspbian chroot.
-# Note - The entire boot folder is deleted (bar any smaller files under 100kb that aren't already overwritten). This means any custom configuration is lost each update.
+# Automatic SD card files updater. Compares the SD card boot partition against the manifest.sha256 hash list the server publishes in /bootfiles/ inside the Raspbian chroot.
+# Only files which differ are rewritten (each one via a temporary file and rename), the server IP address in cmdline.txt is kept and the Pi only reboots if something used to boot changed.
+# A copy of the manifest is kept on the card once it is up to date, so a card with nothing to update is never read through.
+# If the server has no manifest (older PiNet), it falls back to checking version.txt and copying everything in, deleting files over 100kb first.
 
-version=002
+version=003
 
 ### BEGIN INIT INFO
 # Provides:             None
@@ -47,10 +48,67 @@ runUpdate(){
 }
 
 timerCountDown(){
-for i in {5..1};do echo "$i seconds $1" && sleep 1; done #Simple 5 second countdown
+for i in 5 4 3 2 1;do echo "$i seconds $1" && sleep 1; done #Simple 5 second countdown
 echo " "
 }
 
+replaceFile(){
+#Replaces $2 on the card with $1, writing to a temporary file first so a power cut never leaves half a file
+mkdir -p "$(dirname "$2")"
+cp "$1" "$2.pinet-new" && sync && mv -f "$2.pinet-new" "$2"
+}
+
+needsReboot(){
+#Checks if a changed boot partition file is used while booting (rather than being informational, like version.txt)
+case "$1" in
+    *.img|*.elf|*.dat|*.bin|*.dtb|overlays/*|config.txt|cmdline.txt) return 0 ;;
+    *) return 1 ;;
+esac
+}
+
+runManifestUpdate(){
+        reboot="false"
+        updated=0
+        while read -r hash name; do
+            name="${name#./}"
+            if [ -f "$fpath/$name" ] && [ "$(sha256sum < "$fpath/$name" | cut -d ' ' -f1)" = "$hash" ]; then
+                continue
+            fi
+            if [ $updated -eq 0 ]; then
+                echo "-------------------------------------------------------"
+                echo "Updating SD card kernel files, do not disconnect the"
+                echo "power or SD card till complete!"
+                echo "-------------------------------------------------------"
+            fi
+            echo "Updating $name"
+            replaceFile "/bootfiles/$name" "$fpath/$name"
+            updated=$((updated + 1))
+            if needsReboot "$name"; then
+                reboot="true"
+            fi
+        done < "/bootfiles/manifest.sha256"
+        ip=$(grep -E -o "(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)" "$fpath/cmdline.txt" | head -n 1) #Get the IP address of the PiNet server from the current cmdline.txt file
+        if [ -f "/bootfiles/cmdlineNBD.txt" ] && [ ! "$ip" = "" ]; then
+            sed "s/1.1.1.1/$ip/g" "/bootfiles/cmdlineNBD.txt" > /tmp/cmdline.txt #Replace the 1.1.1.1 dummy address with the PiNet server address
+            if ! cmp -s /tmp/cmdline.txt "$fpath/cmdline.txt"; then
+                echo "Updating cmdline.txt"
+                replaceFile /tmp/cmdline.txt "$fpath/cmdline.txt"
+                reboot="true"
+            fi
+            rm -f /tmp/cmdline.txt
+        fi
+        replaceFile "/bootfiles/manifest.sha256" "$fpath/manifest.sha256" #Marks the card as up to date, only once everything else is written
+        if [ "$reboot" = "true" ]; then
+            echo "-------------------------------------------------------"
+            echo "Update complete, will now reboot to apply it"
+            echo "-------------------------------------------------------"
+            timerCountDown "till reboot."
+            reboot #Reboot Raspberry Pi
+        else
+            echo "SD card files updated, no reboot needed"
+        fi
+}
+
 checkUpdate(){
 
 echo "Checking for SD card kernel updates"
@@ -70,14 +128,23 @@ if [ -e "/dev/mmcblk0p1" ] || [ -e "/dev/mmcblk0" ]; then #Verify a card is in t
     fi
     if [ ! "$fpath" = "" ]; then
         	if [ "$fpath" = "/dev" ]; then #If the SD card boot partition isn't mounted currently
-        		mkdir /media/sdcard
+        		mkdir -p /media/sdcard
         		mount /dev/$partition /media/sdcard
         		fpath="/media/sdcard"
         	fi
     fi
 
     if [ -f "$fpath/bootcode.bin" ]; then #Check that it is an actual Raspberry Pi boot partition by verifying if bootcode.bin exists
-        if [ -f "/bootfiles/bootcode.bin" ]; then #Check the update from boot partition by verifying if bootcode.bin exists
+        if [ -f "/bootfiles/manifest.sha256" ]; then #Server publishes a hash list of its boot files, so only what differs needs updated
+            if cmp -s "/bootfiles/manifest.sha256" "$fpath/manifest.sha256"; then
+                echo "No new updates found"
+            else
+                runManifestUpdate
+            fi
+            if [ "$fpath" = "/media/sdcard" ]; then
+                umount "/media/sdcard" #Unmount the card to clean up after ourselves
+            fi
+        elif [ -f "/bootfiles/bootcode.bin" ]; then #Check the update from boot partition by verifying if bootcode.bin exists
             if [ -f "$fpath/version.txt" ]; then #Check if a version.txt file exists. If not just flash the card anyway
                 current=$(head -n 1 "$fpath/version.txt") #Current version number
                 new=$(head -n 1 "/bootfiles/version.txt") #Possible new version number
@@ -85,7 +152,7 @@ if [ -e "/dev/mmcblk0p1" ] || [ -e "/dev/mmcblk0" ]; then #Verify a card is in t
                     runUpdate #Reflash card
                 else
                     echo "No new updates found"
-                    if [ "$fpath$" = "/media/sdcard" ]; then
+                    if [ "$fpath" = "/media/sdcard" ]; then
                         umount "/media/sdcard" #Unmount the card to clean up after ourselves
                     fi
                 fi
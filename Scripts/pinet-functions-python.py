@@ -40,6 +40,54 @@ RawRepository=RawRepositoryBase + RepositoryName
 RawBootRepository=RawRepositoryBase + BootRepository
 ReleaseBranch = "master"
 configFileData = {}
+InternetCacheFile = "/tmp/pinetInternet.cache"
+InternetCacheTime = 300 #Seconds a reachability result is trusted for within a pinet session
+ReturnFile = os.environ.get("PINET_RETURN_FILE", "/tmp/ltsptmp")
+serverMode = False #True while answering requests in serveRequests()
+serverResult = None
+usersCache = {}
+PupilGroups = ["adm", "dialout", "cdrom", "audio", "users", "video", "games", "plugdev", "input", "pupil"]
+SystemGroups = ["adm", "dialout", "cdrom", "audio", "users", "sudo", "video", "games", "plugdev", "input"]
+FixedGroups = [("pupil", 2122), ("teacher", 2123)] #Group names and the gid they must have, shared with the Raspberry Pi image
+ImportJournal = "/var/lib/pinet/csvImport.journal"
+SoftwareManifest = "/usr/local/share/pinet/software.manifest"
+ImageManifest = "/var/lib/pinet/imageManifest.json"
+ImageBuildStatus = "/var/lib/pinet/imageBuild.json"
+ImageBuildQueued = "/var/lib/pinet/imageBuild.queued"
+CompressionBenchmark = "/var/lib/pinet/compressionBenchmark.txt"
+DownloadCache = "/var/cache/pinet/downloads"
+DownloadCacheDays = 30 #Cached downloads not used for this long are removed
+DownloadCacheSize = 1073741824 #Oldest used downloads are removed once the cache is bigger than this
+ReleaseCache = "/var/cache/pinet/releases.json"
+ReleaseCacheTime = 3600 #Seconds before the release feed is fetched again
+BackupRepositoryName = "PiNet-Backups" #Folder inside backupLoc holding the packs and snapshots
+BackupMinChunk = 262144
+BackupMaxChunk = 4194304
+BackupAnchorBytes = 4 #Bytes hashed to find candidate chunk ends, 1 in 256 of which are candidates
+BackupChunkWindow = 32 #Bytes checked at a candidate to decide if it is a chunk end
+BackupChunkMask = 0x7FF #11 more bits, so chunk ends come every 512KB on average after BackupMinChunk and chunks average about 768KB
+BackupScanSize = 262144 #Bytes searched for a chunk end at a time
+BackupPackSize = 67108864
+BackupIndexName = "index.sqlite"
+MigrationBundleMagic = b"PINETMOVE 1\n"
+MigrationBlockSize = 1048576 #Uncompressed size of each block, compressed separately so they can be done in parallel
+SharedFolderBase = "/home/shared"
+SharedFolderRegistry = "/var/lib/pinet/sharedFolders.json"
+SharedFolderScript = "/usr/local/bin/bindfs-mount"
+SharedFolderMountState = "/run/pinet/sharedFolderMounts.json"
+StatusInterval = 2 #Seconds between System-Status refreshes
+StatusHistorySize = 1800 #Samples kept, an hour at StatusInterval
+StatusHistoryFile = "/run/pinet/statusHistory.json"
+SSHProcessNames = ("sshd", "sshd-session") #Newer OpenSSH runs each login in an sshd-session process
+ClientInventory = "/var/lib/pinet/clients.sqlite"
+ClientLeaseFiles = ["/var/lib/misc/dnsmasq.leases", "/var/lib/dhcp/dhcpd.leases"]
+ClientSwapFolder = "/tmp/nbd-swap" #Where the swap export from EnableNBDswap keeps each Raspberry Pi's swap file, named by IP address
+ClientDetailDays = 7 #Days of per minute client samples kept, older ones are folded into hourly totals
+ClientKeepDays = 365
+ClientReportRows = 10
+MigrationFiles = [SharedFolderScript, SharedFolderRegistry] #Files outside /home which go in a migration bundle
+BackupAnchorTables = []
+BackupWorker = {}
 
 
 class softwarePackage():
@@ -125,6 +173,107 @@ class softwarePackage():
                 done = True
         debug(self.marked, self.installType, self.installCommands, self.name)
 
+class installPlan():
+    """
+    Plans the install of a batch of marked softwarePackage objects using as few package manager runs as possible.
+    apt-get purge/remove commands from scripts run first, then every apt package (including apt-get install commands from scripts) in one transaction,
+    then all pip packages with one pip and one pip3 call running in parallel, then what is left of each script and finally the server side installers.
+    """
+
+    def __init__(self, packages):
+        super(installPlan, self).__init__()
+        self.remove = []
+        self.apt = []
+        self.pip = []
+        self.scripts = []
+        self.serverSide = []
+        for package in packages:
+            if package.marked == True:
+                self.add(package)
+
+    def addNames(self, names, toAdd):
+        for name in toAdd:
+            if name != "" and not name in names:
+                names.append(name)
+
+    def add(self, package):
+        if package.installType == "apt":
+            self.addNames(self.apt, " ".join(package.installCommands).split())
+        elif package.installType == "pip":
+            self.addNames(self.pip, " ".join(package.installCommands).split())
+        elif package.installType == "script":
+            commands = []
+            for command in package.installCommands:
+                words = command.split()
+                names = [word for word in words[2:] if not word.startswith("-")]
+                options = [word for word in words[2:] if word.startswith("-")]
+                if words[0:1] == ["apt-get"] and len(words) > 2 and set(options) <= {"-y", "--yes"}:
+                    if words[1] in ("purge", "remove"):
+                        self.addNames(self.remove, names)
+                        continue
+                    elif words[1] == "install":
+                        self.addNames(self.apt, names)
+                        continue
+                commands.append(command)
+            if commands:
+                self.scripts.append((package.name, commands))
+        elif package.installType in ("epoptes", "scratchGPIO"):
+            self.serverSide.append(package)
+        else:
+            print(_("Error in installing") + " " + package.name + " " + _("due to invalid install type."))
+
+    def empty(self):
+        return not (self.remove or self.apt or self.pip or self.scripts or self.serverSide)
+
+    def describe(self):
+        """
+        Returns the plan as a list of numbered steps.
+        """
+        steps = []
+        if self.remove or self.apt or self.pip or self.scripts:
+            steps.append(_("Update package lists"))
+        if self.remove:
+            steps.append(_("Remove with apt") + " - " + " ".join(self.remove))
+        if self.apt:
+            steps.append(_("Install with apt, in one transaction") + " - " + " ".join(self.apt))
+        if self.pip:
+            steps.append(_("Install with pip and pip3, in parallel") + " - " + " ".join(self.pip))
+        for name, commands in self.scripts:
+            steps.append(_("Run install script for") + " " + name + " (" + str(len(commands)) + " " + _("commands") + ")")
+        for package in self.serverSide:
+            steps.append(_("Install") + " " + package.name)
+        return [str(number + 1) + ". " + step for number, step in enumerate(steps)]
+
+    def run(self):
+        """
+        Runs the plan. Returns the names of any apt packages which couldn't be installed.
+        """
+        import shlex
+        failed = []
+        if self.remove or self.apt or self.pip or self.scripts:
+            ltspChroot("apt-get update")
+        if self.remove:
+            ltspChroot("apt-get purge -y " + " ".join(self.remove))
+        if self.apt and ltspChroot("apt-get install -y " + " ".join(self.apt)) != 0:
+            if len(self.apt) == 1:
+                failed = list(self.apt)
+            else:
+                #apt gives up on the whole transaction if one package can't be installed, so find which one it was and install the rest
+                print(_("Installing the packages together failed, installing them one at a time"))
+                for name in self.apt:
+                    if ltspChroot("apt-get install -y " + name) != 0:
+                        failed.append(name)
+        if failed:
+            print(_("Unable to install") + " - " + " ".join(failed))
+        if self.pip:
+            programs = " ".join(self.pip)
+            ltspChroot("sh -c " + shlex.quote("pip install -U " + programs + " & pip3 install -U " + programs + " & wait")) #One chroot for both, so they don't fight over its mounts
+        for name, commands in self.scripts:
+            ltspChroot("sh -c " + shlex.quote("; ".join(commands)))
+        for package in self.serverSide:
+            package.installPackage()
+        return failed
+
 def runBash(command):
     if type(command) == str:
         p = Popen("sudo " + command, shell=True)
@@ -140,14 +289,27 @@ def runBashOutput(command):
     return output
 
 def getUsers(includeRoot=False):
+    """
+    Returns the usernames of all normal users with a home folder in /home.
+    The list is kept between calls (so stays warm in server mode) until /etc/passwd changes.
+    """
+    try:
+        info = os.stat("/etc/passwd")
+        stamp = (info.st_mtime_ns, info.st_size, info.st_ino)
+    except OSError:
+        stamp = None
+    if stamp is not None and usersCache.get("stamp") == stamp:
+        return list(usersCache["users"])
     users = []
     for p in pwd.getpwall():
         if (len(str(p[2])) > 3) and (str(p[5])[0:5] == "/home"): #or (str(p[5])[0:5] == "/root"):
             users.append(p[0].lower())
-    return users
+    usersCache["stamp"] = stamp
+    usersCache["users"] = users
+    return list(users)
 
 def ltspChroot(command):
-    runBash("ltsp-chroot --arch armhf " + command)
+    return runBash("ltsp-chroot --arch armhf " + command)
 
 def installPackage(toInstall, update=False, upgrade=False, InstallOnServer=False):
     toInstall = toInstall.split(" ")
@@ -179,12 +341,8 @@ def getReleaseChannel():
     """
     Gets the PiNet release chanel (branch) from /etc/pinet and also allows overwriting RepositoryBase and RawRepositoryBase.
     """
-    Channel = "Stable"
-    configFile = getList("/etc/pinet")
-    for i in range(0, len(configFile)):
-        if configFile[i][0:14] == "ReleaseChannel":
-            Channel = configFile[i][15:len(configFile[i])]
-            break
+    config = getConfig("/etc/pinet")
+    Channel = config.get("ReleaseChannel", "Stable")
 
     global ReleaseBranch, RepositoryBase, Repository, RawRepository, RawBootRepository, RawRepositoryBase
     Channel = Channel.lower()
@@ -202,21 +360,15 @@ def getReleaseChannel():
 
     needUpdateRepoVariables = False
 
-    for i in range(0, len(configFile)):  # Check if overwriting RepositoryBase
-        if configFile[i][0:14] == "RepositoryBase":
-            RepositoryBaseCustom = configFile[i][15:len(configFile[i])]
-            if RepositoryBaseCustom != "":
-                RepositoryBase = RepositoryBaseCustom
-                needUpdateRepoVariables = True
-            break
+    RepositoryBaseCustom = config.get("RepositoryBase", "")  # Check if overwriting RepositoryBase
+    if RepositoryBaseCustom != "":
+        RepositoryBase = RepositoryBaseCustom
+        needUpdateRepoVariables = True
 
-    for i in range(0, len(configFile)):  # Check if overwriting RawRepositoryBase
-        if configFile[i][0:17] == "RawRepositoryBase":
-            RawRepositoryBaseCustom = configFile[i][18:len(configFile[i])]
-            if RawRepositoryBaseCustom != "":
-                RawRepositoryBase = RawRepositoryBaseCustom
-                needUpdateRepoVariables = True
-            break
+    RawRepositoryBaseCustom = config.get("RawRepositoryBase", "")  # Check if overwriting RawRepositoryBase
+    if RawRepositoryBaseCustom != "":
+        RawRepositoryBase = RawRepositoryBaseCustom
+        needUpdateRepoVariables = True
 
     if needUpdateRepoVariables:
         Repository=RepositoryBase + RepositoryName
@@ -225,6 +377,19 @@ def getReleaseChannel():
 
 
 
+def iterTextFile(filep):
+    """
+    Generator going through a text file line by line, yielding each line without its newline character.
+    Only one line is held in memory at a time, so it is safe on very large files. A missing file yields nothing.
+    """
+    if not os.path.exists(filep):
+        return
+    with open(filep) as file:
+        for line in file:
+            if line.endswith("\n"):
+                line = line[0:len(line) - 1]
+            yield line
+
 def getTextFile(filep):
     """
     Opens the text file and goes through line by line, appending it to the filelist list.
@@ -241,85 +406,200 @@ def getTextFile(filep):
     """
     if not os.path.exists(filep):
         return []
-    file = open(filep)
-    filelist = []
-    while 1:
-        line = file.readline()
-        if not line:
-            break
-        filelist.append(line) #Go through entire SVG file and import it into a list
-    return filelist
+    with open(filep) as file:
+        return file.readlines()
 
 def removeN(filelist):
     """
-    Removes the final character from every line, this is always /n, aka newline character.
+    Removes the newline character (\n) from the end of every line.
     """
-    for count in range(0, len(filelist)):
-        filelist[count] = filelist[count][0: (len(filelist[count]))-1]
+    filelist[:] = [line[0:len(line) - 1] if line.endswith("\n") else line for line in filelist]
     return filelist
 
 def blankLineRemover(filelist):
     """
     Removes blank lines in the file.
     """
-    toremove = [ ]
-    #toremove.append(len(filelist))
-    for count in range(0, len(filelist)): #Go through each line in the text file
-        found = False
-        for i in range(0, len(filelist[count])): #Go through each char in the line
-            if not (filelist[count][i] == " "):
-                found = True
-        if found == False:
-            toremove.append(count)
-
-    #toremove.append(len(filelist))
-    toremove1 = []
-    for i in reversed(toremove):
-        toremove1.append(i)
-
-
-    for r in range(0, len(toremove)):
-        filelist.pop(toremove1[r])
-        debug("just removed " + str(toremove1[r]))
+    filelist[:] = [line for line in filelist if line.strip(" ") != ""]
     return filelist
 
 def writeTextFile(filelist, name):
     """
     Writes the final list to a text file.
     Adds a newline character (\n) to the end of every sublist in the file.
-    Then writes the string to the text file.
+    The file is replaced atomically, see atomicFile.
     """
-    file = open(name, 'w')
-    mainstr = ""
-    for i in range(0, len(filelist)):
-        mainstr = mainstr + filelist[i] + "\n"
-    file.write(mainstr)
-    file.close()
-    info("")
-    info("------------------------")
-    info("File generated")
-    info("The file can be found at " + name)
-    info("------------------------")
-    info("")
+    with atomicFile(name) as file:
+        for line in filelist:
+            file.write(line + "\n")
+    debug("File generated at " + name)
+
+class atomicFile():
+    """
+    File like object used to replace a file atomically.
+    Data is written to a temporary file in the same folder, which is renamed over the original when the with block ends without an error.
+    Call discard() to throw the new version away instead. The permissions and owner of an existing file are kept.
+    """
+
+    def __init__(self, filep, mode = "w"):
+        super(atomicFile, self).__init__()
+        import tempfile
+        self.filep = os.path.realpath(filep)
+        fd, self.tempLoc = tempfile.mkstemp(prefix="." + os.path.basename(self.filep) + ".", dir=os.path.dirname(self.filep))
+        self.file = os.fdopen(fd, mode)
+        self.finished = False
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        import stat
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        try:
+            current = os.stat(self.filep)
+            os.chmod(self.tempLoc, stat.S_IMODE(current.st_mode))
+            try:
+                os.chown(self.tempLoc, current.st_uid, current.st_gid)
+            except OSError:
+                pass
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.tempLoc, 0o666 & ~umask)
+        os.replace(self.tempLoc, self.filep)
+        self.finished = True
+
+    def discard(self):
+        self.file.close()
+        removeFile(self.tempLoc)
+        self.finished = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.finished:
+            return
+        if excType is None:
+            self.commit()
+        else:
+            self.discard()
+
+def writeFileAtomic(filep, data):
+    """
+    Writes the string data to filep atomically, anything reading the file sees either the old or the new version.
+    """
+    with atomicFile(filep) as file:
+        file.write(data)
+
+class replaceLineRule():
+    """
+    Line rule for transformTextFile(). Replaces every entire line containing string with newString.
+    If no line contains string, newString is added to the end of the file.
+    """
+
+    def __init__(self, string, newString):
+        super(replaceLineRule, self).__init__()
+        self.string = string
+        self.newString = newString
+        self.found = False
+
+    def apply(self, line):
+        if line.find(self.string) != -1:
+            self.found = True
+            return self.newString
+        return line
+
+    def finish(self):
+        if self.found:
+            return []
+        return [self.newString]
+
+class replaceSectionRule():
+    """
+    Line rule for transformTextFile(). Replaces the first occurrence of string on each line with newString.
+    """
+
+    def __init__(self, string, newString):
+        super(replaceSectionRule, self).__init__()
+        self.string = string
+        self.newString = newString
+
+    def apply(self, line):
+        found = line.find(self.string)
+        if found != -1:
+            return line[0:found] + self.newString + line[found + len(self.string):len(line)]
+        return line
+
+    def finish(self):
+        return []
+
+class removeBlankLinesRule():
+    """
+    Line rule for transformTextFile(). Drops lines that are empty or only contain spaces.
+    """
+
+    def apply(self, line):
+        if line.strip(" ") == "":
+            return None
+        return line
+
+    def finish(self):
+        return []
+
+def applyLineRules(lines, rules):
+    """
+    Generator passing each line through every rule in order. A rule returning None drops the line.
+    Once the input runs out, any lines the rules want added to the end are run through the later rules too.
+    """
+    for line in lines:
+        for rule in rules:
+            line = rule.apply(line)
+            if line is None:
+                break
+        if line is not None:
+            yield line
+    for i in range(0, len(rules)):
+        for line in rules[i].finish():
+            for rule in rules[i + 1:len(rules)]:
+                line = rule.apply(line)
+                if line is None:
+                    break
+            if line is not None:
+                yield line
+
+def transformTextFile(filep, rules):
+    """
+    Streams a text file through a list of line rules (replaceLineRule, replaceSectionRule, removeBlankLinesRule...) in a single pass.
+    The result is written to a temporary file and renamed over the original. If nothing changed, the file is left untouched.
+    Returns True if the file was changed.
+    """
+    changed = not os.path.exists(filep)
+    with atomicFile(filep) as file:
+        original = iterTextFile(filep) #Second reader, only used to spot if anything changed
+        for line in applyLineRules(iterTextFile(filep), rules):
+            if not changed and next(original, None) != line:
+                changed = True
+            file.write(line + "\n")
+        if not changed and next(original, None) is not None:
+            changed = True
+        if not changed:
+            file.discard()
+    return changed
 
 def getList(file):
     """
     Creates list from the passed text file with each line a new object in the list
     """
-    return removeN(getTextFile(file))
+    return list(iterTextFile(file))
 
 def checkStringExists(filename, toSearchFor):
-    textFile = getList(filename)
-    unfound = True
-    for i in range(0,len(textFile)):
-        found = textFile[i].find(toSearchFor)
-        if (found != -1):
-            unfound = False
-            break
-    if unfound:
-        return False
-
-    return True
+    for line in iterTextFile(filename):
+        if line.find(toSearchFor) != -1:
+            return True
+    return False
 
 def findReplaceAnyLine(textFile, string, newString):
     """
@@ -327,15 +607,7 @@ def findReplaceAnyLine(textFile, string, newString):
     Pass it a text file in list form and it will search for strings.
     If it finds a string, it will replace the entire line with newString
     """
-    unfound = True
-    for i in range(0,len(textFile)):
-        found = textFile[i].find(string)
-        if (found != -1):
-            textFile[i] = newString
-            unfound = False
-    if unfound:
-        textFile.append(newString)
-
+    textFile[:] = applyLineRules(textFile, [replaceLineRule(string, newString)])
     return textFile
 
 def findReplaceSection(textFile, string, newString):
@@ -344,33 +616,257 @@ def findReplaceSection(textFile, string, newString):
     Pass it a text file in list form and it will search for strings.
     If it finds a string, it will replace that exact string with newString
     """
-    for i in range(0, len(textFile)):
-        found = textFile[i].find(string)
-        if (found != -1):
-            before = textFile[i][0:found]
-            after = textFile[i][found+len(string):len(textFile[i])]
-            textFile[i] = before+newString+after
+    textFile[:] = applyLineRules(textFile, [replaceSectionRule(string, newString)])
     return textFile
 
 
-def downloadFile(url, saveloc):
+class downloadSession():
+    """
+    Keeps HTTP connections open between downloads, so fetching several files from one host (as updatePiNet does) only connects once.
+    Use in a with block, or call close() when finished.
+    """
+
+    def __init__(self, timeoutLimit = 30):
+        super(downloadSession, self).__init__()
+        self.timeoutLimit = timeoutLimit
+        self.connections = {}
+
+    def proxy(self, scheme, host):
+        """
+        Returns the proxy address and headers to use for host, from http_proxy/https_proxy (and no_proxy), or None to connect directly.
+        """
+        import urllib.request, base64
+        from urllib.parse import urlsplit, unquote
+        proxy = urllib.request.getproxies().get(scheme)
+        if not proxy or urllib.request.proxy_bypass(urlsplit("//" + host).hostname or host):
+            return None
+        if not "://" in proxy:
+            proxy = "http://" + proxy
+        parts = urlsplit(proxy)
+        headers = {}
+        if parts.username:
+            credentials = unquote(parts.username) + ":" + unquote(parts.password or "")
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+        return parts.hostname + (":" + str(parts.port) if parts.port else ""), headers
+
+    def connection(self, scheme, host):
+        """
+        Returns the connection for host and the headers to send through a proxy, or None when requests go straight to host.
+        """
+        import http.client
+        if not (scheme, host) in self.connections:
+            proxy = self.proxy(scheme, host)
+            if proxy is None:
+                if scheme == "https":
+                    connection = http.client.HTTPSConnection(host, timeout=self.timeoutLimit)
+                else:
+                    connection = http.client.HTTPConnection(host, timeout=self.timeoutLimit)
+                proxyHeaders = None
+            elif scheme == "https": #Tunnelled with CONNECT, so the proxy can't see inside
+                connection = http.client.HTTPSConnection(proxy[0], timeout=self.timeoutLimit)
+                connection.set_tunnel(host, headers=proxy[1])
+                proxyHeaders = None
+            else: #Plain http proxies are sent the whole URL
+                connection = http.client.HTTPConnection(proxy[0], timeout=self.timeoutLimit)
+                proxyHeaders = proxy[1]
+            self.connections[(scheme, host)] = (connection, proxyHeaders)
+        return self.connections[(scheme, host)]
+
+    def open(self, url, headers = None, redirects = 5):
+        """
+        Sends a GET request for url, following redirects. Returns the response, which must be read to the end before the session is used again.
+        """
+        import http.client
+        from urllib.parse import urlsplit, urljoin
+        headers = dict(headers or {})
+        headers["User-agent"] = "Mozilla 5.10"
+        for redirect in range(redirects + 1):
+            parts = urlsplit(url)
+            path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+            for attempt in range(2):
+                connection, proxyHeaders = self.connection(parts.scheme, parts.netloc)
+                try:
+                    if proxyHeaders is None:
+                        connection.request("GET", path, headers=headers)
+                    else:
+                        requestHeaders = dict(proxyHeaders)
+                        requestHeaders.update(headers)
+                        connection.request("GET", parts.scheme + "://" + parts.netloc + path, headers=requestHeaders)
+                    response = connection.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    del self.connections[(parts.scheme, parts.netloc)]
+                    if attempt == 1: #Only retry once, in case the server had closed a kept alive connection
+                        raise
+            location = response.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urljoin(url, location)
+                continue
+            return response
+        raise IOError(_("Too many redirects for") + " " + url)
+
+    def close(self):
+        for connection, proxyHeaders in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+def loadDownloadInfo(path):
+    import json
+    try:
+        with open(path) as infoFile:
+            return json.load(infoFile)
+    except (OSError, IOError, ValueError):
+        return {}
+
+def saveDownloadInfo(path, info):
+    import json
+    writeFileAtomic(path, json.dumps(info))
+
+def pruneDownloadCache(keep = None):
+    """
+    Removes downloads which haven't been used for DownloadCacheDays, then the least recently used ones until DownloadCache is no bigger than DownloadCacheSize.
+    Entries another process is fetching are left alone, as is keep (the entry just downloaded).
+    """
+    import fcntl, time
+    entries = {}
+    try:
+        names = os.listdir(DownloadCache)
+    except OSError:
+        return
+    for name in names:
+        if len(name.split(".")[0]) != 64: #Not a cache entry, like a temporary file being written
+            continue
+        path = os.path.join(DownloadCache, name.split(".")[0])
+        try:
+            info = os.stat(os.path.join(DownloadCache, name))
+        except OSError:
+            continue
+        used, size = entries.get(path, (0, 0))
+        entries[path] = (max(used, info.st_mtime), size + info.st_size)
+    total = sum(size for used, size in entries.values())
+    oldest = time.time() - DownloadCacheDays * 86400
+    for used, path in sorted((used, path) for path, (used, size) in entries.items()):
+        if path == keep or (used >= oldest and total <= DownloadCacheSize):
+            continue
+        with open(path + ".lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            for suffix in ("", ".json", ".part", ".part.json", ".lock"):
+                removeFile(path + suffix)
+        total = total - entries[path][1]
+
+def downloadFile(url, saveloc, sha256 = None, session = None):
     """
     Downloads a file from the internet using a standard browser header.
     Custom header is required to allow access to all pages.
+    Files are streamed into DownloadCache and then copied into place atomically. A cached copy is checked with If-None-Match/If-Modified-Since rather than downloaded again,
+    and a download which was cut off is resumed with a Range request next time.
+    If sha256 is given the file is only used if it matches. Pass a downloadSession to reuse its connections. Returns True on success.
     """
-    import traceback
+    import traceback, hashlib, fcntl
+    ownSession = session is None
+    if ownSession:
+        session = downloadSession()
+    lock = None
     try:
-        import urllib.request
-        req = urllib.request.Request(url)
-        req.add_header('User-agent', 'Mozilla 5.10')
-        f = urllib.request.urlopen(req)
-        text_file = open(saveloc, "wb")
-        text_file.write(f.read())
-        text_file.close()
+        if os.path.realpath(saveloc) == os.devnull: #Only fetched to be counted (see triggerInstall), nothing to keep
+            response = session.open(url)
+            while response.read(65536):
+                pass
+            return response.status < 400
+        makeFolder(DownloadCache)
+        entry = os.path.join(DownloadCache, hashlib.sha256(url.encode("utf-8")).hexdigest())
+        while True:
+            lock = open(entry + ".lock", "a")
+            fcntl.flock(lock, fcntl.LOCK_EX) #Another pinet process (like the background refreshReleaseInfo) may be fetching the same URL, and would share the .part file
+            if os.path.exists(entry + ".lock") and os.path.samestat(os.fstat(lock.fileno()), os.stat(entry + ".lock")):
+                break
+            lock.close() #Removed by pruneDownloadCache while waiting for it
+        info = loadDownloadInfo(entry + ".json")
+        partInfo = loadDownloadInfo(entry + ".part.json")
+        headers = {}
+        if os.path.isfile(entry) and info:
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("lastModified"):
+                headers["If-Modified-Since"] = info["lastModified"]
+        partSize = os.path.getsize(entry + ".part") if os.path.isfile(entry + ".part") else 0
+        etag = partInfo.get("etag") or ""
+        validator = etag if etag and not etag.startswith("W/") else partInfo.get("lastModified") #If-Range needs a strong validator
+        if partSize > 0 and validator:
+            headers["Range"] = "bytes=" + str(partSize) + "-"
+            headers["If-Range"] = validator
+        response = session.open(url, headers)
+        if response.status == 304:
+            response.read()
+            os.utime(entry) #Marks it as used for pruneDownloadCache
+        elif response.status in (200, 206):
+            digest = hashlib.sha256()
+            mode = "wb"
+            if response.status == 206:
+                contentRange = response.getheader("Content-Range", "")
+                if contentRange.startswith("bytes " + str(partSize) + "-"):
+                    mode = "ab"
+                    with open(entry + ".part", "rb") as part:
+                        for chunk in iter(lambda: part.read(1048576), b""):
+                            digest.update(chunk)
+                else: #Not the range asked for, so can't be added to the partial download
+                    response.read()
+                    removeFile(entry + ".part")
+                    removeFile(entry + ".part.json")
+                    lock.close() #Taken again by the retry
+                    lock = None
+                    return downloadFile(url, saveloc, sha256, session)
+            else:
+                saveDownloadInfo(entry + ".part.json", {"etag": response.getheader("ETag"), "lastModified": response.getheader("Last-Modified")})
+            received = 0
+            with open(entry + ".part", mode) as part:
+                for chunk in iter(lambda: response.read(65536), b""):
+                    part.write(chunk)
+                    digest.update(chunk)
+                    received = received + len(chunk)
+            expected = response.getheader("Content-Length")
+            if expected is not None and received < int(expected): #Cut off, the partial download is kept to be resumed
+                print(_("Download cut off") + " - " + url)
+                return False
+            if partInfo and response.status == 206:
+                info = partInfo
+            else:
+                info = {"etag": response.getheader("ETag"), "lastModified": response.getheader("Last-Modified")}
+            info.update({"url": url, "sha256": digest.hexdigest()})
+            os.replace(entry + ".part", entry)
+            saveDownloadInfo(entry + ".json", info)
+            removeFile(entry + ".part.json")
+            pruneDownloadCache(entry)
+        else:
+            response.read()
+            print(_("Unable to download") + " " + url + " - " + str(response.status) + " " + response.reason)
+            return False
+        if sha256 is not None and info.get("sha256") != sha256.lower():
+            print(_("Checksum doesn't match for") + " " + url)
+            return False
+        with open(entry, "rb") as source:
+            with atomicFile(saveloc, "wb") as target:
+                shutil.copyfileobj(source, target, 1048576)
         return True
-    except:
+    except Exception:
         print (traceback.format_exc())
         return False
+    finally:
+        if lock is not None:
+            lock.close()
+        if ownSession:
+            session.close()
 
 def stripStartWhitespaces(filelist):
     """
@@ -420,41 +916,425 @@ def compareVersions(local, web):
                 returnData(0)
                 return False
 
-def getConfigParameter(filep, searchfor):
-    textFile = getTextFile(filep)
-    textFile = stripEndWhitespaces(textFile)
-    value = ""
-    for i in range(0,len(textFile)):
-        found = textFile[i].find(searchfor)
-        if (found != -1):
-            value = textFile[i][found+len(searchfor):len(textFile[i])]
+class pinetConfig():
+    """
+    Parsed copy of a key=value config file, normally /etc/pinet.
+    The file is read once and only read again when its modification time, size or inode changes.
+    """
+
+    def __init__(self, filep = "/etc/pinet"):
+        super(pinetConfig, self).__init__()
+        self.filep = filep
+        self.lines = []
+        self.values = {}
+        self.fileStamp = None
+
+    def refresh(self):
+        try:
+            fileInfo = os.stat(self.filep)
+            stamp = (fileInfo.st_mtime_ns, fileInfo.st_size, fileInfo.st_ino)
+        except OSError:
+            stamp = None
+        if stamp is not None and stamp == self.fileStamp:
+            return
+        self.lines = getList(self.filep)
+        self.values = {}
+        for line in self.lines:
+            key = self.lineKey(line)
+            if key is not None:
+                self.values[key] = line.split("=", 1)[1].rstrip() #Later lines win, same as sourcing the file in bash
+        self.fileStamp = stamp
+
+    def lineKey(self, line):
+        if not "=" in line:
+            return None
+        key = line.split("=", 1)[0].strip()
+        if key == "" or key.startswith("#"):
+            return None
+        return key
 
+    def get(self, key, default = "None"):
+        self.refresh()
+        return self.values.get(key, default)
+
+    def set(self, changes):
+        """
+        Applies a list of (key, value) pairs with a single atomic write.
+        Every existing line for a key is updated in place, new keys are appended to the end.
+        Returns False if nothing needed to change, so the file was left alone.
+        """
+        self.refresh()
+        newValues = {}
+        order = []
+        for key, value in changes:
+            if not key in newValues:
+                order.append(key)
+            newValues[key] = str(value)
+        lines = []
+        found = set()
+        changed = False
+        for line in self.lines:
+            key = self.lineKey(line)
+            if key in newValues:
+                found.add(key)
+                newLine = key + "=" + newValues[key]
+                if newLine != line:
+                    changed = True
+                line = newLine
+            lines.append(line)
+        for key in order:
+            if not key in found:
+                lines.append(key + "=" + newValues[key])
+                changed = True
+        if not changed:
+            return False
+        writeFileAtomic(self.filep, "".join(line + "\n" for line in lines))
+        info("Updated " + ", ".join(order) + " in " + self.filep)
+        self.fileStamp = None
+        return True
+
+def getConfig(filep = "/etc/pinet"):
+    """
+    Returns the shared pinetConfig object for a config file, creating it on first use.
+    """
+    if not filep in configFileData:
+        configFileData[filep] = pinetConfig(filep)
+    return configFileData[filep]
+
+def getConfigParameter(filep, searchfor):
+    """
+    Returns the value of a key in a config file, where searchfor is the key followed by "=" (for example "NBD=").
+    Returns "None" if the key is missing or blank.
+    """
+    if searchfor.endswith("="):
+        searchfor = searchfor[0:len(searchfor) - 1]
+    value = getConfig(filep).get(searchfor, "")
     if value == "":
         value = "None"
 
     return value
 
 def setConfigParameter(option, value, filep = "/etc/pinet"):
-    newValue = option + "=" + value
-    replaceLineOrAdd(filep, option, newValue)
+    getConfig(filep).set([(option, value)])
+
+def setConfigParameters(parameters, filep = "/etc/pinet"):
+    """
+    Sets a number of config parameters with a single write. Pass a list of "option=value" strings.
+    """
+    changes = []
+    for parameter in parameters:
+        if not "=" in parameter:
+            print(_("Invalid config parameter") + " " + parameter)
+            returnData(1)
+            return False
+        option, value = parameter.split("=", 1)
+        changes.append((option, value))
+    getConfig(filep).set(changes)
+    returnData(0)
+    return True
+
+def readColonDatabase(filep):
+    """
+    Reads a colon separated database like /etc/passwd into an OrderedDict of the first field to the list of fields.
+    Returns None if the file doesn't exist.
+    """
+    from collections import OrderedDict
+    if not os.path.exists(filep):
+        return None
+    entries = OrderedDict()
+    for line in iterTextFile(filep):
+        if line.strip() != "":
+            fields = line.split(":")
+            entries[fields[0]] = fields
+    return entries
+
+class userDatabase():
+    """
+    In memory copy of the passwd, shadow, group and gshadow databases, each an OrderedDict of name to list of fields.
+    Use it in a with block. The databases are locked with /etc/.pwd.lock (the same lock useradd and friends take) and read at the start,
+    then each database that was changed is written once, atomically, when the block ends without an error.
+    """
+
+    databaseNames = ("passwd", "shadow", "group", "gshadow")
+
+    def __init__(self, etc = "/etc"):
+        super(userDatabase, self).__init__()
+        self.etc = etc
+        self.databases = {}
+        self.changed = set()
+        self.usedIDs = {}
+        self.lockFile = None
+
+    def lock(self):
+        import fcntl
+        self.lockFile = open(os.path.join(self.etc, ".pwd.lock"), "a")
+        fcntl.lockf(self.lockFile, fcntl.LOCK_EX)
+
+    def unlock(self):
+        if self.lockFile is not None:
+            self.lockFile.close() #Closing the file releases the lock
+            self.lockFile = None
+
+    def load(self):
+        for name in self.databaseNames:
+            self.databases[name] = readColonDatabase(os.path.join(self.etc, name)) #None if missing, so left alone, for example systems without gshadow
+        self.changed = set()
+        self.usedIDs = {}
+
+    def save(self):
+        for name in self.databaseNames:
+            if name in self.changed:
+                filep = os.path.join(self.etc, name)
+                shutil.copy2(filep, filep + "-") #Backup, same as the shadow tools keep
+                writeFileAtomic(filep, "".join(":".join(fields) + "\n" for fields in self.databases[name].values()))
+                info("Updated " + filep)
+        self.changed = set()
+
+    def __enter__(self):
+        self.lock()
+        try:
+            self.load()
+        except Exception:
+            self.unlock()
+            raise
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            if excType is None:
+                self.save()
+        finally:
+            self.unlock()
+
+    def get(self, database, name):
+        entries = self.databases.get(database)
+        if entries is None:
+            return None
+        return entries.get(name)
+
+    def names(self, database):
+        entries = self.databases.get(database)
+        if entries is None:
+            return []
+        return list(entries.keys())
+
+    def setEntry(self, database, fields):
+        entries = self.databases.get(database)
+        if entries is None:
+            return
+        previous = entries.get(fields[0])
+        if previous != fields:
+            entries[fields[0]] = fields
+            self.changed.add(database)
+            if previous is not None and previous[2:3] != fields[2:3]:
+                self.usedIDs.pop(database, None) #An ID has moved, work the used ones out again when next needed
+            elif database in self.usedIDs and fields[2].isdigit():
+                self.usedIDs[database].add(int(fields[2]))
+
+    def removeEntry(self, database, name):
+        entries = self.databases.get(database)
+        if entries is not None and name in entries:
+            del entries[name]
+            self.changed.add(database)
+            self.usedIDs.pop(database, None)
+
+    def idUsed(self, database, id):
+        if not database in self.usedIDs:
+            self.usedIDs[database] = set(int(fields[2]) for fields in self.databases[database].values() if len(fields) > 2 and fields[2].isdigit())
+        return id in self.usedIDs[database]
+
+    def nextFreeID(self, database, first = 1000, last = 59999):
+        """
+        Returns the next free uid (database "passwd") or gid (database "group"), picked the same way as useradd.
+        That is one above the highest in use between first and last, or the lowest gap if the top has been reached.
+        """
+        self.idUsed(database, first)
+        inRange = [id for id in self.usedIDs[database] if first <= id <= last]
+        candidate = max(inRange) + 1 if inRange else first
+        if candidate > last:
+            candidate = first
+            while self.idUsed(database, candidate) and candidate <= last:
+                candidate = candidate + 1
+            if candidate > last:
+                raise ValueError(_("No free IDs left in") + " " + database)
+        return candidate
+
+    def addGroup(self, name, gid = None):
+        """
+        Adds a group if it doesn't already exist. Returns its gid.
+        """
+        existing = self.get("group", name)
+        if existing is not None:
+            return int(existing[2])
+        if gid is None:
+            gid = self.nextFreeID("group")
+        self.setEntry("group", [name, "x", str(gid), ""])
+        self.setEntry("gshadow", [name, "!", "", ""])
+        return gid
+
+    def addUser(self, name, passwordHash, shell = "/bin/bash", home = None):
+        """
+        Adds a user along with a group of the same name, like useradd does on Ubuntu. Returns the (uid, gid) used.
+        """
+        uid = self.nextFreeID("passwd")
+        gid = uid
+        if self.idUsed("group", gid):
+            gid = self.nextFreeID("group")
+        gid = self.addGroup(name, gid)
+        if home is None:
+            home = "/home/" + name
+        self.setEntry("passwd", [name, "x", str(uid), str(gid), "", home, shell])
+        self.setEntry("shadow", [name, passwordHash, str(int(time.time() // 86400)), "0", "99999", "7", "", "", ""])
+        return uid, gid
+
+    def groupMembers(self, group):
+        fields = self.get("group", group)
+        if fields is None or len(fields) < 4:
+            return []
+        return [member for member in fields[3].split(",") if member != ""]
+
+    def addToGroup(self, user, group):
+        """
+        Adds user to the member list of a supplementary group, in both group and gshadow.
+        Returns True if anything changed. Groups which don't exist are skipped.
+        """
+        changed = False
+        for database in ("group", "gshadow"):
+            fields = self.get(database, group)
+            if fields is None or len(fields) < 4:
+                continue
+            members = [member for member in fields[3].split(",") if member != ""]
+            if not user in members:
+                members.append(user)
+                self.setEntry(database, fields[0:3] + [",".join(members)] + fields[4:])
+                changed = True
+        return changed
+
+def hashPassword(password):
+    """
+    Returns a SHA-512 crypt hash of password, for use in /etc/shadow.
+    """
+    import crypt
+    return crypt.crypt(password, crypt.mksalt(crypt.METHOD_SHA512))
+
+def hashPasswords(passwords):
+    """
+    Hashes a list of passwords using every CPU core, as SHA-512 crypt is deliberately slow.
+    """
+    if len(passwords) < 20:
+        return [hashPassword(password) for password in passwords]
+    from multiprocessing import Pool
+    pool = Pool()
+    try:
+        return pool.map(hashPassword, passwords, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+def createHomeFolder(user, uid, gid, home, skel = "/etc/skel"):
+    """
+    Creates a home folder for a user from /etc/skel, owned by the user.
+    It is built under a temporary name then renamed into place, so a home folder which exists is always complete.
+    Returns False if the folder already existed.
+    """
+    if os.path.exists(home):
+        return False
+    tempHome = os.path.join(os.path.dirname(home), "." + os.path.basename(home) + ".pinet-new")
+    removeFile(tempHome)
+    if os.path.isdir(skel):
+        shutil.copytree(skel, tempHome, symlinks=True)
+    else:
+        os.mkdir(tempHome)
+    os.lchown(tempHome, uid, gid)
+    for root, dirs, files in os.walk(tempHome):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid, gid)
+    os.chmod(tempHome, 0o755)
+    os.rename(tempHome, home)
+    return True
+
+def createHomeFolders(homes, workers = 8):
+    """
+    Creates home folders in parallel from a list of [user, uid, gid, home] entries, printing progress as it goes.
+    Returns the list of users whose home folder couldn't be created.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    failed = []
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for user, uid, gid, home in homes:
+            futures[pool.submit(createHomeFolder, user, uid, gid, home)] = user
+        for future in as_completed(futures):
+            done = done + 1
+            try:
+                future.result()
+            except (OSError, IOError, shutil.Error) as e:
+                failed.append(futures[future])
+                warning("Unable to create home folder for " + futures[future] + " - " + str(e))
+            if done % 50 == 0 or done == len(homes):
+                print(_("Home folders created") + " - " + str(done) + "/" + str(len(homes)))
+    return failed
+
+def loadImportJournal():
+    """
+    Returns the [user, uid, gid, home] entries an interrupted CSV import still needs home folders for.
+    """
+    import json
+    try:
+        with open(ImportJournal) as journal:
+            homes = json.load(journal)
+    except (OSError, IOError, ValueError):
+        return []
+    return [home for home in homes if userExists(home[0])]
+
+def saveImportJournal(homes):
+    import json
+    if homes:
+        makeFolder(os.path.dirname(ImportJournal))
+        writeFileAtomic(ImportJournal, json.dumps(homes))
+    else:
+        removeFile(ImportJournal)
+
+def userExists(user):
+    try:
+        pwd.getpwnam(user)
+        return True
+    except KeyError:
+        return False
 
 #def selectFile(start = "/home/"+os.environ['SUDO_USER']+"/"):
 #    pass
 def returnData(data):
-    with open("/tmp/ltsptmp", "w+") as text_file:
+    """
+    Hands a result back to the pinet bash script.
+    In server mode it is sent back with the reply, otherwise it is written to the return file (PINET_RETURN_FILE, default /tmp/ltsptmp) for gp to read.
+    """
+    global serverResult
+    if serverMode:
+        serverResult = str(data)
+        return
+    with open(ReturnFile, "w+") as text_file:
         text_file.write(str(data))
     return
     #return fileLoc
 
 def readReturn():
-    with open("/tmp/ltsptmp", "r") as text_file:
+    with open(ReturnFile, "r") as text_file:
         print(text_file.read())
 
-def removeFile(file):
+def removeFile(file, quiet = True):
+    """
+    Removes a file, link or whole folder. Errors are ignored unless quiet is False.
+    """
     try:
-        shutil.rmtree(file)
+        if os.path.isdir(file) and not os.path.islink(file):
+            shutil.rmtree(file)
+        else:
+            os.remove(file)
     except (OSError, IOError):
-        pass
+        if not quiet:
+            raise
 
 def copyFile(src, dest):
     shutil.copy(src, dest)
@@ -477,6 +1357,22 @@ def whiptailBox(whiltailType, title, message, returnTrueFalse ,height = "8", wid
     else:
         return p.returncode
 
+def whiptailTextBox(title, text, height = "24", width = "78"):
+    """
+    Shows a scrollable box of text. The text is passed through a temporary file, so it can be as long as needed.
+    """
+    import tempfile
+    fd, textLoc = tempfile.mkstemp(prefix="pinet")
+    try:
+        with os.fdopen(fd, "w") as textFile:
+            textFile.write(text)
+        cmd = ["whiptail", "--title", title, "--scrolltext", "--textbox", textLoc, height, width]
+        p = Popen(cmd,  stderr=PIPE)
+        p.communicate()
+        return p.returncode
+    finally:
+        removeFile(textLoc)
+
 def whiptailSelectMenu(title, message, items, height = "16", width = "78", other = "5"):
     cmd = ["whiptail", "--title", title, "--menu", message ,height, width, other]
     itemsList = ""
@@ -533,49 +1429,119 @@ def whiptailBoxYesNo(title, message, returnTrueFalse ,height = "8", width= "78",
 def replaceLineOrAdd(file, string, newString):
     """
     Basic find and replace function for entire line.
-    Pass it a text file in list form and it will search for strings.
-    If it finds a string, it will replace that entire line with newString
+    Streams the file and searches each line for string.
+    If it finds a string, it will replace that entire line with newString, if not newString is added to the end.
     """
-    textfile = getList(file)
-    textfile = findReplaceAnyLine(textfile, string, newString)
-    writeTextFile(textfile, file)
+    transformTextFile(file, [replaceLineRule(string, newString)])
 
 def replaceBitOrAdd(file, string, newString):
     """
     Basic find and replace function for section.
-    Pass it a text file in list form and it will search for strings.
+    Streams the file and searches each line for string.
     If it finds a string, it will replace that exact string with newString
     """
-    textfile = getList(file)
-    textfile = findReplaceSection(textfile, string, newString)
-    writeTextFile(textfile, file)
+    transformTextFile(file, [replaceSectionRule(string, newString)])
+
+def replaceLinesOrAdd(file, replacements):
+    """
+    Same as replaceLineOrAdd() for a number of strings at once, in a single pass over the file.
+    Pass it a list of [string, newString] pairs.
+    """
+    transformTextFile(file, [replaceLineRule(string, newString) for string, newString in replacements])
+
+def loadInternetCache():
+    """
+    Loads the cached site reachability results.
+    Results are only trusted if they came from this pinet session and are younger than InternetCacheTime.
+    """
+    import json
+    try:
+        with open(InternetCacheFile) as cacheFile:
+            cache = json.load(cacheFile)
+    except (OSError, IOError, ValueError):
+        return {}
+    if cache.get("session") != os.environ.get("PINET_SESSION", ""):
+        return {}
+    if time.time() - cache.get("time", 0) > InternetCacheTime:
+        return {}
+    return cache.get("sites", {})
+
+def saveInternetCache(results):
+    """
+    Adds the passed {url: True/False} results to the reachability cache.
+    """
+    import json
+    sites = loadInternetCache()
+    sites.update(results)
+    cache = {"session": os.environ.get("PINET_SESSION", ""), "time": time.time(), "sites": sites}
+    try:
+        tempLoc = InternetCacheFile + "." + str(os.getpid())
+        with open(tempLoc, "w") as cacheFile:
+            json.dump(cache, cacheFile)
+        os.replace(tempLoc, InternetCacheFile)
+    except (OSError, IOError):
+        debug("Unable to save internet status cache")
+
+def testSiteConnections(siteURLs, timeoutLimit = 5, deadline = None, firstSuccess = False):
+    """
+    Tests a list of websites at the same time, returning a dictionary of url to True/False.
+    Every probe shares one overall deadline, anything still running after it counts as failed.
+    If firstSuccess is True, stops waiting as soon as any one site responds.
+    Already cached results from this session are reused instead of probing again.
+    """
+    import threading, queue
+    if deadline is None:
+        deadline = int(timeoutLimit) + 1
+    cached = loadInternetCache()
+    results = {}
+    toTest = []
+    for url in siteURLs:
+        if url in cached:
+            results[url] = cached[url]
+        else:
+            results[url] = False
+            toTest.append(url)
+    if firstSuccess and True in results.values():
+        return results
+
+    resultQueue = queue.Queue()
+    def probe(url):
+        resultQueue.put((url, testSiteConnection(url, timeoutLimit)))
+    for url in toTest:
+        thread = threading.Thread(target=probe, args=(url,))
+        thread.daemon = True #Stragglers past the deadline must not hold up exiting
+        thread.start()
+
+    tested = {}
+    endTime = time.time() + deadline
+    for i in range(0, len(toTest)):
+        remaining = endTime - time.time()
+        if remaining <= 0:
+            break
+        try:
+            url, status = resultQueue.get(timeout=remaining)
+        except queue.Empty:
+            break
+        tested[url] = status
+        if firstSuccess and status:
+            break
+    if not (firstSuccess and True in tested.values()):
+        for url in toTest: #Only record timeouts as failures when a full answer was wanted
+            tested.setdefault(url, False)
+    results.update(tested)
+    saveInternetCache(tested)
+    return results
 
 def internet_on(timeoutLimit = 5, returnType = True):
     """
     Checks if there is an internet connection.
     If there is, return a 0, if not, return a 1
     """
-    import urllib.request
-    #print("Checking internet")
-    try:
-        response=urllib.request.urlopen('http://www.google.com',timeout=int(timeoutLimit))
-        returnData(0)
-        #print("returning 0")
-        return True
-    except:  pass
-    try:
-        response=urllib.request.urlopen('http://mirrordirector.raspbian.org/',timeout=int(timeoutLimit))
-        returnData(0)
-        #print("returning 0")
-        return True
-    except:  pass
-    try:
-        response=urllib.request.urlopen('http://18.62.0.96',timeout=int(timeoutLimit))
+    sites = ["http://www.google.com", "http://mirrordirector.raspbian.org/", "http://18.62.0.96"]
+    results = testSiteConnections(sites, timeoutLimit, firstSuccess = True)
+    if True in results.values():
         returnData(0)
-        #print("returning 0")
         return True
-    except:  pass
-    #print("Reached end, no internet")
     returnData(1)
     return False
 
@@ -602,14 +1568,15 @@ def internetFullStatusReport(timeoutLimit = 5, whiptail = False, returnStatus =
     sites.append([_("Bitbucket (Github mirror, not active yet)"), "https://bitbucket.org", ("Recommended"), False])
     sites.append([_("BlueJ"), "http://bluej.org", ("Recommended"), False])
     sites.append([_("PiNet metrics"), "https://secure.pinet.org.uk", ("Recommended"), False])
+    results = testSiteConnections([site[1] for site in sites], timeoutLimit)
     for website in range(0, len(sites)):
-        sites[website][3] = testSiteConnection(sites[website][1])
+        sites[website][3] = results[sites[website][1]]
     if returnStatus:
         return sites
     if whiptail:
         message = ""
         for website in sites:
-            if sites[3]:
+            if website[3]:
                 status = "Success"
             else:
                 status = "Failed"
@@ -662,10 +1629,14 @@ def updatePiNet():
     print("----------------------")
     print("")
     download = True
-    if not downloadFile(RawRepository +"/" + ReleaseBranch + "/pinet", "/usr/local/bin/pinet"):
-        download = False
-    if not downloadFile(RawRepository +"/" + ReleaseBranch + "/Scripts/pinet-functions-python.py", "/usr/local/bin/pinet-functions-python.py"):
-        download = False
+    makeFolder(os.path.dirname(SoftwareManifest))
+    with downloadSession() as session: #All from the same host, so one connection does
+        if not downloadFile(RawRepository +"/" + ReleaseBranch + "/pinet", "/usr/local/bin/pinet", session=session):
+            download = False
+        if not downloadFile(RawRepository +"/" + ReleaseBranch + "/Scripts/pinet-functions-python.py", "/usr/local/bin/pinet-functions-python.py", session=session):
+            download = False
+        if not downloadFile(RawRepository +"/" + ReleaseBranch + "/Scripts/software.manifest", SoftwareManifest, session=session):
+            download = False
     if download:
         print("----------------------")
         print(_("Update complete"))
@@ -681,19 +1652,85 @@ def updatePiNet():
         returnData(1)
 
 
-def checkUpdate2():
+def parseReleaseFeed(data, maxEntries = 20):
+    """
+    Parses the GitHub commits atom feed into a list of {"version": release version or None, "lines": commit message lines}, newest first.
+    """
+    import xml.etree.ElementTree as ElementTree
+    import re
+    atom = "{http://www.w3.org/2005/Atom}"
+    entries = []
+    for entry in ElementTree.fromstring(data).findall(atom + "entry")[0:maxEntries]:
+        content = entry.findtext(atom + "content") or entry.findtext(atom + "title") or ""
+        try:
+            text = "".join(ElementTree.fromstring(content).itertext())
+        except ElementTree.ParseError:
+            text = re.sub(r"<[^>]*>", "", content)
+        lines = text.strip("\n").split("\n")
+        entries.append({"version": GetVersionNum(lines), "lines": lines})
+    return entries
+
+def loadReleaseInfo():
+    import json
+    try:
+        with open(ReleaseCache) as cacheFile:
+            return json.load(cacheFile)
+    except (OSError, IOError, ValueError):
+        return None
+
+def refreshReleaseInfo(force = False):
+    """
+    Fetches the release feed and kernel version for the current release channel into ReleaseCache, unless the cache is younger than ReleaseCacheTime.
+    Both are fetched with conditional requests (see downloadFile), so an unchanged feed costs one round trip each. Run in the background by pinet at start up.
+    Returns the release info, or None if it couldn't be fetched.
+    """
+    info = loadReleaseInfo()
+    if not force and info is not None and info.get("branch") == ReleaseBranch and time.time() - info.get("fetched", 0) < ReleaseCacheTime:
+        return info
+    import tempfile, json
+    folder = tempfile.mkdtemp(prefix="pinet-releases-")
+    try:
+        with downloadSession() as session:
+            if not downloadFile(Repository + "/commits/" + ReleaseBranch + ".atom", os.path.join(folder, "feed.atom"), session=session):
+                return None
+            kernelVersion = None
+            if downloadFile(RawBootRepository + "/" + ReleaseBranch + "/boot/version.txt", os.path.join(folder, "version.txt"), session=session):
+                kernelVersion = getCleanList(os.path.join(folder, "version.txt"))[0]
+        downloadFile("http://bit.ly/pinetCheckCommits", "/dev/null")
+        with open(os.path.join(folder, "feed.atom"), "rb") as feed:
+            releases = parseReleaseFeed(feed.read())
+    except Exception:
+        debug("Unable to read the release feed")
+        return None
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    info = {"branch": ReleaseBranch, "fetched": time.time(), "releases": releases, "kernelVersion": kernelVersion}
+    makeFolder(os.path.dirname(ReleaseCache))
+    writeFileAtomic(ReleaseCache, json.dumps(info))
+    return info
+
+def getReleaseInfo():
     """
-    Grabs the xml commit log to check for releases. Picks out most recent release and returns it.
+    Returns the cached release info for the current release channel, even if old (refreshReleaseInfo() runs in the background to update it).
+    Only fetches it here if there is nothing cached yet.
     """
+    info = loadReleaseInfo()
+    if info is None or info.get("branch") != ReleaseBranch:
+        info = refreshReleaseInfo(True)
+    return info
+
+def latestRelease(info):
+    for release in (info or {}).get("releases", []):
+        if release["version"] is not None:
+            return release["version"]
+    return None
 
-    loc = "/tmp/raspiupdate.txt"
-    downloadFile("http://bit.ly/pinetcheckmaster", loc)
-    from xml.dom import minidom
-    xmldoc = minidom.parse(loc)
-    version = xmldoc.getElementsByTagName('title')[1].firstChild.nodeValue
-    version = cleanStrings([version,])[0]
-    if version.find("Release") != -1:
-        version = version[8:len(version)]
+def checkUpdate2():
+    """
+    Prints the most recent release version, from the release cache.
+    """
+    version = latestRelease(getReleaseInfo())
+    if version is not None:
         print(version)
     else:
         print(_("ERROR"))
@@ -709,41 +1746,38 @@ def GetVersionNum(data):
 
 
 def checkUpdate(currentVersion):
-    if not internet_on(5, False):
-        print(_("No Internet Connection"))
+    """
+    Checks the cached release feed for a newer release than currentVersion, offering to show the release history and update if there is one.
+    """
+    thisVersion = latestRelease(getReleaseInfo())
+    if thisVersion is None:
+        print(_("Unable to check for PiNet software updates"))
         returnData(0)
-    import feedparser
-    import xml.etree.ElementTree
-    downloadFile("http://bit.ly/pinetCheckCommits", "/dev/null")
-    d = feedparser.parse(Repository +'/commits/' +ReleaseBranch + '.atom')
-    releases = []
-    data = (d.entries[0].content[0].get('value'))
-    data = ''.join(xml.etree.ElementTree.fromstring(data).itertext())
-    data = data.split("\n")
-    thisVersion = GetVersionNum(data)
-    #thisVersion = data[0].rstrip()
-    #thisVersion = thisVersion[8:len(thisVersion)]
-
+        return
     if compareVersions(currentVersion, thisVersion):
         whiptailBox("msgbox", _("Update detected"), _("An update has been detected for PiNet. Select OK to view the Release History."), False)
         displayChangeLog(currentVersion)
     else:
         print(_("No PiNet software updates found"))
-        #print(thisVersion)
-        #print(currentVersion)
         returnData(0)
 
 
 
 def checkKernelFileUpdateWeb():
-    #downloadFile(RawRepository +"/" + ReleaseBranch + "/boot/version.txt", "/tmp/kernelVersion.txt")
-    downloadFile(RawBootRepository +"/" + ReleaseBranch + "/boot/version.txt", "/tmp/kernelVersion.txt")
-    import os.path
+    """
+    Compares the kernel files version in the release cache with the one in PiBoot. The new version is also written to /tmp/kernelVersion.txt for pinet to show.
+    """
+    info = getReleaseInfo()
+    if info is None or info.get("kernelVersion") is None:
+        returnData(0)
+        print(_("Unable to check for kernel updates"))
+        return True
+    createTextFile("/tmp/kernelVersion.txt", info["kernelVersion"] + "\n")
     user=os.environ['SUDO_USER']
     currentPath="/home/"+user+"/PiBoot/version.txt"
     if (os.path.isfile(currentPath)) == True:
         current = int(getCleanList(currentPath)[0])
-        new = int(getCleanList("/tmp/kernelVersion.txt")[0])
+        new = int(info["kernelVersion"])
         if new > current:
             returnData(1)
             return False
@@ -786,17 +1820,15 @@ def installCheckKernelUpdater():
 #def importUsers():
 
 def displayChangeLog(version):
+    """
+    Shows the release history since version from the release cache, offering to install the newest release.
+    """
     version = "Release " + version
-    import feedparser
-    import xml.etree.ElementTree
-    d = feedparser.parse(Repository +'/commits/' +ReleaseBranch + '.atom')
     releases = []
-    for x in range(0, len(d.entries)):
-        data = (d.entries[x].content[0].get('value'))
-        data = ''.join(xml.etree.ElementTree.fromstring(data).itertext())
-        data = data.split("\n")
-        thisVersion = "Release " + GetVersionNum(data)
-        #thisVersion = data[0].rstrip()
+    entries = (getReleaseInfo() or {}).get("releases", [])
+    for x in range(0, len(entries)):
+        data = entries[x]["lines"]
+        thisVersion = "Release " + str(entries[x]["version"])
         if thisVersion == version:
             break
         elif x == 10:
@@ -804,6 +1836,9 @@ def displayChangeLog(version):
         if data[0][0:5] == "Merge":
             continue
         releases.append(data)
+    if not releases:
+        returnData(0)
+        return False
     output=[]
     for i in range(0, len(releases)):
         output.append(releases[i][0])
@@ -827,285 +1862,3358 @@ def displayChangeLog(version):
     else:
         return "ERROR"
 
-def previousImport():
-    items = ["passwd", "group", "shadow", "gshadow"]
-    #items = ["group",]
-    toAdd = []
-    for x in range(0, len(items)):
-        #migLoc = "/Users/Andrew/Documents/Code/pinetImportTest/" + items[x] + ".mig"
-        #etcLoc = "/Users/Andrew/Documents/Code/pinetImportTest/" + items[x]
-        migLoc = "/root/move/" + items[x] + ".mig"
-        etcLoc = "/etc/" + items[x]
-        debug("mig loc " + migLoc)
-        debug("etc loc " + etcLoc)
-        mig = getList(migLoc)
-        etc = getList(etcLoc)
-        for i in range(0, len(mig)):
-            mig[i] = str(mig[i]).split(":")
-        for i in range(0, len(etc)):
-            etc[i] = str(etc[i]).split(":")
-        for i in range(0, len(mig)):
-            unFound = True
-            for y in range(0, len(etc)):
-                bob = mig[i][0]
-                thing = etc[y][0]
-                if bob == thing:
-                    unFound = False
-            if unFound:
-                toAdd.append(mig[i])
-        for i in range(0, len(toAdd)):
-            etc.append(toAdd[i])
-        for i in range(0, len(etc)):
-            line = ""
-            for y in range(0, len(etc[i])):
-                line = line  + etc[i][y] + ":"
-            line = line[0:len(line) - 1]
-            etc[i] = line
-        debug(etc)
-        writeTextFile(etc, etcLoc)
+def mergeUserDatabases(database, migrated):
+    """
+    Merges migrated passwd, shadow, group and gshadow entries (a dict of database name to readColonDatabase() result) into a userDatabase.
+    New users and groups are added, members of groups which exist on both are combined.
+    Users or groups whose name, uid or gid clashes with a different one already here are left out.
+    Returns (added, conflicts), both lists of descriptions.
+    """
+    added = []
+    conflicts = []
+    uids = dict((fields[2], name) for name, fields in database.databases["passwd"].items() if len(fields) > 2)
+    gids = dict((fields[2], name) for name, fields in database.databases["group"].items() if len(fields) > 2)
+    newUsers = set()
+    for name, fields in (migrated.get("passwd") or {}).items():
+        existing = database.get("passwd", name)
+        if len(fields) != 7:
+            conflicts.append(_("User") + " " + name + " - " + _("invalid passwd entry"))
+        elif existing is not None:
+            if existing[2] != fields[2]:
+                conflicts.append(_("User") + " " + name + " - " + _("already exists with uid") + " " + existing[2] + ", " + _("not") + " " + fields[2])
+        elif fields[2] in uids:
+            conflicts.append(_("User") + " " + name + " - " + _("uid") + " " + fields[2] + " " + _("is already used by") + " " + uids[fields[2]])
+        else:
+            database.setEntry("passwd", fields)
+            uids[fields[2]] = name
+            newUsers.add(name)
+            added.append(_("User") + " " + name + " (" + fields[2] + ")")
+    for name, fields in (migrated.get("shadow") or {}).items():
+        if name in newUsers:
+            database.setEntry("shadow", fields)
+    for name in newUsers:
+        if database.get("shadow", name) is None:
+            database.setEntry("shadow", [name, "!", str(int(time.time() // 86400)), "0", "99999", "7", "", "", ""]) #Locked until a password is set
+    migratedGshadow = migrated.get("gshadow") or {}
+    for name, fields in (migrated.get("group") or {}).items():
+        if len(fields) != 4:
+            conflicts.append(_("Group") + " " + name + " - " + _("invalid group entry"))
+            continue
+        members = [member for member in fields[3].split(",") if member != ""]
+        existing = database.get("group", name)
+        if existing is not None:
+            if existing[2] != fields[2]:
+                conflicts.append(_("Group") + " " + name + " - " + _("already exists with gid") + " " + existing[2] + ", " + _("not") + " " + fields[2] + ", " + _("members merged"))
+            for member in members:
+                database.addToGroup(member, name)
+        elif fields[2] in gids:
+            conflicts.append(_("Group") + " " + name + " - " + _("gid") + " " + fields[2] + " " + _("is already used by") + " " + gids[fields[2]])
+        else:
+            database.setEntry("group", fields)
+            gshadowFields = migratedGshadow.get(name)
+            if gshadowFields is None or len(gshadowFields) != 4:
+                gshadowFields = [name, "!", "", fields[3]]
+            database.setEntry("gshadow", gshadowFields)
+            gids[fields[2]] = name
+            added.append(_("Group") + " " + name + " (" + fields[2] + ")")
+    return added, conflicts
 
-def importFromCSV(theFile, defaultPassword, test = True):
-    import csv
-    import os
-    from sys import exit
-    import crypt
-    userData=[]
-    if test == "True" or True:
-        test = True
+def previousImport(migLoc = "/root/move"):
+    """
+    Imports the users and groups exported by pinet (the .mig files in migLoc) into this server, in a single pass with each database written once.
+    Prints what was imported and any clashes, then returns the number of clashes through returnData.
+    """
+    migrated = {}
+    for name in userDatabase.databaseNames:
+        migrated[name] = readColonDatabase(os.path.join(migLoc, name + ".mig"))
+    with userDatabase() as database:
+        added, conflicts = mergeUserDatabases(database, migrated)
+    print(_("Imported") + " " + str(len(added)) + " " + _("users and groups"))
+    for conflict in conflicts:
+        print(_("Not imported") + " - " + conflict)
+    returnData(len(conflicts))
+
+def exportUserDatabases(etc = "/etc"):
+    """
+    Returns the users and groups to move to a new server, as a dict of database name to a list of entries (each a list of fields).
+    Like the old .mig files, this is every user and group with an id of 1000 or more (except nobody), their shadow entries and all of gshadow.
+    """
+    exported = {}
+    for name in ("passwd", "group"):
+        exported[name] = [fields for fields in (readColonDatabase(os.path.join(etc, name)) or {}).values()
+                          if len(fields) > 2 and fields[2].isdigit() and int(fields[2]) >= 1000 and int(fields[2]) != 65534]
+    users = set(fields[0] for fields in exported["passwd"])
+    exported["shadow"] = [fields for user, fields in (readColonDatabase(os.path.join(etc, "shadow")) or {}).items() if user in users]
+    exported["gshadow"] = list((readColonDatabase(os.path.join(etc, "gshadow")) or {}).values())
+    return exported
+
+class migrationBundleWriter():
+    """
+    Writes a PiNet migration bundle to a binary file object, which can be a pipe as nothing is ever seeked.
+    The bundle is "PINETMOVE 1" then a series of sections, each a JSON header line followed by the section data as zlib compressed blocks
+    (each prefixed with its 4 byte length, ending with a zero length) and then the SHA-256 of the uncompressed data.
+    Blocks are compressed by a pool of threads (zlib lets go of the GIL) while the data is still being produced, and written in order.
+    """
+
+    def __init__(self, output, workers = None):
+        super(migrationBundleWriter, self).__init__()
+        from concurrent.futures import ThreadPoolExecutor
+        import collections
+        self.output = output
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = collections.deque()
+        self.output.write(MigrationBundleMagic)
+
+    def startSection(self, header):
+        import json, hashlib
+        self.output.write((json.dumps(header) + "\n").encode())
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size = self.size + len(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= MigrationBlockSize:
+            self.queueBlock(bytes(self.buffer[0:MigrationBlockSize]))
+            del self.buffer[0:MigrationBlockSize]
+        return len(data)
+
+    def queueBlock(self, block):
+        import zlib
+        self.pending.append(self.pool.submit(zlib.compress, block, 6))
+        while len(self.pending) > self.workers * 2:
+            self.writeBlock(self.pending.popleft().result())
+
+    def writeBlock(self, compressed):
+        self.output.write(len(compressed).to_bytes(4, "big"))
+        self.output.write(compressed)
+
+    def endSection(self):
+        if self.buffer:
+            self.queueBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.writeBlock(self.pending.popleft().result())
+        self.output.write((0).to_bytes(4, "big"))
+        self.output.write(self.digest.digest())
+        return self.size
+
+    def addSection(self, header, data):
+        self.startSection(header)
+        self.write(data)
+        return self.endSection()
+
+    def close(self):
+        self.addSection({"kind": "end"}, b"")
+        self.output.flush()
+        self.pool.shutdown()
+
+def migrationSections(home = "/home"):
+    """
+    Returns the sections to go in a migration bundle for /home, as header dictionaries.
+    Each folder in /home gets its own section, marked as a home if it belongs to a user, as the shared folders if it is /home/shared, or otherwise just as a folder.
+    """
+    homes = dict((fields[5], fields[0]) for fields in (readColonDatabase("/etc/passwd") or {}).values() if len(fields) > 5)
+    sections = []
+    for name in sorted(os.listdir(home)):
+        path = os.path.join(home, name)
+        if not os.path.isdir(path) or os.path.islink(path) or name.startswith("."):
+            continue
+        if path in homes:
+            sections.append({"kind": "home", "name": name, "user": homes[path]})
+        elif name == "shared":
+            sections.append({"kind": "shared", "name": name})
+        else:
+            sections.append({"kind": "folder", "name": name})
+    for path in MigrationFiles:
+        if os.path.isfile(path):
+            sections.append({"kind": "file", "name": path})
+    return sections
+
+def createMigrationBundle(destination, home = "/home"):
+    """
+    Writes everything needed to move PiNet to a new server (users and groups, every folder in /home including the shared folders, and the shared folder mounts) to a migration bundle in one pass.
+    destination is a file, or - to stream the bundle to stdout (to pipe it straight to the new server for example). See migrationBundleWriter for the format.
+    """
+    import json, tarfile
+    sections = migrationSections(home)
+    if destination == "-":
+        output = sys.stdout.buffer
+        log = sys.stderr
     else:
-        test = False
-    if os.path.isfile(theFile):
-        with open(theFile) as csvFile:
-            data = csv.reader(csvFile, delimiter=' ', quotechar='|')
-            for row in data:
+        output = atomicFile(destination, "wb")
+        log = sys.stdout
+    writer = migrationBundleWriter(output if destination == "-" else output.file)
+    try:
+        manifest = {"created": time.time(), "hostname": os.uname()[1], "home": home, "sections": sections}
+        writer.addSection({"kind": "manifest", "name": "manifest"}, json.dumps(manifest).encode())
+        writer.addSection({"kind": "accounts", "name": "accounts"}, json.dumps(exportUserDatabases()).encode())
+        for section in sections:
+            writer.startSection(section)
+            if section["kind"] == "file":
+                with open(section["name"], "rb") as sectionFile:
+                    shutil.copyfileobj(sectionFile, writer, MigrationBlockSize)
+            else:
+                with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                    tar.add(os.path.join(home, section["name"]), arcname=section["name"])
+            size = writer.endSection()
+            print(_("Added") + " " + section["name"] + " (" + str(size // 1048576) + "MB)", file=log)
+        writer.close()
+    except BaseException:
+        if destination != "-":
+            output.discard()
+        raise
+    if destination != "-":
+        output.commit()
+    print(_("Migration bundle complete") + " - " + str(len(sections)) + " " + _("folders"), file=log)
+
+class migrationSectionReader():
+    """
+    File like object giving the uncompressed data of one section of a migration bundle, from compressed blocks put on its queue by importMigrationBundle() (None marks the end).
+    verify() checks the SHA-256 of everything read against the one given at the end of the section.
+    """
+
+    def __init__(self, blocks):
+        super(migrationSectionReader, self).__init__()
+        import hashlib
+        self.blocks = blocks
+        self.data = b""
+        self.finished = False
+        self.digest = hashlib.sha256()
+
+    def read(self, size = -1):
+        import zlib
+        while not self.finished and (size < 0 or len(self.data) < size):
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+            else:
                 try:
-                    theRow=str(row[0]).split(",")
-                except:
-                    whiptailBox("msgbox", _("Error!"), _("CSV file invalid!"), False)
-                    sys.exit()
-                user=theRow[0]
-                if " " in user:
-                    whiptailBox("msgbox", _("Error!"), _("CSV file names column (1st column) contains spaces in the usernames! This isn't supported."), False)
-                    returnData("1")
-                    sys.exit()
-                if len(theRow) >= 2:
-                    if theRow[1] == "":
-                        password=defaultPassword
-                    else:
-                        password=theRow[1]
+                    block = zlib.decompress(block)
+                except zlib.error:
+                    raise IOError("Damaged block")
+                self.digest.update(block)
+                self.data = self.data + block
+        if size < 0:
+            size = len(self.data)
+        data = self.data[0:size]
+        self.data = self.data[size:]
+        return data
+
+    def drain(self):
+        while not self.finished:
+            self.finished = self.blocks.get() is None
+
+    def verify(self, expected):
+        while self.read(MigrationBlockSize):
+            pass #Anything left over must still be counted
+        return self.digest.digest() == expected
+
+def mergeFolder(source, target):
+    """
+    Moves everything in source into target, replacing files and symlinks which are in both and merging folders. source is removed.
+    """
+    for name in os.listdir(source):
+        sourcePath = os.path.join(source, name)
+        targetPath = os.path.join(target, name)
+        if os.path.isdir(targetPath) and not os.path.islink(targetPath) and os.path.isdir(sourcePath) and not os.path.islink(sourcePath):
+            mergeFolder(sourcePath, targetPath)
+        else:
+            if os.path.isdir(targetPath) and not os.path.islink(targetPath):
+                shutil.rmtree(targetPath)
+            os.replace(sourcePath, targetPath)
+    os.rmdir(source)
+
+def importMigrationSection(section, reader, expected, home):
+    """
+    Restores one section of a migration bundle. Folders are unpacked next to where they belong and only moved into place once the section checksum matches.
+    expected is a future giving the checksum, as it comes after the data. Returns a description of the problem, or None if it worked.
+    """
+    try:
+        return unpackMigrationSection(section, reader, expected, home)
+    finally:
+        reader.drain() #So reading the bundle carries on if this section failed part way
+
+def unpackMigrationSection(section, reader, expected, home):
+    import tarfile
+    if section["kind"] == "file":
+        with atomicFile(section["name"], "wb") as restored:
+            shutil.copyfileobj(reader, restored, MigrationBlockSize)
+            if not reader.verify(expected.result()):
+                restored.discard()
+                return section["name"] + " " + _("is damaged")
+        return None
+    target = os.path.join(home, section["name"])
+    tempFolder = os.path.join(home, "." + section["name"] + ".pinet-import")
+    removeFile(tempFolder)
+    os.mkdir(tempFolder)
+    try:
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for member in tar:
+                parts = member.name.split("/")
+                if member.name.startswith("/") or ".." in parts or parts[0] != section["name"]:
+                    continue #Nothing may be unpacked outside the folder
+                tar.extract(member, tempFolder)
+    except BaseException:
+        removeFile(tempFolder)
+        raise
+    if not reader.verify(expected.result()):
+        removeFile(tempFolder)
+        return section["name"] + " " + _("is damaged")
+    unpacked = os.path.join(tempFolder, section["name"])
+    if not os.path.exists(target):
+        os.rename(unpacked, target)
+        os.rmdir(tempFolder)
+    else:
+        mergeFolder(unpacked, target)
+        os.rmdir(tempFolder)
+    return None
+
+def readBundleSection(bundle):
+    """
+    Reads the header line of the next section of a migration bundle, returning it as a dictionary.
+    """
+    import json
+    line = bundle.readline()
+    if not line.endswith(b"\n"):
+        raise IOError("The migration bundle ends early")
+    return json.loads(line.decode())
+
+def readBundleBlocks(bundle):
+    """
+    Yields the compressed blocks of a migration bundle section. The section checksum (32 bytes) follows them.
+    """
+    while True:
+        length = int.from_bytes(bundle.read(4), "big")
+        if length == 0:
+            break
+        block = bundle.read(length)
+        if len(block) != length:
+            raise IOError("The migration bundle ends early")
+        yield block
+
+def readWholeBundleSection(bundle):
+    """
+    Returns the uncompressed data of a (small) migration bundle section, raising IOError if its checksum doesn't match.
+    """
+    import zlib, hashlib
+    data = b"".join(zlib.decompress(block) for block in readBundleBlocks(bundle))
+    if hashlib.sha256(data).digest() != bundle.read(32):
+        raise IOError("The migration bundle is damaged")
+    return data
+
+def importMigrationBundle(source, home = "/home", workers = 4):
+    """
+    Imports a migration bundle made by createMigrationBundle() from a file, or - for stdin.
+    The users and groups are merged in first (see mergeUserDatabases()), then the folders are unpacked in parallel while the rest of the bundle is still being read.
+    Returns the number of users and groups which clashed plus the number of sections which failed through returnData.
+    """
+    import json, queue, tarfile
+    from concurrent.futures import ThreadPoolExecutor, Future
+    from collections import OrderedDict
+    bundle = sys.stdin.buffer if source == "-" else open(source, "rb")
+    if bundle.readline() != MigrationBundleMagic:
+        print(_("This is not a PiNet migration bundle"))
+        returnData(1)
+        return
+    problems = []
+    try:
+        header = readBundleSection(bundle)
+        manifest = json.loads(readWholeBundleSection(bundle).decode())
+        print(_("Importing from") + " " + manifest["hostname"] + ", " + _("made") + " " + time.strftime("%Y-%m-%d %H:%M", time.localtime(manifest["created"])))
+        header = readBundleSection(bundle)
+        exported = json.loads(readWholeBundleSection(bundle).decode())
+        migrated = dict((name, OrderedDict((fields[0], fields) for fields in entries)) for name, entries in exported.items())
+        with userDatabase() as database:
+            added, conflicts = mergeUserDatabases(database, migrated)
+        print(_("Imported") + " " + str(len(added)) + " " + _("users and groups"))
+        for conflict in conflicts:
+            print(_("Not imported") + " - " + conflict)
+        problems.extend(conflicts)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = []
+            while True:
+                section = readBundleSection(bundle)
+                if section["kind"] == "end":
+                    readWholeBundleSection(bundle)
+                    break
+                blocks = queue.Queue(maxsize=16)
+                expected = Future()
+                reader = migrationSectionReader(blocks)
+                running.append((section, pool.submit(importMigrationSection, section, reader, expected, home)))
+                try:
+                    for block in readBundleBlocks(bundle):
+                        blocks.put(block)
+                    expected.set_result(bundle.read(32))
+                except BaseException:
+                    expected.set_result(b"") #Never matches, so the part read is thrown away
+                    raise
+                finally:
+                    blocks.put(None)
+            for section, result in running:
+                try:
+                    problem = result.result()
+                except (OSError, IOError, EOFError, ValueError, tarfile.TarError) as e:
+                    problem = section["name"] + " - " + str(e)
+                if problem is None:
+                    print(_("Imported") + " " + section["name"])
                 else:
-                    password=defaultPassword
-                userData.append([user, password])
-            if test:
-                thing = ""
-                for i in range(0, len(userData)):
-                    thing = thing + _("Username") + " - " + userData[i][0] + " : " + _("Password - ") + userData[i][1] + "\n"
-                cmd = ["whiptail", "--title", _("About to import (Use arrow keys to scroll)") ,"--scrolltext", "--"+"yesno", "--yes-button", _("Import") , "--no-button", _("Cancel"), thing, "24", "78"]
-                p = Popen(cmd,  stderr=PIPE)
-                out, err = p.communicate()
-                if p.returncode == 0:
-                    for x in range(0, len(userData)):
-                        user = userData[x][0]
-                        password = userData[x][1]
-                        encPass = crypt.crypt(password,"22")
-                        cmd = ["useradd", "-m", "-s", "/bin/bash", "-p", encPass, user]
-                        p = Popen(cmd,  stderr=PIPE)
-                        out, err = p.communicate()
-                        fixGroupSingle(user)
-                        print("Import of " + user + " complete.")
-                    whiptailBox("msgbox", _("Complete"), _("Importing of CSV data has been complete."), False)
+                    print(_("Not imported") + " - " + problem)
+                    problems.append(problem)
+    except (OSError, IOError, ValueError) as e:
+        print(_("Unable to read the migration bundle") + " - " + str(e))
+        problems.append(str(e))
+    if source != "-":
+        bundle.close()
+    returnData(len(problems))
+
+def readUserCSV(theFile, defaultPassword):
+    """
+    Checks a CSV file of users a row at a time. The 1st column is the username, the optional 2nd column the password.
+    Returns (users, skipped, errors), users being (username, password) pairs to add, skipped the usernames which already exist
+    and errors a list of problems found, with their line numbers.
+    """
+    import csv, re
+    validName = re.compile(r"^[a-z_][a-z0-9_-]{0,31}$")
+    existingUsers = set(user.pw_name for user in pwd.getpwall())
+    existingGroups = set(group.gr_name for group in grp.getgrall())
+    users = []
+    skipped = []
+    errors = []
+    seen = set()
+    with open(theFile, newline="", encoding="utf-8-sig") as csvFile:
+        data = csv.reader(csvFile)
+        for row in data:
+            if not row or row[0].strip() == "":
+                continue
+            user = row[0].strip()
+            line = _("Line") + " " + str(data.line_num) + " - "
+            if user in existingUsers:
+                skipped.append(user)
+            elif not validName.match(user):
+                errors.append(line + user + " " + _("isn't a valid username (lower case letters, numbers, - and _ only, up to 32 characters)"))
+            elif user in seen:
+                errors.append(line + user + " " + _("is in the file more than once"))
+            elif user in existingGroups:
+                errors.append(line + user + " " + _("is already used as a group name"))
+            else:
+                seen.add(user)
+                if len(row) >= 2 and row[1] != "":
+                    password = row[1]
                 else:
-                    sys.exit()
-    else:
+                    password = defaultPassword
+                users.append((user, password))
+    return users, skipped, errors
+
+def importFromCSV(theFile, defaultPassword, test = True):
+    """
+    Imports users from a CSV file (username in the 1st column, optional password in the 2nd).
+    The whole file is checked first, then every passwd, shadow and group change is made in memory and each database is written once.
+    Home folders are created last, in parallel. Users still needing a home folder are kept in ImportJournal, so an interrupted import is finished off next time.
+    """
+    import csv
+    pending = loadImportJournal()
+    if pending:
+        print(_("Finishing home folders from a previous import"))
+        failed = createHomeFolders(pending)
+        saveImportJournal([home for home in pending if home[0] in failed])
+
+    if not os.path.isfile(theFile):
         print(_("Error! CSV file not found at") + " " + theFile)
+        returnData(1)
+        return
+    try:
+        users, skipped, errors = readUserCSV(theFile, defaultPassword)
+    except (csv.Error, ValueError):
+        whiptailBox("msgbox", _("Error!"), _("CSV file invalid!"), False)
+        returnData(1)
+        return
+    if errors:
+        whiptailTextBox(_("CSV file problems, nothing has been imported"), "\n".join(errors) + "\n")
+        returnData(1)
+        return
+    if not users:
+        whiptailBox("msgbox", _("Nothing to import"), _("All the users in the CSV file already exist."), False)
+        returnData(0)
+        return
+    if test:
+        preview = "".join(_("Username") + " - " + user + " : " + _("Password - ") + password + "\n" for user, password in users)
+        if skipped:
+            preview = preview + "\n" + _("Already exist, will be skipped") + " - " + ", ".join(skipped) + "\n"
+        whiptailTextBox(_("About to import (Use arrow keys to scroll)"), preview)
+        if not whiptailBox("yesno", _("Import"), _("Import") + " " + str(len(users)) + " " + _("users?"), True):
+            returnData(1)
+            return
+
+    print(_("Encrypting passwords for") + " " + str(len(users)) + " " + _("users"))
+    passwordHashes = hashPasswords([password for user, password in users])
+    print(_("Adding users"))
+    homes = []
+    with userDatabase() as database:
+        for (user, password), passwordHash in zip(users, passwordHashes):
+            if database.get("passwd", user) is not None:
+                continue
+            uid, gid = database.addUser(user, passwordHash)
+            homes.append([user, uid, gid, "/home/" + user])
+        reconcileGroups(database, [home[0] for home in homes])
+        saveImportJournal(homes) #Saved before the databases are written, loadImportJournal() skips any users which never made it in
+    print(_("Creating home folders"))
+    failed = createHomeFolders(homes)
+    saveImportJournal([home for home in homes if home[0] in failed])
+    if failed:
+        whiptailBox("msgbox", _("Complete"), _("Importing of CSV data has been completed, but home folders could not be created for") + " " + ", ".join(failed), False, "12")
+    else:
+        whiptailBox("msgbox", _("Complete"), _("Importing of CSV data has been complete."), False)
+    returnData(0)
+
+def reconcileGroups(database, users = None):
+    """
+    Works out the group changes PiNet needs and applies them to a userDatabase.
+    Makes sure the system groups exist, the fixed groups (pupil and teacher) have their fixed gids (members are kept),
+    and every normal user (or just those listed in users) is in all of PupilGroups.
+    Returns (changes, gidsMoved), changes being a list of descriptions of what was changed.
+    """
+    changes = []
+    gidsMoved = False
+    teachers = database.get("group", "teachers")
+    if teachers is not None:
+        primaryUsers = [user for user in database.names("passwd") if database.get("passwd", user)[3] == teachers[2]]
+        if primaryUsers: #Removing it would leave these users with a primary group that doesn't exist
+            message = _("Kept old group") + " teachers, " + _("it is the primary group of") + " " + ", ".join(primaryUsers)
+            warning(message)
+            changes.append(message)
+        else:
+            database.removeEntry("group", "teachers")
+            database.removeEntry("gshadow", "teachers")
+            changes.append(_("Removed old group") + " teachers")
+    for name, gid in FixedGroups:
+        fields = database.get("group", name)
+        if fields is not None and fields[2] == str(gid):
+            continue
+        if database.idUsed("group", gid):
+            changes.append(_("Unable to give group") + " " + name + " " + _("gid") + " " + str(gid) + ", " + _("it is already in use"))
+        elif fields is None:
+            database.addGroup(name, gid)
+            changes.append(_("Added group") + " " + name + " (" + str(gid) + ")")
+        else:
+            oldGid = fields[2]
+            database.setEntry("group", fields[0:2] + [str(gid)] + fields[3:])
+            for user in database.names("passwd"):
+                userFields = database.get("passwd", user)
+                if userFields[3] == oldGid:
+                    database.setEntry("passwd", userFields[0:3] + [str(gid)] + userFields[4:])
+            changes.append(_("Moved group") + " " + name + " " + _("from gid") + " " + oldGid + " " + _("to") + " " + str(gid))
+            gidsMoved = True
+    for name in SystemGroups:
+        if database.get("group", name) is None:
+            changes.append(_("Added group") + " " + name + " (" + str(database.addGroup(name, database.nextFreeID("group", 100, 999))) + ")")
+    if users is None:
+        users = [user for user in database.names("passwd") if database.get("passwd", user)[2].isdigit() and 1000 <= int(database.get("passwd", user)[2]) <= 9999]
+    added = {}
+    for user in users:
+        for group in PupilGroups:
+            if database.addToGroup(user, group):
+                added.setdefault(group, []).append(user)
+    for group in PupilGroups:
+        if group in added:
+            changes.append(_("Added") + " " + str(len(added[group])) + " " + _("users to group") + " " + group + " - " + ", ".join(added[group]))
+    return changes, gidsMoved
+
+def fixGroups(users = None):
+    """
+    Checks the PiNet groups and group memberships, changing only what differs with a single write of each database.
+    Prints what was changed and returns 1 through returnData if a gid was moved (so a restart is needed), otherwise 0.
+    """
+    with userDatabase() as database:
+        changes, gidsMoved = reconcileGroups(database, users)
+    if changes:
+        for change in changes:
+            print(change)
+    else:
+        print(_("All groups are correct, nothing to change"))
+    if gidsMoved:
+        returnData(1)
+    else:
+        returnData(0)
 
 def fixGroupSingle(username):
-    groups = ["adm", "dialout", "cdrom", "audio", "users", "video", "games", "plugdev", "input", "pupil"]
-    for x in range(0, len(groups)):
-        cmd = ["usermod", "-a", "-G", groups[x], username]
-        p = Popen(cmd,  stderr=PIPE)
-        out, err = p.communicate()
+    fixGroups([username])
 
-def checkIfFileContains(file, string):
+def getPupils(groupFile = "/etc/group", passwdFile = "/etc/passwd"):
     """
-    Simple function to check if a string exists in a file.
+    Returns an OrderedDict of username to home folder for every pupil, a user with a 4 digit uid in the pupil group (as a member or as their primary group).
+    The group and passwd files are each read once.
+    """
+    from collections import OrderedDict
+    groups = readColonDatabase(groupFile) or {}
+    users = readColonDatabase(passwdFile) or {}
+    pupils = OrderedDict()
+    pupilGroup = groups.get("pupil")
+    if pupilGroup is None or len(pupilGroup) < 4:
+        return pupils
+    members = set(member for member in pupilGroup[3].split(",") if member)
+    for name, fields in users.items():
+        if len(fields) >= 6 and len(fields[2]) == 4 and fields[2].isdigit() and (name in members or fields[3] == pupilGroup[2]):
+            pupils[name] = fields[5]
+    return pupils
+
+def openOwnedFolder(base, path, uid, gid):
+    """
+    Opens the folder path (relative to base), creating it and any missing parents owned by uid and gid, and returns its file descriptor.
+    Each folder is opened relative to the one before it with O_NOFOLLOW, so a symlink anywhere below base raises OSError instead of being followed,
+    even if it is swapped in while this runs.
+    """
+    fd = os.open(base, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for part in [part for part in path.split("/") if part]:
+            created = False
+            try:
+                os.mkdir(part, dir_fd=fd)
+                created = True
+            except FileExistsError:
+                pass
+            partFd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            os.close(fd)
+            fd = partFd
+            if created:
+                os.fchown(fd, uid, gid)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+def writeOwnedFile(folderFd, name, chunks, uid, gid, times = None, mode = None):
+    """
+    Writes chunks to name in the folder open as folderFd via a temporary file and rename, owned by uid and gid, with times (access and modification, in ns) and permissions (mode) if given.
+    A symlink already at name is replaced rather than followed. Returns the sha256 of the contents.
+    """
+    import hashlib, binascii
+    tempName = "." + name + "." + binascii.hexlify(os.urandom(6)).decode("ascii")
+    fd = os.open(tempName, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o666, dir_fd=folderFd)
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, "wb") as output:
+            for chunk in chunks:
+                output.write(chunk)
+                digest.update(chunk)
+            output.flush()
+            os.fchown(output.fileno(), uid, gid)
+            if mode is not None:
+                os.fchmod(output.fileno(), mode)
+            os.fsync(output.fileno())
+            if times is not None:
+                os.utime(output.fileno(), ns=times)
+        os.replace(tempName, name, src_dir_fd=folderFd, dst_dir_fd=folderFd)
+    except BaseException:
+        try:
+            os.unlink(tempName, dir_fd=folderFd)
+        except OSError:
+            pass
+        raise
+    return digest.hexdigest()
+
+def openBelow(base, path):
+    """
+    Opens the file path (relative to base) for reading and returns its file descriptor.
+    Each folder is opened relative to the one before it with O_NOFOLLOW, so a symlink anywhere below base raises OSError instead of being followed,
+    even if it is swapped in while this runs. The file is opened with O_NONBLOCK so a fifo can't hang the caller.
+    """
+    parts = [part for part in path.split("/") if part]
+    fd = os.open(base, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for part in parts[:-1]:
+            partFd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            os.close(fd)
+            fd = partFd
+        return os.open(parts[-1], os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+def copyCollectedFile(sourceBase, source, base, target, uid, gid):
+    """
+    Copies a pupil's file source (relative to sourceBase) to target (relative to base) via a temporary file and rename, owned by uid and gid and keeping its modification time.
+    Neither side is followed through symlinks (see openBelow() and openOwnedFolder()), even ones swapped in after collectWork() looked,
+    so a pupil can't hand in a file they can't read and a symlink planted in the submitted folder can't send the copy elsewhere. Returns the sha256 of the contents.
+    """
+    import stat
+    with os.fdopen(openBelow(sourceBase, source), "rb") as original:
+        info = os.fstat(original.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            raise IOError(_("Not a file") + " - " + os.path.join(sourceBase, source))
+        folderFd = openOwnedFolder(base, os.path.dirname(target), uid, gid)
+        try:
+            return writeOwnedFile(folderFd, os.path.basename(target), iter(lambda: original.read(1048576), b""), uid, gid, (info.st_atime_ns, info.st_mtime_ns))
+        finally:
+            os.close(folderFd)
+
+def loadCollectManifest(folderFd, name):
+    import json
+    try:
+        with os.fdopen(os.open(name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=folderFd), "rb") as manifestFile:
+            return json.loads(manifestFile.read().decode("utf-8"))
+    except (OSError, IOError, ValueError):
+        return {"files": {}}
+
+def parseDateTime(text):
+    """
+    Returns the time (in seconds since the epoch) for a local date and time written like "2016-03-25 15:30", or the end of the day for just a date like "2016-03-25".
+    Raises ValueError for anything else.
+    """
+    for dateFormat in ["%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            parsed = time.mktime(time.strptime(text.strip(), dateFormat))
+        except ValueError:
+            continue
+        if dateFormat == "%Y-%m-%d":
+            parsed = parsed + 86400 #The whole day
+        return parsed
+    raise ValueError("Unrecognised date " + text)
+
+def collectWork(teacher, deadline = "", hashCheck = False, workers = 8):
+    """
+    Collects pupils' work from their handin folders into the submitted folder of teacher, one folder per pupil.
+    Only files which are new or changed (by size and modification time, or also by sha256 if hashCheck is True) are copied, in parallel, owned by the teacher as they go.
+    Each pupil gets a manifest in submitted/.manifests of what was collected and when, with files changed after deadline ("YYYY-MM-DD HH:MM" or "YYYY-MM-DD") marked late.
+    Files pupils have since removed are kept, but marked as removed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import json, stat
+    try:
+        teacherInfo = pwd.getpwnam(teacher)
+    except KeyError:
+        whiptailBox("msgbox", _("ERROR"), _("The user") + " " + teacher + " " + _("was not found!"), False)
+        returnData(1)
+        return
+    deadlineTime = None
+    if deadline:
+        try:
+            deadlineTime = parseDateTime(deadline)
+        except ValueError:
+            whiptailBox("msgbox", _("ERROR"), _("The deadline must be written like 2016-03-25 or 2016-03-25 15:30"), False)
+            returnData(1)
+            return
+    uid, gid = teacherInfo.pw_uid, teacherInfo.pw_gid
+    submitted = os.path.join(teacherInfo.pw_dir, "submitted")
+    try:
+        manifestFolder = openOwnedFolder(teacherInfo.pw_dir, "submitted/.manifests", uid, gid)
+    except OSError as e:
+        whiptailBox("msgbox", _("ERROR"), _("Unable to use") + " " + submitted + " - " + str(e), False)
+        returnData(1)
+        return
+    now = time.time()
+    manifests = {}
+    copies = []
+    pupils = getPupils()
+    for pupil, home in pupils.items():
+        handin = os.path.join(home, "handin")
+        if os.path.islink(handin) or not os.path.isdir(handin):
+            continue
+        manifest = loadCollectManifest(manifestFolder, pupil + ".json")
+        manifests[pupil] = manifest
+        seen = set()
+        for folder, dirs, files, folderFd in os.fwalk(handin): #Walks by file descriptor, so a folder swapped for a symlink isn't followed
+            for name in files:
+                source = os.path.join(folder, name)
+                relativePath = os.path.relpath(source, handin)
+                try:
+                    info = os.stat(name, dir_fd=folderFd, follow_symlinks=False)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(info.st_mode):
+                    continue
+                seen.add(relativePath)
+                old = manifest["files"].get(relativePath)
+                target = os.path.join(submitted, pupil, relativePath)
+                if old is not None and old["size"] == info.st_size and old["mtime"] == info.st_mtime_ns and os.path.isfile(target) and not os.path.islink(target):
+                    try:
+                        unchanged = not hashCheck or hashFile(name, folderFd) == old["sha256"]
+                    except (OSError, IOError): #Copying it will report the problem
+                        unchanged = False
+                    if unchanged:
+                        continue
+                copies.append((pupil, relativePath, source, target, info))
+        for relativePath, entry in manifest["files"].items():
+            entry["removed"] = not relativePath in seen
+    print(_("Pupils with a handin folder") + " - " + str(len(manifests)) + ", " + _("files to collect") + " - " + str(len(copies)))
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for copy in copies:
+            futures[pool.submit(copyCollectedFile, pupils[copy[0]], os.path.join("handin", copy[1]), submitted, os.path.join(copy[0], copy[1]), uid, gid)] = copy
+        for future in as_completed(futures):
+            pupil, relativePath, source, target, info = futures[future]
+            try:
+                digest = future.result()
+            except (OSError, IOError) as e:
+                failed.append(pupil + "/" + relativePath)
+                warning("Unable to collect " + source + " - " + str(e))
+                continue
+            manifests[pupil]["files"][relativePath] = {"size": info.st_size, "mtime": info.st_mtime_ns, "sha256": digest, "collected": now, "removed": False}
+    summary = []
+    lateTotal = 0
+    for pupil, manifest in manifests.items():
+        if deadlineTime is not None:
+            manifest["deadline"] = deadline
+            for entry in manifest["files"].values():
+                entry["late"] = entry["mtime"] / 1e9 > deadlineTime
+        manifest["lastCollected"] = now
+        late = sorted(path for path, entry in manifest["files"].items() if entry.get("late") and not entry["removed"])
+        lateTotal = lateTotal + len(late)
+        collected = len([copy for copy in copies if copy[0] == pupil])
+        line = pupil + " - " + str(len(manifest["files"])) + " " + _("files") + ", " + str(collected) + " " + _("new or changed")
+        if late:
+            line = line + ", " + _("late") + ": " + ", ".join(late)
+        summary.append(line)
+        writeOwnedFile(manifestFolder, pupil + ".json", [json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8")], uid, gid)
+    os.close(manifestFolder)
+    text = _("Students work has been collected and can be found in") + " " + submitted + "\n" + str(len(copies) - len(failed)) + " " + _("files copied") + ", " + str(lateTotal) + " " + _("late") + "\n"
+    if failed:
+        text = text + _("Unable to collect") + ": " + ", ".join(sorted(failed)) + "\n"
+    whiptailTextBox(_("Complete"), text + "\n" + "\n".join(summary))
+    returnData(0)
+
+def getHomeUsers(passwdFile = "/etc/passwd"):
+    """
+    Returns a list of (username, uid, gid, home folder) for every user with a 4 digit uid and an existing home folder, from a single read of passwd.
+    """
+    users = []
+    for name, fields in (readColonDatabase(passwdFile) or {}).items():
+        if len(fields) >= 6 and len(fields[2]) == 4 and fields[2].isdigit() and os.path.isdir(fields[5]):
+            users.append((name, int(fields[2]), int(fields[3]), fields[5]))
+    return users
+
+def removeBelow(folderFd, name):
+    """
+    Removes name (a file, link or whole folder) from the folder open as folderFd. Nothing inside is followed through a symlink.
+    """
+    import stat
+    if not stat.S_ISDIR(os.stat(name, dir_fd=folderFd, follow_symlinks=False).st_mode):
+        os.unlink(name, dir_fd=folderFd)
+        return
+    fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=folderFd)
+    try:
+        for child in os.listdir(fd):
+            removeBelow(fd, child)
+    finally:
+        os.close(fd)
+    os.rmdir(name, dir_fd=folderFd)
+
+def distributeFile(source, folderFd, name, info, uid, gid, link = False):
+    """
+    Puts source at name in the folder open as folderFd (through a temporary file and rename) owned by uid and gid, with the same permissions and modification time.
+    With link as True it is hard linked instead, so every user shares one read only copy. Otherwise a reflink (copy on write clone) is tried before copying the data.
+    """
+    import fcntl, stat, binascii
+    tempName = "." + name + "." + binascii.hexlify(os.urandom(6)).decode("ascii")
+    if link:
+        try:
+            os.link(source, tempName, dst_dir_fd=folderFd)
+            os.replace(tempName, name, src_dir_fd=folderFd, dst_dir_fd=folderFd)
+            return
+        except OSError: #Different filesystem, copy instead
+            try:
+                os.unlink(tempName, dir_fd=folderFd)
+            except OSError:
+                pass
+    fd = os.open(tempName, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600, dir_fd=folderFd)
+    try:
+        with os.fdopen(fd, "wb") as copy:
+            with open(source, "rb") as original:
+                try:
+                    fcntl.ioctl(copy.fileno(), 0x40049409, original.fileno()) #FICLONE
+                except (OSError, IOError):
+                    shutil.copyfileobj(original, copy, 1048576)
+            copy.flush()
+            os.fchown(copy.fileno(), uid, gid)
+            os.fchmod(copy.fileno(), stat.S_IMODE(info.st_mode))
+            os.utime(copy.fileno(), ns=(info.st_atime_ns, info.st_mtime_ns))
+        os.replace(tempName, name, src_dir_fd=folderFd, dst_dir_fd=folderFd)
+    except BaseException:
+        try:
+            os.unlink(tempName, dir_fd=folderFd)
+        except OSError:
+            pass
+        raise
+
+def distributedCopyMatches(info, folderFd, name, uid, link):
+    """
+    Checks if name in the folder open as folderFd is already an up to date copy of the source (info is its lstat), going by size, modification time, permissions and owner, or by being the same file if hard linked.
+    """
+    try:
+        current = os.stat(name, dir_fd=folderFd, follow_symlinks=False)
+    except OSError:
+        return False
+    if link and current.st_ino == info.st_ino and current.st_dev == info.st_dev:
+        return True
+    return current.st_mode == info.st_mode and current.st_size == info.st_size and current.st_mtime_ns == info.st_mtime_ns and current.st_uid == uid
+
+def distributeFolder(source, folderFd, name, uid, gid, replace, link):
+    """
+    Brings the folder name (in the folder open as folderFd) up to date with the folder source, descending through folder descriptors.
+    Returns the number of files and folders written or removed.
+    """
+    import stat
+    changed = 0
+    try:
+        current = os.stat(name, dir_fd=folderFd, follow_symlinks=False)
+    except FileNotFoundError:
+        current = None
+    if current is not None and not stat.S_ISDIR(current.st_mode): #Including a symlink the user has made
+        removeBelow(folderFd, name)
+        current = None
+    if current is None:
+        os.mkdir(name, 0o700, dir_fd=folderFd)
+        changed = changed + 1
+    fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=folderFd)
+    try:
+        if current is None:
+            os.fchown(fd, uid, gid)
+            os.fchmod(fd, stat.S_IMODE(os.stat(source).st_mode))
+        names = os.listdir(source)
+        for child in names:
+            sourceFile = os.path.join(source, child)
+            info = os.lstat(sourceFile)
+            if stat.S_ISDIR(info.st_mode):
+                changed = changed + distributeFolder(sourceFile, fd, child, uid, gid, replace, link)
+                continue
+            try:
+                existing = os.stat(child, dir_fd=fd, follow_symlinks=False)
+            except FileNotFoundError:
+                existing = None
+            if stat.S_ISLNK(info.st_mode):
+                if existing is not None and stat.S_ISLNK(existing.st_mode) and os.readlink(child, dir_fd=fd) == os.readlink(sourceFile):
+                    continue
+                if existing is not None:
+                    removeBelow(fd, child)
+                os.symlink(os.readlink(sourceFile), child, dir_fd=fd)
+                os.chown(child, uid, gid, dir_fd=fd, follow_symlinks=False)
+            elif stat.S_ISREG(info.st_mode):
+                if distributedCopyMatches(info, fd, child, uid, link):
+                    continue
+                if existing is not None and stat.S_ISDIR(existing.st_mode):
+                    removeBelow(fd, child)
+                distributeFile(sourceFile, fd, child, info, uid, gid, link)
+            else:
+                continue
+            changed = changed + 1
+        if replace:
+            for child in os.listdir(fd):
+                if not child in names:
+                    removeBelow(fd, child)
+                    changed = changed + 1
+    finally:
+        os.close(fd)
+    return changed
+
+def distributeToUser(source, home, target, uid, gid, replace = True, link = False, missingOnly = False):
+    """
+    Brings home/target up to date with source (a file or folder) for one user. Returns the number of files and folders written or removed.
+    The target is only ever reached through folder descriptors opened with O_NOFOLLOW (see openOwnedFolder()),
+    so nothing is written, changed or removed through a symlink the user has made, even one swapped in while this runs.
+    """
+    import stat
+    parts = [part for part in target.split("/") if part]
+    try:
+        folderFd = openOwnedFolder(home, "/".join(parts[0:-1]), uid, gid) #Folders leading to the target
+    except OSError as e:
+        warning("Not distributing to " + os.path.join(home, *parts[0:-1]) + " - " + str(e))
+        return 0
+    name = parts[-1]
+    try:
+        try:
+            current = os.stat(name, dir_fd=folderFd, follow_symlinks=False)
+        except FileNotFoundError:
+            current = None
+        if missingOnly and current is not None:
+            return 0
+        if os.path.isdir(source):
+            if current is not None and not stat.S_ISDIR(current.st_mode) and not replace:
+                return 0
+            return distributeFolder(source, folderFd, name, uid, gid, replace, link)
+        info = os.lstat(source)
+        if distributedCopyMatches(info, folderFd, name, uid, link):
+            return 0
+        if current is not None and stat.S_ISDIR(current.st_mode):
+            removeBelow(folderFd, name)
+        distributeFile(source, folderFd, name, info, uid, gid, link)
+        return 1
+    finally:
+        os.close(folderFd)
+
+def distributeToUsers(source, target, options = (), workers = 8):
+    """
+    Copies a file or folder (source) to target, a path relative to the home folder of every user, in parallel and owned by each user.
+    Users whose copy already matches are skipped. Options are:
+      skel    - also copy it to /etc/skel for new users
+      merge   - leave other files already in the target folder alone, rather than making it an exact copy
+      link    - hard link the files rather than copying them (read only content shared between users, like python_games), falling back to a copy
+      missing - only add it for users who don't have it yet
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    if not os.path.exists(source):
+        print(_("Unable to find") + " " + source)
+        returnData(0)
+        return
+    replace = not "merge" in options
+    link = "link" in options
+    missingOnly = "missing" in options
+    users = getHomeUsers()
+    if "skel" in options:
+        users.append(("skel", 0, 0, "/etc/skel"))
+    updated = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for user, uid, gid, home in users:
+            futures[pool.submit(distributeToUser, source, home, target, uid, gid, replace, link, missingOnly)] = user
+        for future in as_completed(futures):
+            try:
+                if future.result() > 0:
+                    updated.append(futures[future])
+            except (OSError, IOError, shutil.Error) as e:
+                failed.append(futures[future])
+                warning("Unable to copy " + source + " to " + futures[future] + " - " + str(e))
+    print(target + " - " + str(len(updated)) + " " + _("updated") + ", " + str(len(users) - len(updated) - len(failed)) + " " + _("already up to date"))
+    if failed:
+        print(_("Unable to copy to") + " " + ", ".join(sorted(failed)))
+    returnData(len(updated))
+
+def loadSharedFolders():
+    """
+    Returns the shared folder registry (see SharedFolderRegistry), a list of {"name", "path", "access"} where access is "write" if pupils can write to it, otherwise "read".
+    The first time, the registry is built from the mounts in the old generated /usr/local/bin/bindfs-mount script.
+    """
+    import json, re
+    try:
+        with open(SharedFolderRegistry) as registryFile:
+            return json.load(registryFile)
+    except (OSError, IOError, ValueError):
+        pass
+    folders = []
+    if os.path.exists(SharedFolderScript):
+        for line in iterTextFile(SharedFolderScript):
+            match = re.match(r"^\s*bindfs -o \S*force-group=(\w+)\S* (\S+) (\S+)\s*$", line)
+            if match and match.group(2).startswith(SharedFolderBase + "/"):
+                folders.append({"name": os.path.basename(match.group(2)), "path": match.group(2), "access": "write" if match.group(1) == "pupil" else "read"})
+    return folders
+
+def saveSharedFolders(folders):
+    import json
+    makeFolder(os.path.dirname(SharedFolderRegistry))
+    writeFileAtomic(SharedFolderRegistry, json.dumps(sorted(folders, key=lambda folder: folder["name"]), indent=1))
+
+def sharedFolderOptions(folder):
+    return "perms=0775,force-group=" + ("pupil" if folder["access"] == "write" else "teacher")
+
+def readMountInfo(mountInfo = "/proc/self/mountinfo"):
+    """
+    Returns a dictionary of mount point to filesystem type for everything currently mounted.
+    """
+    import re
+    mounts = {}
+    for line in iterTextFile(mountInfo):
+        fields = line.split(" ")
+        if len(fields) < 10 or not " - " in line:
+            continue
+        mountPoint = re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), fields[4]) if "\\" in fields[4] else fields[4]
+        mounts[mountPoint] = line.split(" - ", 1)[1].split(" ")[0]
+    return mounts
+
+def writeSharedFolderScript(folders):
+    """
+    Regenerates /usr/local/bin/bindfs-mount (run by the bindfs-mount service at boot) from the registry, only writing it if it changed.
+    """
+    lines = ["bindfs -o " + sharedFolderOptions(folder) + " " + folder["path"] + " " + folder["path"] for folder in folders]
+    text = "\n".join(lines) + "\n" if lines else ""
+    try:
+        with open(SharedFolderScript) as scriptFile:
+            if scriptFile.read() == text:
+                return
+    except (OSError, IOError):
+        pass
+    writeFileAtomic(SharedFolderScript, text)
+
+def reconcileSharedFolders(mountInfo = "/proc/self/mountinfo"):
+    """
+    Makes the bindfs mounts match the shared folder registry, comparing it with what /proc/self/mountinfo shows is mounted.
+    Only shares which are missing, changed or removed are mounted or unmounted, everything else is left alone so open files on the Raspberry Pis aren't interrupted.
+    FUSE doesn't show the bindfs options in mountinfo, so the options each share was mounted with are remembered in SharedFolderMountState (cleared by a reboot along with the mounts).
+    Returns the number of mounts changed through returnData.
+    """
+    import json
+    folders = loadSharedFolders()
+    if not os.path.exists(SharedFolderRegistry):
+        saveSharedFolders(folders)
+    writeSharedFolderScript(folders)
+    try:
+        with open(SharedFolderMountState) as stateFile:
+            mounted = json.load(stateFile)
+    except (OSError, IOError, ValueError):
+        mounted = {}
+    mounts = readMountInfo(mountInfo)
+    wanted = dict((folder["path"], sharedFolderOptions(folder)) for folder in folders)
+    changed = 0
+    for path in sorted(mounts):
+        if os.path.dirname(path) == SharedFolderBase and mounts[path].startswith("fuse") and wanted.get(path) != mounted.get(path):
+            runBash(["umount", "-l", path])
+            mounted.pop(path, None)
+            changed = changed + 1
+            if not path in wanted:
+                print(_("Unmounted") + " " + path)
+    for path, options in sorted(wanted.items()):
+        if path in mounts and mounts[path].startswith("fuse") and mounted.get(path) == options:
+            continue
+        if not os.path.isdir(path):
+            warning("Shared folder " + path + " is missing, not mounting it")
+            continue
+        if runBash(["bindfs", "-o", options, path, path]) == 0:
+            mounted[path] = options
+            changed = changed + 1
+            print(_("Mounted") + " " + path)
+        else:
+            warning("Unable to mount shared folder " + path)
+    makeFolder(os.path.dirname(SharedFolderMountState))
+    writeFileAtomic(SharedFolderMountState, json.dumps(mounted))
+    returnData(changed)
+    return changed
+
+def updateSharedBookmarks():
+    """
+    Writes the file manager bookmarks for the shared folders to /etc/skel/.gtk-bookmarks (only if they changed), then copies it to the users whose copy differs.
+    """
+    text = "".join("file://" + folder["path"] + " " + folder["name"] + "\n" for folder in loadSharedFolders())
+    skelBookmarks = "/etc/skel/.gtk-bookmarks"
+    try:
+        with open(skelBookmarks) as bookmarksFile:
+            current = bookmarksFile.read()
+    except (OSError, IOError):
+        current = None
+    if current != text:
+        writeFileAtomic(skelBookmarks, text)
+    distributeToUsers(skelBookmarks, ".gtk-bookmarks")
+
+def addSharedFolder(name, access = "read"):
+    """
+    Adds a new shared folder to the registry, then mounts it and updates the bookmarks.
+    """
+    setSharedFolderAccess(name, access)
+    updateSharedBookmarks()
+
+def setSharedFolderAccess(name, access):
+    """
+    Changes whether pupils can write to a shared folder, adding it to the registry if it isn't there yet. Only that folder is remounted.
+    """
+    folders = [folder for folder in loadSharedFolders() if folder["name"] != name]
+    folders.append({"name": name, "path": os.path.join(SharedFolderBase, name), "access": access})
+    saveSharedFolders(folders)
+    reconcileSharedFolders()
+
+def removeSharedFolder(name):
+    """
+    Removes a shared folder from the registry, unmounting it and removing its bookmark. The folder itself is left for pinet to delete.
+    """
+    saveSharedFolders([folder for folder in loadSharedFolders() if folder["name"] != name])
+    reconcileSharedFolders()
+    updateSharedBookmarks()
+
+def checkSharedFolders():
+    """
+    Returns (through returnData) the space separated names of the folders in /home/shared which aren't in the shared folder registry, for pinet to ask about.
+    Registry entries whose folder is gone are dropped.
+    """
+    folders = loadSharedFolders()
+    existing = [folder for folder in folders if os.path.isdir(folder["path"])]
+    if existing != folders or not os.path.exists(SharedFolderRegistry):
+        saveSharedFolders(existing)
+    known = set(folder["name"] for folder in existing)
+    unknown = [name for name in sorted(os.listdir(SharedFolderBase)) if os.path.isdir(os.path.join(SharedFolderBase, name)) and not name in known] if os.path.isdir(SharedFolderBase) else []
+    returnData(" ".join(unknown))
+
+def backupAnchorTables():
+    """
+    Returns the BackupAnchorBytes translation tables used to find candidate chunk ends in nextChunkEnd(), one for each byte of the window.
+    They are derived from SHA-256, so they are the same on every server and Python version (changing them would stop old chunks being reused).
+    The last table is adjusted so a run of one repeated byte is never a candidate, otherwise a file of zeros would be checked at every byte.
+    """
+    import hashlib
+    if not BackupAnchorTables:
+        tables = [bytearray(hashlib.sha256(bytes([index, byte])).digest()[0] for byte in range(256)) for index in range(BackupAnchorBytes)]
+        for byte in range(256):
+            combined = 0
+            for table in tables:
+                combined = combined ^ table[byte]
+            if combined == 0:
+                tables[-1][byte] = tables[-1][byte] ^ 1
+        BackupAnchorTables.extend(bytes(table) for table in tables)
+    return BackupAnchorTables
+
+def nextChunkEnd(data, start, end):
+    """
+    Returns where the chunk of data starting at start should end, looking at the bytes after BackupMinChunk.
+    A position is a candidate if the XOR of its last BackupAnchorBytes bytes, each put through its own table, is 0. Candidates are found for a
+    whole BackupScanSize block at a time using bytes.translate() and big integer shifts rather than a byte at a time in Python.
+    A candidate is a chunk end if the crc32 of its last BackupChunkWindow bytes passes BackupChunkMask.
+    Chunk ends depend only on the data around them, so an insertion near the start of a file only changes the chunks around it.
+    """
+    import zlib
+    if end - start <= BackupMinChunk:
+        return end
+    limit = start + min(end - start, BackupMaxChunk)
+    tables = backupAnchorTables()
+    position = start + BackupMinChunk
+    while position < limit:
+        block = data[position - BackupChunkWindow + 1:min(position + BackupScanSize, limit)]
+        anchors = 0
+        for age, table in enumerate(tables): #Byte i of anchors ends up as the XOR of table[age][block[i - age]] for every age
+            anchors = anchors ^ (int.from_bytes(block.translate(table), "little") << (8 * age))
+        anchors = anchors.to_bytes(len(block) + len(tables), "little")
+        candidate = anchors.find(b"\0", BackupChunkWindow - 1, len(block))
+        while candidate != -1:
+            if not zlib.crc32(block[candidate - BackupChunkWindow + 1:candidate + 1]) & BackupChunkMask:
+                return position - BackupChunkWindow + candidate + 2
+            candidate = anchors.find(b"\0", candidate + 1, len(block))
+        position = position + len(block) - BackupChunkWindow + 1
+    return limit
+
+def iterFileChunks(path):
+    """
+    Yields the content defined chunks of a file as bytes.
+    """
+    with open(path, "rb", buffering=0) as file:
+        data = b""
+        finished = False
+        while True:
+            if not finished and len(data) <= BackupMaxChunk: #Always more than a whole chunk buffered, unless at the end of the file
+                more = file.read(BackupMaxChunk * 2)
+                if more:
+                    data = data + more
+                    continue
+                finished = True
+            if not data:
+                return
+            end = nextChunkEnd(data, 0, len(data))
+            yield data[0:end]
+            data = data[end:]
+
+class backupPack():
+    """
+    A pack file in a backup repository which chunks are appended to, each compressed with zlib (stored as is if that doesn't make it smaller) and prefixed with z or r.
+    entries holds the hash, offset, stored length and original length of each chunk added, which are written to the .idx file next to it by writeIndex().
+    """
+
+    def __init__(self, repo):
+        super(backupPack, self).__init__()
+        import binascii
+        self.name = binascii.hexlify(os.urandom(8)).decode()
+        self.path = os.path.join(repo, "packs", self.name + ".pack")
+        self.file = open(self.path, "wb", buffering=0)
+        self.size = 0
+        self.entries = {}
+
+    def add(self, digest, data, compress = True):
+        import zlib
+        stored = zlib.compress(data, 6) if compress else b""
+        stored = b"z" + stored if compress and len(stored) < len(data) else b"r" + data
+        self.file.write(stored)
+        entry = [self.name, self.size, len(stored), len(data)]
+        self.entries[digest] = entry
+        self.size = self.size + len(stored)
+        return entry
+
+    def writeIndex(self):
+        import json
+        os.fsync(self.file.fileno())
+        self.file.close()
+        writeFileAtomic(self.path[0:-len(".pack")] + ".idx", json.dumps(dict((digest, entry[1:]) for digest, entry in self.entries.items()), separators=(",", ":")))
+
+def startBackupWorker(repo, known):
+    BackupWorker.update({"repo": repo, "known": known, "pack": None})
+
+def backupChunkFile(path):
+    """
+    Runs in a backup worker process (see backupHomes()). Splits a file into chunks, adding any chunk the repository doesn't already have to this worker's pack file.
+    Returns the path, the list of chunk hashes (or None if the file couldn't be read), the new chunks as [hash, pack, offset, length, original length] and any error.
+    """
+    import hashlib
+    hashes = []
+    added = []
+    try:
+        for data in iterFileChunks(path):
+            digest = hashlib.sha256(data).hexdigest()
+            hashes.append(digest)
+            if digest in BackupWorker["known"]:
+                continue
+            if BackupWorker["pack"] is None or BackupWorker["pack"].size >= BackupPackSize:
+                BackupWorker["pack"] = backupPack(BackupWorker["repo"])
+            added.append([digest] + BackupWorker["pack"].add(digest, data))
+            BackupWorker["known"].add(digest)
+    except (OSError, IOError) as e:
+        return path, None, added, str(e)
+    return path, hashes, added, None
+
+def loadBackupIndex(repo):
+    """
+    Reads the .idx file of every pack in a backup repository. Returns a dictionary of chunk hash to [pack, offset, length, original length],
+    the dictionary of pack name to its own index, and the set of packs without an index (left behind by a backup which didn't finish).
+    """
+    import json
+    index = {}
+    packs = {}
+    unfinished = set()
+    names = os.listdir(os.path.join(repo, "packs"))
+    for name in sorted(names):
+        pack, extension = os.path.splitext(name)
+        if extension == ".pack" and not pack + ".idx" in names:
+            unfinished.add(pack)
+        elif extension == ".idx":
+            try:
+                with open(os.path.join(repo, "packs", name)) as indexFile:
+                    packs[pack] = json.load(indexFile)
+            except (OSError, IOError, ValueError):
+                unfinished.add(pack)
+                continue
+            for digest, entry in packs[pack].items():
+                if not digest in index:
+                    index[digest] = [pack] + entry
+    return index, packs, unfinished
+
+def readBackupChunk(repo, entry):
+    """
+    Returns the original bytes of a chunk from its [pack, offset, length, original length] index entry.
     """
+    import zlib
+    with open(os.path.join(repo, "packs", entry[0] + ".pack"), "rb") as pack:
+        pack.seek(entry[1])
+        stored = pack.read(entry[2])
+    data = zlib.decompress(stored[1:]) if stored[0:1] == b"z" else stored[1:]
+    if len(data) != entry[3]:
+        raise IOError("Damaged chunk in pack " + entry[0] + " at " + str(entry[1]))
+    return data
+
+def listSnapshots(repo):
+    return sorted(name[0:-len(".json.gz")] for name in os.listdir(os.path.join(repo, "snapshots")) if name.endswith(".json.gz"))
+
+def openSnapshot(repo, name):
+    import gzip
+    return gzip.open(os.path.join(repo, "snapshots", name + ".json.gz"), "rt", encoding="utf-8", errors="surrogateescape")
+
+def readSnapshotHeader(repo, name):
+    """
+    Returns the header of a backup snapshot, a dictionary with its name, time, source folder and totals.
+    """
+    import json
+    with openSnapshot(repo, name) as snapshotFile:
+        return json.loads(snapshotFile.readline())
+
+def iterSnapshot(repo, name):
+    """
+    Yields the entries of a backup snapshot. Each entry is [path, kind, mode, uid, gid, mtime (ns), size, inode, data],
+    where kind is f (file, data is the list of chunk hashes), d (folder) or l (symlink, data is the link target).
+    """
+    import json
+    with openSnapshot(repo, name) as snapshotFile:
+        snapshotFile.readline()
+        for line in snapshotFile:
+            yield json.loads(line)
+
+def writeSnapshot(repo, name, header, entries):
+    import gzip, json
+    with atomicFile(os.path.join(repo, "snapshots", name + ".json.gz"), "wb") as snapshotFile:
+        with gzip.GzipFile(fileobj=snapshotFile.file, mode="wb") as compressed:
+            compressed.write((json.dumps(header) + "\n").encode())
+            for entry in entries:
+                compressed.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8", "surrogateescape"))
+
+def scanBackupSource(source, previous, index, exclude):
+    """
+    Walks the folder being backed up and returns the snapshot entries, with the chunk list filled in for every file unchanged since the previous snapshot
+    (same size, modification time and inode, with all its chunks still stored), and the list of files which need reading.
+    """
+    import stat
+    entries = []
+    changed = []
+    def addEntry(path):
+        info = os.lstat(path)
+        entry = [path, None, stat.S_IMODE(info.st_mode), info.st_uid, info.st_gid, info.st_mtime_ns, 0, info.st_ino, None]
+        if stat.S_ISDIR(info.st_mode):
+            entry[1] = "d"
+        elif stat.S_ISLNK(info.st_mode):
+            entry[1] = "l"
+            entry[8] = os.readlink(path)
+        elif stat.S_ISREG(info.st_mode):
+            entry[1] = "f"
+            entry[6] = info.st_size
+            old = previous.get(path)
+            if old is not None and old[1] == "f" and old[5:8] == entry[5:8] and all(digest in index for digest in old[8]):
+                entry[8] = old[8]
+            else:
+                changed.append(entry)
+        else:
+            return #Sockets, pipes and devices aren't backed up
+        entries.append(entry)
+    addEntry(source)
+    for folder, dirs, files in os.walk(source):
+        dirs[:] = sorted(name for name in dirs if not os.path.join(folder, name) in exclude)
+        for name in dirs + sorted(files):
+            try:
+                addEntry(os.path.join(folder, name))
+            except OSError:
+                pass #Removed while walking
+    return entries, changed
+
+def openBackupIndex(repo):
+    """
+    Opens (creating if needed) the SQLite index of a backup repository, which lets a restore find a file without reading every snapshot.
+    Each version of a path is stored once, visible in snapshots from added up to (but not including) removed.
+    The chunks table holds where each chunk is in the packs, so only the bytes wanted are read.
+    The snapshots and packs are the permanent record, the index can always be rebuilt from them (see updateBackupIndex()).
+    """
+    import sqlite3
+    db = sqlite3.connect(os.path.join(repo, BackupIndexName))
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, name TEXT UNIQUE, time REAL, source TEXT);
+        CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, path TEXT, kind TEXT, mode INTEGER, uid INTEGER, gid INTEGER, mtime INTEGER, size INTEGER, data TEXT, added INTEGER, removed INTEGER);
+        CREATE INDEX IF NOT EXISTS versionsPath ON versions (path, added);
+        CREATE INDEX IF NOT EXISTS versionsRemoved ON versions (removed);
+        CREATE TABLE IF NOT EXISTS packs (name TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS chunks (hash TEXT, pack TEXT, offset INTEGER, length INTEGER, size INTEGER);
+        CREATE INDEX IF NOT EXISTS chunksHash ON chunks (hash);
+        CREATE INDEX IF NOT EXISTS chunksPack ON chunks (pack);
+    """)
+    return db
+
+def indexSnapshot(db, repo, name):
+    """
+    Adds a snapshot to the backup index, comparing it with the versions visible in the last snapshot indexed so only changed paths get new rows.
+    """
+    header = readSnapshotHeader(repo, name)
+    snapshotId = db.execute("INSERT INTO snapshots (name, time, source) VALUES (?, ?, ?)", (name, header["time"], header["source"])).lastrowid
+    live = {}
+    for row in db.execute("SELECT id, path, kind, mode, uid, gid, mtime, size, data FROM versions WHERE removed IS NULL"):
+        live[row[1]] = (row[0], tuple(row[2:]))
+    added = []
+    for entry in iterSnapshot(repo, name):
+        data = " ".join(entry[8]) if entry[1] == "f" else entry[8]
+        version = (entry[1], entry[2], entry[3], entry[4], entry[5], entry[6], data)
+        current = live.pop(entry[0], None)
+        if current is not None and current[1] == version:
+            continue
+        if current is not None:
+            live[entry[0]] = current #Replaced, so ended below along with the removed paths
+        added.append((entry[0],) + version + (snapshotId,))
+    db.executemany("UPDATE versions SET removed = ? WHERE id = ?", [(snapshotId, current[0]) for current in live.values()])
+    db.executemany("INSERT INTO versions (path, kind, mode, uid, gid, mtime, size, data, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", added)
+
+def updateBackupIndex(repo):
+    """
+    Brings the SQLite index of a backup repository up to date with its snapshots and packs, then returns it.
+    New snapshots are added, expired ones dropped along with versions no remaining snapshot can see, and the chunk locations follow the packs.
+    If a snapshot older than the newest indexed one turns up, the index is rebuilt from scratch.
+    """
+    import json
+    db = openBackupIndex(repo)
+    with db:
+        names = listSnapshots(repo)
+        indexed = dict(db.execute("SELECT name, id FROM snapshots"))
+        new = [name for name in names if not name in indexed]
+        if new and indexed and new[0] < max(indexed):
+            db.execute("DELETE FROM versions")
+            db.execute("DELETE FROM snapshots")
+            indexed = {}
+            new = names
+        expired = [name for name in indexed if not name in names]
+        db.executemany("DELETE FROM snapshots WHERE name = ?", [(name,) for name in expired])
+        for name in new:
+            indexSnapshot(db, repo, name)
+        if expired:
+            db.execute("""DELETE FROM versions WHERE NOT EXISTS
+                          (SELECT 1 FROM snapshots WHERE snapshots.id >= versions.added AND (versions.removed IS NULL OR snapshots.id < versions.removed))""")
+        packs = set(name[0:-len(".idx")] for name in os.listdir(os.path.join(repo, "packs")) if name.endswith(".idx"))
+        indexedPacks = set(row[0] for row in db.execute("SELECT name FROM packs"))
+        for pack in indexedPacks - packs:
+            db.execute("DELETE FROM chunks WHERE pack = ?", (pack,))
+            db.execute("DELETE FROM packs WHERE name = ?", (pack,))
+        for pack in packs - indexedPacks:
+            with open(os.path.join(repo, "packs", pack + ".idx")) as indexFile:
+                packIndex = json.load(indexFile)
+            db.executemany("INSERT INTO chunks (hash, pack, offset, length, size) VALUES (?, ?, ?, ?, ?)", [(digest, pack) + tuple(entry) for digest, entry in packIndex.items()])
+            db.execute("INSERT INTO packs (name) VALUES (?)", (pack,))
+    return db
+
+def expireSnapshots(repo, location, keepDays):
+    """
+    Removes snapshots older than keepDays (except the newest one), along with any old style tar.gz backups in location. Returns the number of snapshots removed.
+    """
+    cutoff = time.time() - keepDays * 86400
+    removed = 0
+    for name in listSnapshots(repo)[0:-1]:
+        if readSnapshotHeader(repo, name)["time"] < cutoff:
+            removeFile(os.path.join(repo, "snapshots", name + ".json.gz"))
+            removed = removed + 1
+    for name in os.listdir(location):
+        if name.endswith("PiNet-Users-Backup.tar.gz") and os.stat(os.path.join(location, name)).st_ctime < cutoff:
+            removeFile(os.path.join(location, name))
+    return removed
+
+def collectBackupGarbage(repo, db):
+    """
+    Frees the space used by chunks no snapshot refers to any more, going by the versions left in the backup index (db, see updateBackupIndex()).
+    Packs with nothing left in use are deleted, packs less than half in use have their remaining chunks copied to a new pack first. Returns the number of bytes freed.
+    """
+    live = set()
+    for row in db.execute("SELECT data FROM versions WHERE kind = 'f'"):
+        live.update(row[0].split())
+    index, packs, unfinished = loadBackupIndex(repo)
+    freed = 0
+    newPack = None
+    claimed = set()
+    emptied = []
+    for pack in sorted(packs):
+        used = [digest for digest in packs[pack] if digest in live and not digest in claimed]
+        claimed.update(used)
+        total = sum(entry[1] for entry in packs[pack].values())
+        usedBytes = sum(packs[pack][digest][1] for digest in used)
+        if usedBytes * 2 >= total:
+            continue
+        for digest in used:
+            if newPack is None or newPack.size >= BackupPackSize:
+                if newPack is not None:
+                    newPack.writeIndex()
+                newPack = backupPack(repo)
+            newPack.add(digest, readBackupChunk(repo, [pack] + packs[pack][digest]))
+        emptied.append(pack)
+        freed = freed + total - usedBytes
+    if newPack is not None:
+        newPack.writeIndex() #Copies must be safely stored before the originals go
+    for pack in emptied:
+        removeFile(os.path.join(repo, "packs", pack + ".idx"))
+        removeFile(os.path.join(repo, "packs", pack + ".pack"))
+    for pack in unfinished:
+        packPath = os.path.join(repo, "packs", pack + ".pack")
+        if os.path.exists(packPath):
+            freed = freed + os.path.getsize(packPath)
+        removeFile(packPath)
+        removeFile(os.path.join(repo, "packs", pack + ".idx"))
+    return freed
+
+def backupHomes(source = "/home", location = None, keepDays = None):
+    """
+    Backs up source (normally /home) to the PiNet-Backups repository in location (backupLoc in /etc/pinet), as run by pinet-backup.sh.
+    Files are split into content defined chunks which are stored once each, compressed in parallel on every core, in pack files.
+    Each run records a snapshot listing every file and its chunks. Only files changed since the previous snapshot are read, so a backup takes time proportional to what changed.
+    Snapshots older than keepDays (DELETETIME in /etc/pinet) are removed and then chunks no longer used by any snapshot are deleted.
+    Prints a one line summary (or reason for failing) last, and returns True if the backup was made.
+    """
+    import fcntl
+    from multiprocessing import Pool
+    config = getConfig()
+    location = location or config.get("backupLoc", "")
+    keepDays = int(keepDays or config.get("DELETETIME", "9999") or 9999)
+    if location == "":
+        print(_("No backup location specified!"))
+        return False
+    if not os.path.isdir(location):
+        print(_("Backup folder unavailable!") + " " + location)
+        return False
+    repo = os.path.join(location, BackupRepositoryName)
+    makeFolder(os.path.join(repo, "packs"))
+    makeFolder(os.path.join(repo, "snapshots"))
+    lock = open(os.path.join(repo, "lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (OSError, IOError):
+        print(_("A backup is already running"))
+        return False
+    started = time.time()
+    index, packs, unfinished = loadBackupIndex(repo)
+    snapshots = listSnapshots(repo)
+    previous = {}
+    if snapshots:
+        for entry in iterSnapshot(repo, snapshots[-1]):
+            previous[entry[0]] = entry
+    entries, changed = scanBackupSource(os.path.abspath(source), previous, index, {os.path.realpath(location), repo})
+    previous = None
+    changedEntries = dict((entry[0], entry) for entry in changed)
+    newPacks = {}
+    newBytes = 0
+    failed = []
+    pool = Pool(initializer=startBackupWorker, initargs=(repo, set(index)))
+    try:
+        for path, hashes, added, error in pool.imap_unordered(backupChunkFile, sorted(changedEntries), chunksize=4):
+            for digest, pack, offset, length, originalLength in added:
+                newPacks.setdefault(pack, {})[digest] = [offset, length, originalLength]
+                newBytes = newBytes + length
+                if not digest in index:
+                    index[digest] = [pack, offset, length, originalLength]
+            if hashes is None:
+                failed.append(path)
+                warning("Unable to back up " + path + " - " + error)
+            else:
+                changedEntries[path][8] = hashes
+    finally:
+        pool.close()
+        pool.join()
+    import json
+    for pack, packIndex in newPacks.items():
+        packPath = os.path.join(repo, "packs", pack + ".pack")
+        packFile = os.open(packPath, os.O_RDONLY)
+        try:
+            os.fsync(packFile)
+        finally:
+            os.close(packFile)
+        writeFileAtomic(packPath[0:-len(".pack")] + ".idx", json.dumps(packIndex, separators=(",", ":")))
+    entries = [entry for entry in entries if entry[1] != "f" or entry[8] is not None]
+    totalBytes = sum(entry[6] for entry in entries)
+    name = time.strftime("%Y-%m-%d--%H_%M_%S", time.localtime(started))
+    header = {"name": name, "time": started, "source": os.path.abspath(source), "entries": len(entries), "bytes": totalBytes, "newBytes": newBytes,
+              "changedFiles": len(changed) - len(failed), "duration": int(time.time() - started)}
+    writeSnapshot(repo, name, header, entries)
+    expired = expireSnapshots(repo, location, keepDays)
+    db = updateBackupIndex(repo)
+    if expired > 0 or unfinished:
+        collectBackupGarbage(repo, db)
+        db.close()
+        db = updateBackupIndex(repo)
+    db.close()
+    lock.close()
+    if failed:
+        print(str(len(failed)) + " " + _("files could not be read") + ": " + ", ".join(failed[0:10]))
+    print(_("Backed up") + " " + str(len(entries)) + " " + _("files and folders") + " (" + str(totalBytes // 1048576) + "MB), " + str(len(changed) - len(failed)) + " " + _("changed") + ", "
+          + str(newBytes // 1048576) + "MB " + _("stored") + ", " + _("took") + " " + formatDuration(time.time() - started))
+    return True
+
+def findBackupSnapshot(db, at = None):
+    """
+    Returns (id, name, time) of the newest indexed snapshot taken at or before at (a date as accepted by parseDateTime()), or the newest of all if at is None.
+    """
+    if at is None:
+        return db.execute("SELECT id, name, time FROM snapshots ORDER BY id DESC LIMIT 1").fetchone()
+    return db.execute("SELECT id, name, time FROM snapshots WHERE time <= ? ORDER BY id DESC LIMIT 1", (parseDateTime(at),)).fetchone()
+
+def findBackupVersions(db, snapshotId, path):
+    """
+    Returns the index rows (path, kind, mode, uid, gid, mtime, size, data) of path, and everything inside it if a folder, as they were in a snapshot.
+    """
+    path = path.rstrip("/") or "/"
+    prefix = path if path.endswith("/") else path + "/"
+    return db.execute("""SELECT path, kind, mode, uid, gid, mtime, size, data FROM versions
+                         WHERE (path = ? OR (path >= ? AND path < ?)) AND added <= ? AND (removed IS NULL OR removed > ?) ORDER BY path""",
+                      (path, prefix, prefix[0:-1] + "0", snapshotId, snapshotId)).fetchall() #"0" is the character after "/"
+
+def restoreBackupFile(db, repo, row, folderFd, name):
+    """
+    Writes one file from a backup to name in the folder open as folderFd, reading only its chunks from the packs, with its original owner, permissions and modification time.
+    It is written with writeOwnedFile(), so a symlink already at name is replaced rather than followed.
+    """
+    import hashlib
+    def chunks():
+        for digest in row[7].split():
+            location = db.execute("SELECT pack, offset, length, size FROM chunks WHERE hash = ? LIMIT 1", (digest,)).fetchone()
+            if location is None:
+                raise IOError("Chunk " + digest + " is missing from the backup")
+            data = readBackupChunk(repo, location)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise IOError("Chunk " + digest + " is damaged")
+            yield data
+    writeOwnedFile(folderFd, name, chunks(), row[3], row[4], (row[5], row[5]), row[2])
+
+def restoreBackup(argv):
+    """
+    Command line restore from the backups made by backupHomes(), run as pinet restore. See pinet restore --help for the options.
+    Only the chunks of the files being restored are read, found through the backup index, so restoring one user or file doesn't depend on the size of the backup history.
+    Everything is reached through folder descriptors from the backed up folder (or --to) with openOwnedFolder(), so a symlink a user has put in their
+    home folder is never followed. A folder replaced by a symlink is reported as failed rather than restored through.
+    Returns True if everything asked for was restored.
+    """
+    import argparse, fcntl, stat
+    parser = argparse.ArgumentParser(prog="pinet restore", description=_("Restores files from the PiNet backups of /home."))
+    parser.add_argument("--user", help=_("restore the home folder of this user, --path is then inside it"))
+    parser.add_argument("--path", default="", help=_("file or folder to restore (default everything)"))
+    parser.add_argument("--at", help=_("use the last backup made by this date or time, like 2016-03-25 or 2016-03-25 15:30 (default the newest)"))
+    parser.add_argument("--to", help=_("restore into this folder instead of the original location"))
+    parser.add_argument("--overwrite", action="store_true", help=_("replace files which exist but are different (by default they are skipped)"))
+    parser.add_argument("--list", action="store_true", help=_("only list what would be restored"))
+    parser.add_argument("--snapshots", action="store_true", help=_("list the backups available"))
+    parser.add_argument("--location", help=_("folder holding the backups (default backupLoc in /etc/pinet)"))
+    args = parser.parse_args(argv)
+    location = args.location or getConfig().get("backupLoc", "")
+    repo = os.path.join(location, BackupRepositoryName)
+    if location == "" or not os.path.isdir(os.path.join(repo, "snapshots")):
+        print(_("No backups were found in") + " " + (location or _("the backup location")))
+        return False
+    lock = open(os.path.join(repo, "lock"), "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except (OSError, IOError):
+        print(_("A backup is running, waiting for it to finish"))
+        fcntl.flock(lock, fcntl.LOCK_SH)
+    db = updateBackupIndex(repo)
+    if args.snapshots:
+        for snapshotId, name, taken in db.execute("SELECT id, name, time FROM snapshots ORDER BY id"):
+            header = readSnapshotHeader(repo, name)
+            print(time.strftime("%Y-%m-%d %H:%M", time.localtime(taken)) + "  " + str(header["entries"]) + " " + _("files and folders") + " (" + str(header["bytes"] // 1048576) + "MB)")
+        return True
+    try:
+        snapshot = findBackupSnapshot(db, args.at)
+    except ValueError:
+        print(_("The date must be written like 2016-03-25 or 2016-03-25 15:30"))
+        return False
+    if snapshot is None:
+        print(_("There are no backups from before") + " " + str(args.at))
+        return False
+    path = args.path
+    source = db.execute("SELECT source FROM snapshots WHERE id = ?", (snapshot[0],)).fetchone()[0]
+    if args.user:
+        path = os.path.join(source, args.user, path.lstrip("/"))
+    path = os.path.normpath(os.path.join("/", path))
+    rows = findBackupVersions(db, snapshot[0], path)
+    if not rows:
+        print(path + " " + _("is not in the backup from") + " " + time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot[2])))
+        return False
+    print(_("Restoring from the backup made") + " " + time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot[2])))
+    if args.list:
+        for row in rows:
+            print(time.strftime("%Y-%m-%d %H:%M", time.localtime(row[5] / 1e9)) + "  " + str(row[6]).rjust(10) + "  " + row[0] + ("/" if row[1] == "d" else ""))
+        return True
+    if args.to is None:
+        anchor, relativeTo = source, source
+    else:
+        anchor, relativeTo = args.to, os.path.dirname(path)
+    makeFolder(anchor)
+    restored = 0
+    skipped = []
+    failed = []
+    folders = []
+    for row in rows:
+        relative = os.path.relpath(row[0], relativeTo)
+        target = os.path.normpath(os.path.join(anchor, relative))
+        if relative == ".": #The backed up folder itself
+            folders.append((relative, row))
+            continue
+        parent, name = os.path.split(relative)
+        try:
+            folderFd = openOwnedFolder(anchor, parent, row[3], row[4])
+            try:
+                try:
+                    current = os.stat(name, dir_fd=folderFd, follow_symlinks=False)
+                except FileNotFoundError:
+                    current = None
+                if row[1] == "d":
+                    if current is None:
+                        os.mkdir(name, 0o700, dir_fd=folderFd)
+                        fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=folderFd)
+                        try:
+                            os.fchown(fd, row[3], row[4])
+                            os.fchmod(fd, row[2])
+                        finally:
+                            os.close(fd)
+                    elif not stat.S_ISDIR(current.st_mode):
+                        raise IOError(_("Not a folder"))
+                    folders.append((relative, row))
+                elif row[1] == "l":
+                    if current is None:
+                        os.symlink(row[7], name, dir_fd=folderFd)
+                        os.chown(name, row[3], row[4], dir_fd=folderFd, follow_symlinks=False)
+                        restored = restored + 1
+                else:
+                    if current is not None:
+                        if stat.S_ISREG(current.st_mode) and current.st_size == row[6] and current.st_mtime_ns == row[5]:
+                            continue #Already the same
+                        if not args.overwrite:
+                            skipped.append(target)
+                            continue
+                    restoreBackupFile(db, repo, row, folderFd, name)
+                    restored = restored + 1
+            finally:
+                os.close(folderFd)
+        except (OSError, IOError) as e:
+            failed.append(target)
+            warning("Unable to restore " + target + " - " + str(e))
+    for relative, row in reversed(folders): #Only once their contents are written
+        try:
+            fd = openOwnedFolder(anchor, "" if relative == "." else relative, row[3], row[4])
+            try:
+                os.utime(fd, ns=(row[5], row[5]))
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+    print(str(restored) + " " + _("files restored"))
+    if skipped:
+        print(str(len(skipped)) + " " + _("files were skipped as they already exist and are different, use --overwrite to replace them") + ": " + ", ".join(skipped[0:10]))
+    if failed:
+        print(str(len(failed)) + " " + _("files could not be restored") + ": " + ", ".join(failed[0:10]))
+    db.close()
+    lock.close()
+    return not failed
+
+def checkIfFileContains(file, string):
+    """
+    Simple function to check if a string exists in a file.
+    """
+
+    if checkStringExists(file, string):
+        returnData(1)
+    else:
+        returnData(0)
+
+def savePickled(toSave, path = "/tmp/pinetSoftware.dump"):
+    """
+    Saves list of softwarePackage objects.
+    """
+    import pickle
+    with open(path, "wb") as output:
+        pickle.dump(toSave, output, pickle.HIGHEST_PROTOCOL)
+
+def loadPickled(path= "/tmp/pinetSoftware.dump", deleteAfter = True):
+    """
+    Loads list of softwarePackage objects ready to be used.
+    """
+    import pickle
+    try:
+        with open(path, "rb") as input:
+            obj = pickle.load(input)
+        if deleteAfter:
+            removeFile(path)
+        return obj
+    except (OSError, IOError):
+        if deleteAfter:
+            removeFile(path)
+        return []
+
+def installEpoptes():
+    """
+    Install Epoptes classroom management software. Key is making sure groups are correct.
+    :return:
+    """
+    runBash("apt-get install -y epoptes")
+    runBash("gpasswd -a root staff")
+    runBash("ltsp-chroot --arch armhf apt-get install -y epoptes-client --no-install-recommends")
+    runBash("ltsp-chroot --arch armhf epoptes-client -c")
+    replaceLineOrAdd("/etc/default/epoptes", "SOCKET_GROUP", "SOCKET_GROUP=teacher")
+
+def installScratchGPIO():
+    """
+    ScratchGPIO installation process. Includes creating the desktop icon in all users and /etc/skel
+    """
+    removeFile("/tmp/isgh7.sh")
+    removeFile("/opt/ltsp/armhf/usr/local/bin/isgh5.sh")
+    removeFile("/opt/ltsp/armhf/usr/local/bin/scratchSudo.sh")
+    removeFile("/opt/ltsp/armhf/usr/local/bin/isgh7.sh")
+    downloadFile("http://bit.ly/1wxrqdp", "/tmp/isgh7.sh")
+    copyFile("/tmp/isgh7.sh", "/opt/ltsp/armhf/usr/local/bin/isgh7.sh")
+    replaceLineOrAdd("/opt/ltsp/armhf/usr/local/bin/scratchSudo.sh", "bash /usr/local/bin/isgh7.sh $SUDO_USER", "bash /usr/local/bin/isgh7.sh $SUDO_USER")
+    makeFolder("/etc/skel/Desktop")
+    createTextFile("/etc/skel/Desktop/Install-scratchGPIO.desktop",
+    """[Desktop Entry]
+Version=1.0
+Name=Install ScratchGPIO
+Comment=Install ScratchGPIO
+Exec=sudo bash /usr/local/bin/scratchSudo.sh
+Icon=scratch
+Terminal=true
+Type=Application
+Categories=Utility;Application;
+""")
+    distributeToUsers("/etc/skel/Desktop/Install-scratchGPIO.desktop", "Desktop/Install-scratchGPIO.desktop")
+
+
+def installSoftwareList(holdOffInstall = False):
+    """
+    Replacement for ExtraSoftware function in bash.
+    Builds a list of possible software to install (using softwarePackage class) then displays the list using checkbox Whiptail menu.
+    Checks what options the user has collected, then saves the packages list to file (using pickle). If holdOffInstall is False, then runs installSoftwareFromFile().
+    """
+    software = []
+    software.append(softwarePackage("Libreoffice", _("A free office suite, similar to Microsoft office"), "script", ["apt-get purge -y openjdk-6-jre-headless openjdk-7-jre-headless ca-certificates-java", "apt-get install -y libreoffice gcj-4.7-jre gcj-jre gcj-jre-headless libgcj13-awt"]))
+    software.append(softwarePackage("Arduino-IDE", _("Programming environment for Arduino microcontrollers"), "apt", ["arduino",]))
+    software.append(softwarePackage("Scratch-gpio", _("A special version of scratch for GPIO work") , "scratchGPIO", ["",]))
+    #software.append(softwarePackage("Python-hardware", _("Python libraries for a number of additional addon boards"), "pip", ["pibrella skywriter unicornhat piglow pianohat explorerhat microstacknode twython"]))
+    software.append(softwarePackage("Epoptes", _("Free and open source classroom management software"), "epoptes", ["",]))
+    software.append(softwarePackage("BlueJ", _("A Java IDE for developing programs quickly and easily"), "script", ["rm -rf /tmp/bluej-314a.deb", "rm -rf /opt/ltsp/armhf/tmp/bluej-314a.deb", "wget http://bluej.org/download/files/bluej-314a.deb -O /tmp/bluej-314a.deb", "dpkg -i /tmp/bluej-314a.deb"]))
+    software.append(softwarePackage("Custom-package", _("Allows you to enter the name of a package from Raspbian repository"), "customApt", ["",]))
+    software.append(softwarePackage("Custom-python", _("Allows you to enter the name of a Python library from pip."), "customPip", ["",]))
+    softwareList = []
+    for i in software:
+        softwareList.append([i.name, i.description])
+    done = False
+    if (shutil.get_terminal_size()[0] < 105) or (shutil.get_terminal_size()[0] < 30):
+        print("\x1b[8;30;105t")
+        time.sleep(0.05)
+        #print("Resizing")
+    while done == False:
+        whiptailBox("msgbox", _("Additional Software"), _("In the next window you can select additional software you wish to install. Use space bar to select applications and hit enter when you are finished."), False)
+        result = (whiptailCheckList(_("Extra Software Submenu"), _("Select any software you want to install. Use space bar to select then enter to continue."), softwareList))
+        try:
+            result = result.decode("utf-8")
+        except AttributeError:
+            return
+        result = result.replace('"', '')
+        if result != "Cancel":
+            if result == "":
+                yesno = whiptailBox("yesno", _("Are you sure?"), _("Are you sure you don't want to install any additional software?"), True)
+                if yesno:
+                    savePickled(software)
+                    done = True
+            else:
+                resultList = result.split(" ")
+                yesno = whiptailBox("yesno", _("Are you sure?"), _("Are you sure you want to install this software?") + " \n" + (result.replace(" ", "\n")), True, height=str(7+len(result.split(" "))))
+                if yesno:
+                    for i in software:
+                        if i.name in resultList:
+                            i.customAptPip()
+                            #i.marked = True
+                    done = True
+                    savePickled(software)
+
+    if holdOffInstall == False:
+        installSoftwareFromFile()
+
+def installSoftwareFromFile(packages = None):
+    """
+    Second part of installSoftwareList().
+    Loads the pickle encoded list of softwarePackage objects, then installs the marked ones together using an installPlan, printing the plan first.
+    """
+    if packages == None:
+        packages = loadPickled()
+    plan = installPlan(packages)
+    for i in packages:
+        if i.marked == True:
+            i.marked = False
+        else:
+            debug("Not installing " + str(i.name))
+    if plan.empty():
+        return
+    print("--------------------------------------------------------")
+    print(_("Install plan"))
+    for step in plan.describe():
+        print(step)
+    print("--------------------------------------------------------")
+    setConfigParameter("NBDBuildNeeded", "true")
+    failed = plan.run()
+    if failed:
+        whiptailBox("msgbox", _("Install problem"), _("The following packages couldn't be installed, everything else was") + " - " + " ".join(failed), False)
+    nbdRun()
+
+
+
+
+def compareDebianVersions(first, second):
+    """
+    Compares two Debian package versions the same way dpkg does. Returns -1, 0 or 1.
+    """
+    def split(version):
+        epoch = "0"
+        if ":" in version:
+            epoch, version = version.split(":", 1)
+        revision = "0"
+        if "-" in version:
+            version, revision = version.rsplit("-", 1)
+        return int(epoch or "0"), version, revision
+
+    def order(char):
+        if char == "" or char.isdigit():
+            return 0
+        if char == "~":
+            return -1
+        if char.isalpha():
+            return ord(char)
+        return ord(char) + 256
+
+    def comparePart(a, b):
+        i = j = 0
+        while i < len(a) or j < len(b):
+            while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+                ac = order(a[i:i + 1])
+                bc = order(b[j:j + 1])
+                if ac != bc:
+                    return -1 if ac < bc else 1
+                i = i + 1
+                j = j + 1
+            numberStart = i
+            while i < len(a) and a[i].isdigit():
+                i = i + 1
+            numberA = int(a[numberStart:i] or "0")
+            numberStart = j
+            while j < len(b) and b[j].isdigit():
+                j = j + 1
+            numberB = int(b[numberStart:j] or "0")
+            if numberA != numberB:
+                return -1 if numberA < numberB else 1
+        return 0
+
+    firstParts = split(first)
+    secondParts = split(second)
+    if firstParts[0] != secondParts[0]:
+        return -1 if firstParts[0] < secondParts[0] else 1
+    return comparePart(firstParts[1], secondParts[1]) or comparePart(firstParts[2], secondParts[2])
+
+def iterDebianStanzas(filep):
+    """
+    Generator going through a Debian control style file (like dpkg status or an apt Packages list), yielding a dict per stanza.
+    Only the Package, Status, Version and Provides fields are kept, which keeps reading the big apt lists quick.
+    """
+    wanted = ("Package", "Status", "Version", "Provides")
+    stanza = {}
+    for line in iterTextFile(filep):
+        if line == "":
+            if stanza:
+                yield stanza
+            stanza = {}
+        elif not line[0].isspace() and ":" in line:
+            field, value = line.split(":", 1)
+            if field in wanted:
+                stanza[field] = value.strip()
+    if stanza:
+        yield stanza
+
+def providedNames(stanza):
+    provides = []
+    for provide in stanza.get("Provides", "").split(","):
+        name = provide.strip().split(" ")[0]
+        if name != "":
+            provides.append(name)
+    return provides
+
+def readDpkgStatus(root = ""):
+    """
+    Returns (installed, provided) for the system at root, installed being a dict of package name to installed version and provided the set of virtual package names installed packages provide.
+    """
+    installed = {}
+    provided = set()
+    for stanza in iterDebianStanzas(root + "/var/lib/dpkg/status"):
+        if stanza.get("Status", "").endswith(" installed") and "Package" in stanza:
+            installed[stanza["Package"]] = stanza.get("Version", "")
+            provided.update(providedNames(stanza))
+    return installed, provided
+
+def readAptLists(root = ""):
+    """
+    Returns (available, provided) from the apt lists at root, available being a dict of package name to the newest version on offer.
+    """
+    import glob
+    available = {}
+    provided = set()
+    for listFile in glob.glob(root + "/var/lib/apt/lists/*_Packages"):
+        for stanza in iterDebianStanzas(listFile):
+            name = stanza.get("Package")
+            if name is None:
+                continue
+            version = stanza.get("Version", "")
+            if not name in available or compareDebianVersions(version, available[name]) > 0:
+                available[name] = version
+            provided.update(providedNames(stanza))
+    return available, provided
+
+def aptPackagesNeeded(packages, root = ""):
+    """
+    Works out which apt packages need installing at root, without running apt.
+    Returns (needed, unavailable). needed is the packages which are missing or older than the newest in the apt lists.
+    unavailable is the missing packages apt couldn't install at all, which are left out so they don't fail everything else in the same transaction.
+    """
+    installed, installedProvided = readDpkgStatus(root)
+    available, availableProvided = readAptLists(root)
+    needed = []
+    unavailable = []
+    for package in packages:
+        if package in installed:
+            if package in available and compareDebianVersions(installed[package], available[package]) < 0:
+                needed.append(package)
+        elif package in installedProvided:
+            continue
+        elif package in available or package in availableProvided:
+            needed.append(package)
+        else:
+            unavailable.append(package)
+    return needed, unavailable
+
+def normalisePythonName(name):
+    import re
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def pythonVersionKey(version):
+    """
+    Sort key for Python package versions. Good enough to tell if a newer release is out.
+    Trailing zeros in the release number are ignored (1.0 == 1.0.0), pre-releases sort before the release and post releases after.
+    """
+    import re
+    match = re.match(r"v?(\d+(?:\.\d+)*)(.*)$", version.strip().lower())
+    if not match:
+        return ((), -1, ())
+    release = [int(part) for part in match.group(1).split(".")]
+    while release and release[-1] == 0:
+        release.pop()
+    suffix = [(1, int(part), "") if part.isdigit() else (0, 0, part) for part in re.findall(r"\d+|[a-z]+", match.group(2))]
+    if not suffix:
+        stage = 1
+    elif suffix[0][2] in ("post", "rev", "r"):
+        stage = 2
+    else:
+        stage = 0
+    return (tuple(release), stage, tuple(suffix))
+
+def getInstalledPythonPackages(root, pythonVersion):
+    """
+    Returns a dict of normalised name to version for the Python packages installed at root for a Python version ("2" or "3"), read from their egg-info/dist-info metadata.
+    """
+    import glob
+    packages = {}
+    folders = []
+    for base in ("/usr/lib/python", "/usr/local/lib/python"):
+        for packageFolder in ("dist-packages", "site-packages"):
+            folders.extend(glob.glob(root + base + pythonVersion + "*/" + packageFolder))
+    for folder in folders:
+        for entry in os.listdir(folder):
+            if entry.endswith(".egg-info") or entry.endswith(".dist-info"):
+                parts = entry.rsplit(".", 1)[0].split("-")
+                if len(parts) < 2:
+                    continue
+                name = normalisePythonName(parts[0])
+                if not name in packages or pythonVersionKey(parts[1]) > pythonVersionKey(packages[name]):
+                    packages[name] = parts[1]
+    return packages
+
+def pipPackagesNeeded(packages, root, pythonVersion):
+    """
+    Returns the pip packages which are missing at root for a Python version ("2" or "3").
+    An installed package counts as done unless the manifest pins a version (for example pillow==2.9.0) and a different one is installed.
+    """
+    installed = getInstalledPythonPackages(root, pythonVersion)
+    needed = []
+    for package in packages:
+        name, pinned = (package.split("==", 1) + [None])[0:2]
+        version = installed.get(normalisePythonName(name))
+        if version is None or (pinned is not None and pythonVersionKey(version) != pythonVersionKey(pinned)):
+            needed.append(package)
+    return needed
+
+def readSoftwareManifest(manifest = SoftwareManifest):
+    """
+    Reads a software manifest into a list of (kind, items) steps. Neighbouring lines of the same kind (other than chroot commands) are joined into one step.
+    """
+    kinds = ("apt", "apt-norecommends", "apt-confnew", "apt-noninteractive", "pip", "pip3", "chroot", "server-apt")
+    steps = []
+    for line in iterTextFile(manifest):
+        line = line.split("#", 1)[0].strip()
+        if line == "":
+            continue
+        kind, items = (line.split(None, 1) + [""])[0:2]
+        if not kind in kinds:
+            print(_("Unknown software manifest line") + " - " + line)
+        elif kind == "chroot":
+            steps.append((kind, [items]))
+        elif steps and steps[-1][0] == kind:
+            steps[-1][1].extend(name for name in items.split() if not name in steps[-1][1])
+        else:
+            steps.append((kind, items.split()))
+    return steps
+
+def installSoftwareManifest(manifest = SoftwareManifest, root = "/opt/ltsp/armhf"):
+    """
+    Installs the software listed in the software manifest (see Scripts/software.manifest) into the Raspbian chroot.
+    Reads the chroot's dpkg status, apt lists and Python package metadata directly, so only missing or outdated packages are installed.
+    """
+    import shlex
+    if not os.path.exists(manifest):
+        makeFolder(os.path.dirname(manifest))
+        downloadFile(RawRepository + "/" + ReleaseBranch + "/Scripts/software.manifest", manifest)
+    steps = readSoftwareManifest(manifest)
+    aptOptions = {"apt": "", "apt-norecommends": " --no-install-recommends", "apt-confnew": " -o Dpkg::Options::=\"--force-confnew\"", "apt-noninteractive": ""}
+    installed = 0
+    for kind, items in steps:
+        if kind == "chroot":
+            ltspChroot(items[0])
+        elif kind in aptOptions or kind == "server-apt":
+            if kind == "server-apt":
+                needed, unavailable = aptPackagesNeeded(items)
+            else:
+                needed, unavailable = aptPackagesNeeded(items, root)
+            for package in unavailable:
+                print(_("Skipping") + " " + package + ", " + _("it isn't available from any repository"))
+            if not needed:
+                continue
+            print(_("Installing") + " " + " ".join(needed))
+            installed = installed + len(needed)
+            if kind == "server-apt":
+                runBash("apt-get install -y " + " ".join(needed))
+            elif kind == "apt-noninteractive":
+                runBash("DEBIAN_FRONTEND=noninteractive ltsp-chroot --arch armhf apt-get install -y " + " ".join(needed))
+            else:
+                ltspChroot("apt-get install -y" + aptOptions[kind] + " " + " ".join(needed))
+        else:
+            commands = []
+            pythonVersions = ["3"] if kind == "pip3" else ["2", "3"]
+            for pythonVersion in pythonVersions:
+                needed = pipPackagesNeeded(items, root, pythonVersion)
+                if needed:
+                    print(_("Installing with pip") + ("3" if pythonVersion == "3" else "") + " " + " ".join(needed))
+                    installed = installed + len(needed)
+                    commands.append(("pip3" if pythonVersion == "3" else "pip") + " install -U " + " ".join(needed))
+            if commands:
+                ltspChroot("sh -c " + shlex.quote(" & ".join(commands) + " & wait")) #pip and pip3 run in parallel, in one chroot
+    if installed == 0:
+        print(_("All software in the manifest is installed and up to date"))
+
+class packageCache():
+    """
+    Content addressed store for the package proxy (see runPackageProxy).
+    Downloads are kept under their sha256 in cacheLoc/blobs, with an SQLite index of URL to file, so the same file from two mirrors is only kept once.
+    When the files go over maxSize bytes, the least recently used URLs are dropped.
+    """
+
+    def __init__(self, cacheLoc, maxSize):
+        super(packageCache, self).__init__()
+        import sqlite3, threading
+        self.cacheLoc = cacheLoc
+        self.maxSize = maxSize
+        makeFolder(os.path.join(cacheLoc, "blobs"))
+        makeFolder(os.path.join(cacheLoc, "tmp"))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cacheLoc, "index.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL, contentType TEXT, lastModified TEXT, lastAccess REAL);
+            CREATE INDEX IF NOT EXISTS urlsByAccess ON urls (lastAccess);
+            CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+        self.db.commit()
+
+    def blobPath(self, digest):
+        return os.path.join(self.cacheLoc, "blobs", digest[0:2], digest)
+
+    def lookup(self, url):
+        """
+        Returns (path, size, contentType, lastModified) for a cached URL, or None if it isn't cached.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT urls.digest, size, contentType, lastModified FROM urls JOIN blobs ON urls.digest = blobs.digest WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            path = self.blobPath(row[0])
+            if not os.path.exists(path):
+                self.db.execute("DELETE FROM urls WHERE url = ?", (url,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE urls SET lastAccess = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        return path, row[1], row[2], row[3]
+
+    def newFile(self):
+        """
+        Returns a temporary file and sha256 object for streaming a download into, before store() is called.
+        """
+        import tempfile, hashlib
+        fd, tempLoc = tempfile.mkstemp(dir=os.path.join(self.cacheLoc, "tmp"))
+        return os.fdopen(fd, "wb"), tempLoc, hashlib.sha256()
+
+    def store(self, url, tempLoc, digest, size, contentType, lastModified):
+        path = self.blobPath(digest)
+        makeFolder(os.path.dirname(path))
+        os.replace(tempLoc, path)
+        with self.lock:
+            previous = self.db.execute("SELECT digest FROM urls WHERE url = ?", (url,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (digest, size))
+            self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)", (url, digest, contentType, lastModified, time.time()))
+            if previous is not None and previous[0] != digest:
+                self.dropUnusedBlob(previous[0]) #The URL changed (like an apt Release file), so the old copy may not be wanted any more
+            self.evict()
+            self.db.commit()
+
+    def dropUnusedBlob(self, digest):
+        """
+        Deletes a blob if no URL refers to it any more. Returns the bytes freed.
+        """
+        if self.db.execute("SELECT 1 FROM urls WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None:
+            return 0
+        row = self.db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        removeFile(self.blobPath(digest))
+        if row is None:
+            return 0
+        return row[0]
+
+    def evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.maxSize:
+            return
+        for digest, in self.db.execute("SELECT digest FROM blobs WHERE NOT EXISTS (SELECT 1 FROM urls WHERE urls.digest = blobs.digest)").fetchall():
+            total = total - self.dropUnusedBlob(digest) #Left behind by earlier versions, which didn't clean up replaced URLs
+        for url, digest in self.db.execute("SELECT url, digest FROM urls ORDER BY lastAccess").fetchall():
+            if total <= self.maxSize:
+                break
+            self.db.execute("DELETE FROM urls WHERE url = ?", (url,))
+            total = total - self.dropUnusedBlob(digest)
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO stats VALUES (?, 0)", (name,))
+            self.db.execute("UPDATE stats SET value = value + ? WHERE name = ?", (amount, name))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.db.execute("SELECT name, value FROM stats").fetchall())
+            stats["files"], stats["size"] = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return stats
+
+def getPackageCache():
+    """
+    Returns the packageCache set up from the PackageProxyCache and PackageProxyCacheSize (in MB) settings in /etc/pinet.
+    """
+    config = getConfig()
+    cacheLoc = config.get("PackageProxyCache", "/var/cache/pinet/packages")
+    try:
+        maxSize = int(config.get("PackageProxyCacheSize", "20000")) * 1024 * 1024
+    except ValueError:
+        maxSize = 20000 * 1024 * 1024
+    return packageCache(cacheLoc, maxSize)
+
+def immutablePackageURL(url):
+    """
+    True for URLs whose content never changes (packages and wheels), which can be served from the cache without asking upstream.
+    Anything else (like apt Release files or PyPI index pages) is always fetched again, with the cached copy only used if upstream can't be reached.
+    """
+    path = url.split("?", 1)[0]
+    return path.endswith((".deb", ".udeb", ".dsc", ".whl", ".egg", ".zip", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")) or "/by-hash/" in path
+
+def packageMirrorHosts(roots = ("/opt/ltsp/armhf", "")):
+    """
+    Returns the set of hosts the package proxy may fetch from, being the http mirrors in the apt sources of the Raspbian chroot and the server,
+    plus any listed (space separated) in the PackageProxyHosts setting in /etc/pinet.
+    """
+    import glob, urllib.parse
+    hosts = set(getConfig().get("PackageProxyHosts", "").lower().split())
+    for root in roots:
+        for sources in [root + "/etc/apt/sources.list"] + glob.glob(root + "/etc/apt/sources.list.d/*.list"):
+            try:
+                lines = open(sources).read().splitlines()
+            except (OSError, IOError):
+                continue
+            for line in lines:
+                for word in line.split("#", 1)[0].split():
+                    if word.startswith("http://"):
+                        hosts.add((urllib.parse.urlsplit(word).hostname or "").lower())
+    hosts.discard("")
+    return hosts
+
+def runPackageProxy():
+    """
+    Runs the caching package proxy used by the Raspbian chroot (and the Pis) for apt and pip, see SetupPackageProxy in pinet.
+    apt uses it as a normal HTTP proxy. pip uses it as its index, /pypi/ being passed on to pypi.org and /pythonhosted/ to files.pythonhosted.org,
+    with download links in the index pages rewritten to come back through the proxy.
+    Packages are kept in a packageCache, so repeat downloads run at LAN speed and work with no internet connection.
+    """
+    import http.server, socketserver, urllib.request, urllib.error, ipaddress, socket
+    cache = getPackageCache()
+    reverseProxies = [("/pypi/", "https://pypi.org/"), ("/pythonhosted/", "https://files.pythonhosted.org/")]
+    mirrors = {"hosts": packageMirrorHosts(), "read": time.time()}
+
+    def mirrorAllowed(url):
+        """
+        Only the apt mirrors in use are proxied, so the proxy can't be used to reach anywhere else. The sources are read again (at most once a minute) when an unknown host is asked for, in case a repository has been added.
+        """
+        import urllib.parse
+        host = (urllib.parse.urlsplit(url).hostname or "").lower()
+        if not host in mirrors["hosts"] and time.time() - mirrors["read"] > 60:
+            mirrors["hosts"] = packageMirrorHosts()
+            mirrors["read"] = time.time()
+        return host in mirrors["hosts"]
+
+    class packageProxyHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            debug(self.address_string() + " - " + format % args)
+
+        def upstreamURL(self):
+            if self.path.startswith("http://"):
+                return self.path
+            for prefix, upstream in reverseProxies:
+                if self.path.startswith(prefix):
+                    return upstream + self.path[len(prefix):]
+            return None
+
+        def rewrite(self, url, body):
+            if not url.startswith(reverseProxies[0][1]):
+                return body
+            host = self.headers.get("Host", "")
+            return body.replace(reverseProxies[1][1].encode(), ("http://" + host + reverseProxies[1][0]).encode())
+
+        def sendFile(self, url, cached):
+            path, size, contentType, lastModified = cached
+            with open(path, "rb") as cachedFile:
+                if url.startswith(reverseProxies[0][1]):
+                    body = self.rewrite(url, cachedFile.read())
+                    self.sendHeaders(200, contentType, len(body), lastModified)
+                    self.wfile.write(body)
+                else:
+                    self.sendHeaders(200, contentType, size, lastModified)
+                    shutil.copyfileobj(cachedFile, self.wfile, 65536)
+            cache.count("bytesFromCache", size)
+
+        def sendHeaders(self, status, contentType, length, lastModified = None):
+            self.send_response(status)
+            self.send_header("Content-Type", contentType or "application/octet-stream")
+            if length is not None:
+                self.send_header("Content-Length", str(length))
+            if lastModified:
+                self.send_header("Last-Modified", lastModified)
+            self.end_headers()
+
+        def do_GET(self):
+            try:
+                if not ipaddress.ip_address(self.client_address[0]).is_private:
+                    self.send_error(403)
+                    return
+            except ValueError:
+                self.send_error(403)
+                return
+            url = self.upstreamURL()
+            if url is None:
+                self.send_error(404)
+                return
+            if self.path.startswith("http://") and not mirrorAllowed(url):
+                self.send_error(403, "Not a package mirror")
+                return
+            immutable = immutablePackageURL(url)
+            cached = cache.lookup(url)
+            if immutable and cached is not None:
+                cache.count("hits")
+                self.sendFile(url, cached)
+                return
+            headers = {"User-Agent": self.headers.get("User-Agent", "PiNet package proxy")}
+            for header in ("Accept", "If-Modified-Since", "If-None-Match"):
+                if self.headers.get(header) and not (immutable and header.startswith("If-")):
+                    headers[header] = self.headers.get(header)
+            try:
+                response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    cache.count("revalidated")
+                    self.sendHeaders(304, e.headers.get("Content-Type"), None)
+                elif e.code >= 500 and cached is not None:
+                    cache.count("staleHits")
+                    self.sendFile(url, cached)
+                else:
+                    body = e.read()
+                    self.sendHeaders(e.code, e.headers.get("Content-Type"), len(body))
+                    self.wfile.write(body)
+                return
+            except (urllib.error.URLError, OSError, socket.timeout):
+                if cached is not None:
+                    cache.count("staleHits") #Upstream unreachable, better an old copy than nothing
+                    self.sendFile(url, cached)
+                else:
+                    cache.count("errors")
+                    self.send_error(502, "Upstream unreachable")
+                return
+            cache.count("misses")
+            contentType = response.headers.get("Content-Type")
+            lastModified = response.headers.get("Last-Modified")
+            cacheFile, tempLoc, digest = cache.newFile()
+            size = 0
+            clientGone = False
+            try:
+                if url.startswith(reverseProxies[0][1]):
+                    body = response.read()
+                    cacheFile.write(body)
+                    digest.update(body)
+                    size = len(body)
+                    body = self.rewrite(url, body)
+                    self.sendHeaders(200, contentType, len(body), lastModified)
+                    self.wfile.write(body)
+                else:
+                    self.sendHeaders(200, contentType, response.headers.get("Content-Length"), lastModified)
+                    while True:
+                        chunk = response.read(65536)
+                        if not chunk:
+                            break
+                        cacheFile.write(chunk)
+                        digest.update(chunk)
+                        size = size + len(chunk)
+                        if not clientGone:
+                            try:
+                                self.wfile.write(chunk)
+                            except (OSError, socket.error):
+                                clientGone = True #Carry on filling the cache, it will be asked for again
+                cacheFile.close()
+                cache.store(url, tempLoc, digest.hexdigest(), size, contentType, lastModified)
+                cache.count("bytesFetched", size)
+            except (OSError, socket.timeout) as e:
+                warning("Package proxy download of " + url + " failed - " + str(e))
+                cacheFile.close()
+                removeFile(tempLoc)
+            finally:
+                response.close()
+
+    class packageProxyServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    try:
+        port = int(getConfig().get("PackageProxyPort", "3142"))
+    except ValueError:
+        port = 3142
+    for leftOver in os.listdir(os.path.join(cache.cacheLoc, "tmp")):
+        removeFile(os.path.join(cache.cacheLoc, "tmp", leftOver))
+    packageProxyServer(("", port), packageProxyHandler).serve_forever()
+
+def packageProxyStats():
+    """
+    Prints how well the package proxy cache is doing.
+    """
+    stats = getPackageCache().stats()
+    requests = stats.get("hits", 0) + stats.get("misses", 0) + stats.get("staleHits", 0)
+    hitRate = 0
+    if requests > 0:
+        hitRate = int(round(100.0 * (stats.get("hits", 0) + stats.get("staleHits", 0)) / requests))
+    megabyte = 1024 * 1024
+    print(_("Cached files") + " - " + str(stats["files"]) + " (" + str(stats["size"] // megabyte) + "MB)")
+    print(_("Served from cache") + " - " + str(stats.get("hits", 0)) + " (" + str(stats.get("bytesFromCache", 0) // megabyte) + "MB)")
+    print(_("Downloaded from the internet") + " - " + str(stats.get("misses", 0)) + " (" + str(stats.get("bytesFetched", 0) // megabyte) + "MB)")
+    print(_("Served from cache while offline") + " - " + str(stats.get("staleHits", 0)))
+    print(_("Already up to date") + " - " + str(stats.get("revalidated", 0)))
+    print(_("Failed") + " - " + str(stats.get("errors", 0)))
+    print(_("Hit rate") + " - " + str(hitRate) + "%")
+
+FATShortNameCharacters = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%'-_@~`!(){}^#&")
+
+def fatShortName(name):
+    """
+    Returns the 11 byte FAT short name and case flags for a name which fits 8.3 (each part all upper or all lower case), or None if it needs a long name.
+    """
+    if name.count(".") > 1 or name.startswith("."):
+        return None
+    base, dot, extension = name.partition(".")
+    if not 1 <= len(base) <= 8 or len(extension) > 3:
+        return None
+    flags = 0
+    for part, lowerFlag in [(base, 0x08), (extension, 0x10)]:
+        if part != part.upper():
+            if part != part.lower():
+                return None
+            flags = flags | lowerFlag
+        for character in part.upper():
+            if not character in FATShortNameCharacters:
+                return None
+    return (base.upper().ljust(8) + extension.upper().ljust(3)).encode("ascii"), flags
+
+def fatAliasName(name, used):
+    """
+    Makes a unique short name alias (like BCM270~1DTB) for a long name. used is the set of short names already in the folder.
+    """
+    def clean(part):
+        return "".join(character if character in FATShortNameCharacters else "_" for character in part.upper() if not character in " .")
+    if "." in name.lstrip("."):
+        base, extension = name.rsplit(".", 1)
+    else:
+        base, extension = name, ""
+    base = clean(base) or "_"
+    extension = clean(extension)[0:3]
+    number = 1
+    while True:
+        tail = "~" + str(number)
+        shortName = (base[0:8 - len(tail)] + tail).ljust(8).encode("ascii") + extension.ljust(3).encode("ascii")
+        if not shortName in used:
+            return shortName
+        number = number + 1
+
+def fatLongNameEntries(name, shortName):
+    """
+    Returns the long file name directory entries for name, in the order they go on disk (before the short name entry).
+    """
+    checksum = 0
+    for byte in bytearray(shortName):
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    encoded = name.encode("utf-16-le")
+    units = [encoded[i:i + 2] for i in range(0, len(encoded), 2)]
+    if len(units) % 13:
+        units.append(b"\0\0")
+    while len(units) % 13:
+        units.append(b"\xff\xff")
+    count = len(units) // 13
+    entries = []
+    for index in range(count, 0, -1):
+        part = units[(index - 1) * 13:index * 13]
+        order = index | 0x40 if index == count else index
+        entries.append(bytes([order]) + b"".join(part[0:5]) + bytes([0x0F, 0, checksum]) + b"".join(part[5:11]) + b"\0\0" + b"".join(part[11:13]))
+    return entries
+
+def fatTimestamp(timestamp):
+    """
+    Returns the FAT (date, time) for a Unix timestamp, in local time as FAT has no time zones.
+    """
+    local = time.localtime(max(timestamp, 315532800))
+    date = ((max(local.tm_year, 1980) - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday
+    return date, (local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2)
+
+class fatImage():
+    """
+    SD card image (an MBR with a single FAT32 partition) written straight into a sparse file, so no loop mounting or root is needed.
+    Add the files with addFolder() and setFile(), then call write(). The cluster layout is only worked out again if a file no longer fits its clusters,
+    so variants of one image (like cmdline.txt for each server IP) can be written one after another, with every other file shared between them in memory.
+    """
+
+    sectorSize = 512
+    reservedSectors = 32
+    numberOfFATs = 2
+
+    def __init__(self, imageSize = 100 * 1048576, partitionStart = 4 * 1048576, sectorsPerCluster = 2, label = "PINET"):
+        super(fatImage, self).__init__()
+        from collections import OrderedDict
+        self.imageSize = imageSize
+        self.partitionStart = partitionStart
+        self.partitionSectors = (imageSize - partitionStart) // self.sectorSize
+        self.sectorsPerCluster = sectorsPerCluster
+        self.clusterSize = sectorsPerCluster * self.sectorSize
+        self.label = label.upper()[0:11].ljust(11).encode("ascii")
+        self.fatSectors = -(-(self.partitionSectors - self.reservedSectors) // ((256 * sectorsPerCluster + self.numberOfFATs) // 2))
+        self.dataStart = partitionStart + (self.reservedSectors + self.numberOfFATs * self.fatSectors) * self.sectorSize
+        self.clusterCount = (self.partitionSectors - self.reservedSectors - self.numberOfFATs * self.fatSectors) // sectorsPerCluster
+        if not 65525 <= self.clusterCount < 0x0FFFFFF5:
+            raise ValueError(_("Image size and cluster size don't make a valid FAT32 filesystem"))
+        self.root = {"children": OrderedDict(), "mtime": time.time()}
+        self.allocated = False
+
+    def folder(self, path, create = False):
+        from collections import OrderedDict
+        node = self.root
+        for name in [part for part in path.split("/") if part]:
+            if not name in node["children"]:
+                if not create:
+                    raise KeyError(path)
+                node["children"][name] = {"children": OrderedDict(), "mtime": node["mtime"]}
+                self.allocated = False
+            node = node["children"][name]
+        return node
+
+    def setFile(self, path, data, mtime = None, reserve = 0):
+        """
+        Adds or replaces the file at path (relative to the root, with / between folders). reserve is the minimum space to allocate, so larger variants fit later.
+        """
+        folderPath, name = os.path.split(path.strip("/"))
+        folder = self.folder(folderPath, True)
+        old = folder["children"].get(name)
+        node = {"data": data, "mtime": time.time() if mtime is None else mtime, "space": max(len(data), reserve)}
+        if old is None or "children" in old or node["space"] > old["space"]:
+            self.allocated = False
+        elif self.allocated:
+            node.update({"space": old["space"], "cluster": old["cluster"]}) #Fits where the old version was
+        folder["children"][name] = node
+
+    def addFolder(self, source, path = ""):
+        """
+        Adds everything in a folder on disk to the image, at path.
+        """
+        for folderPath, dirs, files in os.walk(source):
+            dirs.sort()
+            relative = os.path.relpath(folderPath, source)
+            relative = path if relative == "." else os.path.join(path, relative)
+            folder = self.folder(relative, True)
+            folder["mtime"] = os.path.getmtime(folderPath)
+            for name in sorted(files):
+                with open(os.path.join(folderPath, name), "rb") as sourceFile:
+                    self.setFile(relative + "/" + name, sourceFile.read(), os.path.getmtime(os.path.join(folderPath, name)))
+
+    def allocate(self):
+        """
+        Gives every folder and file a run of clusters, in one contiguous block each, with the root folder first as FAT32 expects.
+        A file's run covers its reserve too, but only the clusters holding data are chained in the FAT (see buildFAT()), so the rest of the run stays free space.
+        """
+        self.nextCluster = 2
+        queue = [self.root]
+        while queue:
+            folder = queue.pop(0)
+            used = set()
+            entries = 1 if folder is self.root else 2 #Volume label, or . and ..
+            folder["names"] = {}
+            for name, node in folder["children"].items():
+                short = fatShortName(name)
+                if short is None or short[0] in used:
+                    shortName = fatAliasName(name, used)
+                    folder["names"][name] = (shortName, 0, fatLongNameEntries(name, shortName))
+                else:
+                    folder["names"][name] = (short[0], short[1], [])
+                used.add(folder["names"][name][0])
+                entries = entries + 1 + len(folder["names"][name][2])
+            folder["cluster"] = self.allocateClusters(entries * 32)
+            folder["space"] = entries * 32
+            for name, node in folder["children"].items():
+                if "children" in node:
+                    queue.append(node)
+                else:
+                    node["cluster"] = self.allocateClusters(node["space"])
+        if self.nextCluster - 2 > self.clusterCount:
+            raise ValueError(_("The files don't fit in the SD card image"))
+        self.allocated = True
+
+    def allocateClusters(self, size):
+        count = -(-size // self.clusterSize)
+        if count == 0:
+            return 0
+        first = self.nextCluster
+        self.nextCluster = first + count
+        return first
+
+    def buildFAT(self):
+        """
+        Returns the FAT entries for the current contents, chaining just the clusters each folder and file uses.
+        """
+        fat = [0x0FFFFFF8, 0x0FFFFFFF] + [0] * (self.nextCluster - 2)
+        def chain(first, size):
+            count = -(-size // self.clusterSize)
+            if count > 0:
+                fat[first:first + count - 1] = range(first + 1, first + count)
+                fat[first + count - 1] = 0x0FFFFFFF
+        queue = [self.root]
+        while queue:
+            folder = queue.pop(0)
+            chain(folder["cluster"], folder["space"])
+            for node in folder["children"].values():
+                if "children" in node:
+                    queue.append(node)
+                elif node["data"]:
+                    chain(node["cluster"], len(node["data"]))
+        return fat
+
+    def directoryEntry(self, shortName, attributes, flags, cluster, size, mtime):
+        import struct
+        date, clock = fatTimestamp(mtime)
+        return struct.pack("<11sBBBHHHHHHHI", shortName, attributes, flags, 0, clock, date, date, cluster >> 16, clock, date, cluster & 0xFFFF, size)
+
+    def directory(self, folder, parent):
+        entries = []
+        if folder is self.root:
+            entries.append(self.directoryEntry(self.label, 0x08, 0, 0, 0, folder["mtime"]))
+        else:
+            entries.append(self.directoryEntry(b".          ", 0x10, 0, folder["cluster"], 0, folder["mtime"]))
+            entries.append(self.directoryEntry(b"..         ", 0x10, 0, 0 if parent is self.root else parent["cluster"], 0, parent["mtime"]))
+        for name, node in folder["children"].items():
+            shortName, flags, longEntries = folder["names"][name]
+            entries.extend(longEntries)
+            if "children" in node:
+                entries.append(self.directoryEntry(shortName, 0x10, flags, node["cluster"], 0, node["mtime"]))
+            else:
+                entries.append(self.directoryEntry(shortName, 0x20, flags, node["cluster"] if node["data"] else 0, len(node["data"]), node["mtime"]))
+        return b"".join(entries)
+
+    def bootSector(self, volumeID):
+        import struct
+        sector = bytearray(self.sectorSize)
+        struct.pack_into("<3s8sHBHBHHBHHHII", sector, 0, b"\xeb\x58\x90", b"MSWIN4.1", self.sectorSize, self.sectorsPerCluster, self.reservedSectors,
+                         self.numberOfFATs, 0, 0, 0xF8, 0, 63, 255, self.partitionStart // self.sectorSize, self.partitionSectors)
+        struct.pack_into("<IHHIHH12sBBBI11s8s", sector, 36, self.fatSectors, 0, 0, 2, 1, 6, b"", 0x80, 0, 0x29, volumeID, self.label, b"FAT32   ")
+        sector[510:512] = b"\x55\xaa"
+        return bytes(sector)
+
+    def fsInfoSector(self, fat):
+        import struct
+        sector = bytearray(self.sectorSize)
+        used = len(fat) - fat.count(0)
+        struct.pack_into("<I", sector, 0, 0x41615252)
+        struct.pack_into("<IIII", sector, 484, 0x61417272, self.clusterCount - (used - 2), len(fat), 0)
+        struct.pack_into("<I", sector, 508, 0xAA550000)
+        return bytes(sector)
+
+    def masterBootRecord(self, volumeID):
+        import struct
+        sector = bytearray(self.sectorSize)
+        struct.pack_into("<I", sector, 440, volumeID)
+        struct.pack_into("<B3sB3sII", sector, 446, 0, b"\xfe\xff\xff", 0x0C, b"\xfe\xff\xff", self.partitionStart // self.sectorSize, self.partitionSectors) #CHS left as LBA only
+        sector[510:512] = b"\x55\xaa"
+        return bytes(sector)
+
+    def write(self, filename):
+        """
+        Writes the image to filename (replacing it atomically). Only the parts holding data are written, the rest of the file is left sparse.
+        """
+        import zlib, struct
+        if not self.allocated:
+            self.allocate()
+        writes = []
+        queue = [(self.root, None)]
+        checksum = 0
+        while queue:
+            folder, parent = queue.pop(0)
+            directory = self.directory(folder, parent)
+            checksum = zlib.crc32(directory, checksum)
+            writes.append((folder["cluster"], directory))
+            for node in folder["children"].values():
+                if "children" in node:
+                    queue.append((node, folder))
+                elif node["data"]:
+                    writes.append((node["cluster"], node["data"]))
+                    checksum = zlib.crc32(node["data"], checksum)
+        volumeID = checksum & 0xFFFFFFFF #Same files give the same image
+        entries = self.buildFAT()
+        fat = struct.pack("<" + str(len(entries)) + "I", *entries)
+        partition = self.partitionStart
+        with atomicFile(filename, "wb") as image:
+            image.file.truncate(self.imageSize)
+            for offset, data in [(0, self.masterBootRecord(volumeID)), (partition, self.bootSector(volumeID)), (partition + self.sectorSize, self.fsInfoSector(entries)),
+                                 (partition + 6 * self.sectorSize, self.bootSector(volumeID)), (partition + 7 * self.sectorSize, self.fsInfoSector(entries))]:
+                image.file.seek(offset)
+                image.file.write(data)
+            for copy in range(self.numberOfFATs):
+                image.file.seek(partition + (self.reservedSectors + copy * self.fatSectors) * self.sectorSize)
+                image.file.write(fat)
+            for cluster, data in writes:
+                image.file.seek(self.dataStart + (cluster - 2) * self.clusterSize)
+                image.file.write(data)
+
+def createSDCardImage(bootFolder, imageFile):
+    """
+    Creates an SD card image from a folder of boot files, as they are (including its cmdline.txt).
+    """
+    image = fatImage()
+    image.addFolder(bootFolder)
+    image.write(imageFile)
+    print(_("SD card image created at") + " " + imageFile)
+
+def createSDCardImages(bootFolder, outputFolder, kinds, addresses):
+    """
+    Creates an SD card image for every server IP address and network technology (NBD and/or NFS, made from cmdlineNBD.txt or cmdlineNFS.txt) in one go.
+    The boot files are read and laid out once, only cmdline.txt changes between images. Images are named pinetSDImage-<technology>-<IP address>.img.
+    """
+    image = fatImage()
+    image.addFolder(bootFolder)
+    templates = {}
+    for kind in kinds:
+        with open(os.path.join(bootFolder, "cmdline" + kind + ".txt"), "rb") as template:
+            templates[kind] = template.read()
+    reserve = max(len(template) for template in templates.values()) + 64 #Room for the longest IP address
+    makeFolder(outputFolder)
+    for kind in kinds:
+        for address in addresses:
+            image.setFile("cmdline.txt", templates[kind].replace(b"1.1.1.1", address.encode("ascii")), reserve = reserve)
+            imageFile = os.path.join(outputFolder, "pinetSDImage-" + kind + "-" + address + ".img")
+            image.write(imageFile)
+            print(_("SD card image created at") + " " + imageFile)
+
+def syncDirectory(source, target, keep = ()):
+    """
+    Updates target in place to be a copy of source. Only files which differ are written (each one atomically) and anything not in source is removed.
+    Names in keep (at the top level) are skipped in both, so a target's own files like cmdline.txt are left alone.
+    Returns (and passes to returnData) the number of files added, changed or removed.
+    """
+    import filecmp
+    changed = 0
+    makeFolder(target)
+    for folder, dirs, files in os.walk(source):
+        relative = os.path.relpath(folder, source)
+        targetFolder = os.path.normpath(os.path.join(target, relative))
+        skip = set([".git"])
+        if relative == ".":
+            skip.update(keep)
+        links = [name for name in dirs if os.path.islink(os.path.join(folder, name))] #os.walk lists links to folders as folders
+        dirs[:] = [name for name in dirs if not name in skip and not name in links]
+        files = [name for name in files + links if not name in skip]
+        for name in dirs:
+            if os.path.lexists(os.path.join(targetFolder, name)) and (os.path.islink(os.path.join(targetFolder, name)) or not os.path.isdir(os.path.join(targetFolder, name))):
+                removeFile(os.path.join(targetFolder, name), quiet = False)
+                changed = changed + 1
+            makeFolder(os.path.join(targetFolder, name))
+        for name in files:
+            sourceFile = os.path.join(folder, name)
+            targetFile = os.path.join(targetFolder, name)
+            if os.path.islink(sourceFile):
+                if os.path.islink(targetFile) and os.readlink(targetFile) == os.readlink(sourceFile):
+                    continue
+                if os.path.lexists(targetFile):
+                    removeFile(targetFile, quiet = False)
+                os.symlink(os.readlink(sourceFile), targetFile)
+            else:
+                if os.path.isfile(targetFile) and not os.path.islink(targetFile) and filecmp.cmp(sourceFile, targetFile, shallow=False):
+                    continue
+                if os.path.lexists(targetFile) and (os.path.islink(targetFile) or os.path.isdir(targetFile)):
+                    removeFile(targetFile, quiet = False)
+                with open(sourceFile, "rb") as original:
+                    with atomicFile(targetFile, "wb") as copy:
+                        shutil.copyfileobj(original, copy, 1048576)
+                shutil.copymode(sourceFile, targetFile)
+            changed = changed + 1
+        for name in os.listdir(targetFolder):
+            if not name in files and not name in dirs and not name in skip:
+                removeFile(os.path.join(targetFolder, name), quiet = False)
+                changed = changed + 1
+    returnData(changed)
+    return changed
+
+def fileFingerprint(path, info):
+    """
+    Returns the parts of a file's lstat info which matter to the NBD image, plus the link target for symlinks.
+    """
+    import stat
+    fingerprint = [info.st_mode, info.st_uid, info.st_gid]
+    if stat.S_ISREG(info.st_mode):
+        fingerprint.extend([info.st_size, info.st_mtime_ns, info.st_ino])
+    elif stat.S_ISLNK(info.st_mode):
+        fingerprint.append(os.readlink(path))
+    return fingerprint
+
+def hashFile(path, folderFd = None):
+    """
+    Returns the sha256 of a file. With folderFd, path is opened relative to that folder without following a symlink.
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    if folderFd is not None:
+        file = os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=folderFd), "rb")
+    else:
+        file = open(path, "rb")
+    with file:
+        for chunk in iter(lambda: file.read(1048576), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def writeBootManifest(folder, manifestName = "manifest.sha256"):
+    """
+    Writes a sha256sum style hash list of every file in a boot files folder (except cmdline.txt and the list itself) for kernelCheckUpdate.sh on the Raspberry Pis.
+    The list is only rewritten if it changed. Returns (and passes to returnData) 1 if it changed, otherwise 0.
+    """
+    lines = []
+    for folderPath, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            relativePath = os.path.relpath(os.path.join(folderPath, name), folder)
+            if relativePath in ("cmdline.txt", manifestName):
+                continue
+            lines.append(hashFile(os.path.join(folderPath, name)) + "  ./" + relativePath)
+    manifest = "\n".join(lines) + "\n"
+    manifestPath = os.path.join(folder, manifestName)
+    try:
+        with open(manifestPath) as current:
+            if current.read() == manifest:
+                returnData(0)
+                return 0
+    except (OSError, IOError):
+        pass
+    writeFileAtomic(manifestPath, manifest)
+    returnData(1)
+    return 1
+
+def iterImageTree(root):
+    """
+    Generator going through every file and folder in a chroot, yielding (relative path, full path, lstat info).
+    Folders ltsp-update-image doesn't need (proc, sys, dev, run and tmp) are skipped.
+    """
+    skip = set(["proc", "sys", "dev", "run", "tmp"])
+    for folder, dirs, files in os.walk(root):
+        relativeFolder = os.path.relpath(folder, root)
+        if relativeFolder == ".":
+            dirs[:] = [name for name in dirs if not name in skip]
+            relativeFolder = ""
+        for name in dirs + files:
+            fullPath = os.path.join(folder, name)
+            try:
+                yield os.path.join(relativeFolder, name), fullPath, os.lstat(fullPath)
+            except OSError:
+                continue
+
+def alwaysHashed(relativePath):
+    """
+    Files under etc and usr/local always get a content hash in the image manifest. They are small and the most likely to be rewritten with the same contents.
+    """
+    return relativePath.startswith("etc/") or relativePath.startswith("usr/local/")
+
+def fingerprintImage(root, previous = None):
+    """
+    Builds the image manifest of a chroot, a dict of relative path to [fingerprint, sha256 or None].
+    Hashes are worked out for files under etc and usr/local, for files which had a hash before, and for files which have changed since the previous manifest,
+    so a file gains a hash the first time it is seen to change. The old hash is reused if the file is untouched.
+    """
+    import stat
+    previous = previous or {}
+    manifest = {}
+    for relativePath, fullPath, info in iterImageTree(root):
+        fingerprint = fileFingerprint(fullPath, info)
+        digest = None
+        if stat.S_ISREG(info.st_mode):
+            old = previous.get(relativePath)
+            if old is not None and old[0] == fingerprint and old[1] is not None:
+                digest = old[1]
+            elif alwaysHashed(relativePath) or (old is not None and (old[1] is not None or old[0] != fingerprint)):
+                try:
+                    digest = hashFile(fullPath)
+                except (OSError, IOError):
+                    digest = None
+        manifest[relativePath] = [fingerprint, digest]
+    return manifest
+
+def imageChange(root, manifest):
+    """
+    Compares a chroot against its image manifest. Returns a description of the first change found, or None if nothing has changed.
+    Files whose details changed but have a hash in the manifest only count as changed if their contents differ.
+    """
+    import stat
+    seen = 0
+    for relativePath, fullPath, info in iterImageTree(root):
+        old = manifest.get(relativePath)
+        if old is None:
+            return _("Added") + " /" + relativePath
+        seen = seen + 1
+        fingerprint = fileFingerprint(fullPath, info)
+        if fingerprint == old[0]:
+            continue
+        if stat.S_ISREG(info.st_mode) and old[1] is not None and fingerprint[0:3] == old[0][0:3] and fingerprint[3] == old[0][3]:
+            try:
+                if hashFile(fullPath) == old[1]:
+                    continue
+            except (OSError, IOError):
+                pass
+        return _("Changed") + " /" + relativePath
+    if seen != len(manifest):
+        return _("Files removed")
+    return None
+
+def loadImageManifest():
+    import json
+    try:
+        with open(ImageManifest) as manifestFile:
+            return json.load(manifestFile)
+    except (OSError, IOError, ValueError):
+        return None
+
+def saveImageManifest(manifest):
+    import json
+    makeFolder(os.path.dirname(ImageManifest))
+    writeFileAtomic(ImageManifest, json.dumps(manifest, separators=(",", ":")))
+
+def imageBuildSettings():
+    """
+    Returns the mksquashfs compressor, block size and number of processors to use from /etc/pinet (ImageCompressor, ImageBlockSize and ImageProcessors).
+    Defaults are the mksquashfs defaults (gzip, 128KB blocks) with every core.
+    """
+    config = getConfig()
+    compressor = config.get("ImageCompressor", "gzip")
+    blockSize = config.get("ImageBlockSize", "131072")
+    processors = config.get("ImageProcessors", str(os.cpu_count() or 1))
+    return compressor, blockSize, processors
+
+def mksquashfsCommand(root, image, compressor, blockSize, processors):
+    """
+    Returns the mksquashfs command to compress a chroot into an image, leaving out the same files as ltsp-update-image.
+    """
+    command = ["mksquashfs", root, image, "-noappend", "-comp", compressor, "-b", str(blockSize), "-processors", str(processors)]
+    for excludes in ["/etc/ltsp/ltsp-update-image.excludes", "/usr/share/ltsp/ltsp-update-image.excludes"]:
+        if os.path.isfile(excludes):
+            return command + ["-wildcards", "-ef", excludes]
+    return command + ["-wildcards", "-e", "proc/*", "sys/*", "dev/*", "run/*", "tmp/*"]
+
+def runMksquashfs(command, progress = None):
+    """
+    Runs mksquashfs on a pseudo terminal (it only draws its progress bar on one), calling progress(percent) as the bar moves.
+    Returns the exit code.
+    """
+    import pty, re, fcntl, termios, struct
+    from subprocess import DEVNULL
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", 24, 120, 0, 0))
+    process = Popen(command, stdin=DEVNULL, stdout=slave, stderr=slave)
+    os.close(slave)
+    percentPattern = re.compile(rb"\d+/\d+\s+(\d+)%")
+    recent = b""
+    lastPercent = None
+    while True:
+        try:
+            data = os.read(master, 4096)
+        except OSError: #EIO once mksquashfs has finished
+            break
+        if not data:
+            break
+        recent = (recent + data)[-512:]
+        found = percentPattern.findall(recent)
+        if found and progress is not None and int(found[-1]) != lastPercent:
+            lastPercent = int(found[-1])
+            progress(lastPercent)
+    os.close(master)
+    return process.wait()
 
-    textfile = getList(file)
-    unfound = True
-    for i in range(0,len(textfile)):
-        found = textfile[i].find(string)
-        #print("Searching line number " + str(i) + ". Found status is " + str(found))
-        #print(textfile[i])
-        #print("")
-        if (found != -1):
-            unfound = False
+def loadImageBuildStatus():
+    import json
+    try:
+        with open(ImageBuildStatus) as statusFile:
+            return json.load(statusFile)
+    except (OSError, IOError, ValueError):
+        return {}
 
-    if unfound:
-        returnData(0)
-    else:
-        returnData(1)
+def saveImageBuildStatus(status):
+    import json
+    makeFolder(os.path.dirname(ImageBuildStatus))
+    writeFileAtomic(ImageBuildStatus, json.dumps(status))
 
-def savePickled(toSave, path = "/tmp/pinetSoftware.dump"):
+def imageBuildRunning(status = None):
     """
-    Saves list of softwarePackage objects.
+    Returns True if an image build is in progress, checking its process is still alive in case it was killed.
     """
-    import pickle
-    with open(path, "wb") as output:
-        pickle.dump(toSave, output, pickle.HIGHEST_PROTOCOL)
+    if status is None:
+        status = loadImageBuildStatus()
+    pid = status.get("pid") or 0
+    if status.get("state") != "building" or pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        import errno
+        return error.errno == errno.EPERM
+    return True
 
-def loadPickled(path= "/tmp/pinetSoftware.dump", deleteAfter = True):
+def buildImage(root = "/opt/ltsp/armhf"):
     """
-    Loads list of softwarePackage objects ready to be used.
+    Compresses the NBD image with mksquashfs using every core, keeping ImageBuildStatus up to date with the percentage done and time left.
+    Started in the background by nbdRebuild(). The new image is written next to the old one and only moved into place once finished, so Raspberry Pis can keep booting while it runs.
+    Requests made while compressing (see ImageBuildQueued) are picked up by compressing again at the end.
     """
-    import pickle
+    import fcntl
+    makeFolder(os.path.dirname(ImageBuildStatus))
+    lock = open(ImageBuildStatus + ".lock", "w")
     try:
-        with open(path, "rb") as input:
-            obj = pickle.load(input)
-        if deleteAfter:
-            removeFile(path)
-        return obj
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except (OSError, IOError):
-        if deleteAfter:
-            removeFile(path)
-        return []
+        return #Another build is already running and will see the queued request
+    image = os.path.join(os.path.dirname(root), "images", os.path.basename(root) + ".img")
+    compressor, blockSize, processors = imageBuildSettings()
+    while True:
+        removeFile(ImageBuildQueued)
+        newManifest = fingerprintImage(root, loadImageManifest()) #Taken before compressing, so anything changed during compression is picked up next time
+        status = {"state": "building", "pid": os.getpid(), "started": time.time(), "percent": 0, "eta": None, "compressor": compressor, "blockSize": blockSize}
+        saveImageBuildStatus(status)
+        lastSaved = [0]
+        def progress(percent):
+            status["percent"] = percent
+            elapsed = time.time() - status["started"]
+            if percent > 0:
+                status["eta"] = int(elapsed * (100 - percent) / percent)
+            if time.time() - lastSaved[0] >= 1 or percent == 100:
+                saveImageBuildStatus(status)
+                lastSaved[0] = time.time()
+        if shutil.which("mksquashfs") is None:
+            result = runBash(["ltsp-update-image", root]) #No progress available, but still in the background
+        else:
+            makeFolder(os.path.dirname(image))
+            result = runMksquashfs(mksquashfsCommand(root, image + ".tmp", compressor, blockSize, processors), progress)
+            if result == 0:
+                if os.path.exists(image):
+                    os.replace(image, image + ".old") #Raspberry Pis already booted keep using the old copy until they reboot
+                os.replace(image + ".tmp", image)
+            else:
+                removeFile(image + ".tmp")
+        status.update({"pid": None, "finished": time.time(), "duration": int(time.time() - status["started"]), "eta": None})
+        if result == 0:
+            saveImageManifest(newManifest)
+            setConfigParameter("NBDBuildNeeded", "false")
+            status.update({"state": "done", "percent": 100})
+        else:
+            setConfigParameter("NBDBuildNeeded", "true")
+            status["state"] = "failed"
+        saveImageBuildStatus(status)
+        if not os.path.exists(ImageBuildQueued) or imageChange(root, loadImageManifest() or {}) is None:
+            break
+    removeFile(ImageBuildQueued)
+    lock.close()
 
-def installEpoptes():
+def waitForImageBuild():
     """
-    Install Epoptes classroom management software. Key is making sure groups are correct.
-    :return:
+    Waits for a background image build (including any rebuilds queued behind it) to finish, showing its progress. Used before rebooting, which would kill it.
+    buildImage() holds its lock for as long as it runs, so once the lock can be taken the build is over.
     """
-    runBash("apt-get install -y epoptes")
-    runBash("gpasswd -a root staff")
-    runBash("ltsp-chroot --arch armhf apt-get install -y epoptes-client --no-install-recommends")
-    runBash("ltsp-chroot --arch armhf epoptes-client -c")
-    replaceLineOrAdd("/etc/default/epoptes", "SOCKET_GROUP", "SOCKET_GROUP=teacher")
+    import fcntl
+    makeFolder(os.path.dirname(ImageBuildStatus))
+    with open(ImageBuildStatus + ".lock", "a") as lock:
+        lastPercent = None
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except (OSError, IOError):
+                pass
+            if lastPercent is None:
+                print(_("Waiting for the NBD image compression to finish"))
+            percent = loadImageBuildStatus().get("percent", 0)
+            if percent != lastPercent:
+                print(str(percent) + "%")
+                lastPercent = percent
+            time.sleep(2)
 
-def installScratchGPIO():
+def nbdRebuild(force = False, root = "/opt/ltsp/armhf", wait = False):
     """
-    ScratchGPIO installation process. Includes creating the desktop icon in all users and /etc/skel
+    Starts recompressing the NBD image in the background (see buildImage()), unless the chroot is unchanged since the last build (see ImageManifest).
+    Pass force as True (or "force") to always rebuild. If a build is already running, another is queued to start once it finishes.
+    Pass wait as True to wait for the build to finish, for when the server is about to be rebooted.
     """
-    removeFile("/tmp/isgh7.sh")
-    removeFile("/opt/ltsp/armhf/usr/local/bin/isgh5.sh")
-    removeFile("/opt/ltsp/armhf/usr/local/bin/scratchSudo.sh")
-    removeFile("/opt/ltsp/armhf/usr/local/bin/isgh7.sh")
-    downloadFile("http://bit.ly/1wxrqdp", "/tmp/isgh7.sh")
-    copyFile("/tmp/isgh7.sh", "/opt/ltsp/armhf/usr/local/bin/isgh7.sh")
-    replaceLineOrAdd("/opt/ltsp/armhf/usr/local/bin/scratchSudo.sh", "bash /usr/local/bin/isgh7.sh $SUDO_USER", "bash /usr/local/bin/isgh7.sh $SUDO_USER")
-    users = getUsers()
-    for u in users:
-        createTextFile("/home/" + u + "/Desktop/Install-scratchGPIO.desktop", """
-        [Desktop Entry]
-        Version=1.0
-        Name=Install ScratchGPIO
-        Comment=Install ScratchGPIO
-        Exec=sudo bash /usr/local/bin/scratchSudo.sh
-        Icon=scratch
-        Terminal=true
-        Type=Application
-        Categories=Utility;Application;
-        """)
-        os.chown("/home/" + u + "/Desktop/Install-scratchGPIO.desktop", pwd.getpwnam(u).pw_uid, grp.getgrnam(u).gr_gid)
-    makeFolder("/etc/skel/Desktop")
-    createTextFile("/etc/skel/Desktop/Install-scratchGPIO.desktop",
-    """[Desktop Entry]
-    Version=1.0
-    Name=Install ScratchGPIO
-    Comment=Install ScratchGPIO
-    Exec=sudo bash /usr/local/bin/scratchSudo.sh
-    Icon=scratch
-    Terminal=true
-    Type=Application
-    Categories=Utility;Application;""")
+    if force == "force":
+        force = True
+    manifest = loadImageManifest()
+    if not force and manifest is not None and os.path.exists("/opt/ltsp/images/armhf.img"):
+        print(_("Checking for changes to the Raspbian image"))
+        change = imageChange(root, manifest)
+        if change is None:
+            print(_("No changes since the image was last compressed, skipping compression"))
+            if not imageBuildRunning():
+                setConfigParameter("NBDBuildNeeded", "false")
+            if wait:
+                waitForImageBuild()
+            returnData(0)
+            return
+        print(change)
+    if imageBuildRunning():
+        createTextFile(ImageBuildQueued, "")
+        print(_("The image is already being compressed, it will be compressed again once finished"))
+        if wait:
+            waitForImageBuild()
+        returnData(0)
+        return
+    from subprocess import DEVNULL
+    build = Popen([sys.executable, os.path.abspath(__file__), "buildImage", root], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+    if wait:
+        while build.poll() is None and loadImageBuildStatus().get("pid") != build.pid:
+            time.sleep(0.5) #Until it has its lock, otherwise waitForImageBuild() could take the lock first and stop it starting
+        waitForImageBuild()
+        returnData(0)
+        return
+    print("--------------------------------------------------------")
+    print(_("Compressing the image in the background, progress is shown in System-Status"))
+    print("--------------------------------------------------------")
+    returnData(0)
 
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return str(seconds) + "s"
+    if seconds < 3600:
+        return str(seconds // 60) + "m " + str(seconds % 60) + "s"
+    return str(seconds // 3600) + "h " + str((seconds % 3600) // 60) + "m"
 
-def installSoftwareList(holdOffInstall = False):
+def imageBuildStatus():
     """
-    Replacement for ExtraSoftware function in bash.
-    Builds a list of possible software to install (using softwarePackage class) then displays the list using checkbox Whiptail menu.
-    Checks what options the user has collected, then saves the packages list to file (using pickle). If holdOffInstall is False, then runs installSoftwareFromFile().
+    Returns (via returnData) a one line description of the NBD image build, for listStatus.
     """
-    software = []
-    software.append(softwarePackage("Libreoffice", _("A free office suite, similar to Microsoft office"), "script", ["apt-get purge -y openjdk-6-jre-headless openjdk-7-jre-headless ca-certificates-java", "apt-get install -y libreoffice gcj-4.7-jre gcj-jre gcj-jre-headless libgcj13-awt"]))
-    software.append(softwarePackage("Arduino-IDE", _("Programming environment for Arduino microcontrollers"), "apt", ["arduino",]))
-    software.append(softwarePackage("Scratch-gpio", _("A special version of scratch for GPIO work") , "scratchGPIO", ["",]))
-    #software.append(softwarePackage("Python-hardware", _("Python libraries for a number of additional addon boards"), "pip", ["pibrella skywriter unicornhat piglow pianohat explorerhat microstacknode twython"]))
-    software.append(softwarePackage("Epoptes", _("Free and open source classroom management software"), "epoptes", ["",]))
-    software.append(softwarePackage("BlueJ", _("A Java IDE for developing programs quickly and easily"), "script", ["rm -rf /tmp/bluej-314a.deb", "rm -rf /opt/ltsp/armhf/tmp/bluej-314a.deb", "wget http://bluej.org/download/files/bluej-314a.deb -O /tmp/bluej-314a.deb", "dpkg -i /tmp/bluej-314a.deb"]))
-    software.append(softwarePackage("Custom-package", _("Allows you to enter the name of a package from Raspbian repository"), "customApt", ["",]))
-    software.append(softwarePackage("Custom-python", _("Allows you to enter the name of a Python library from pip."), "customPip", ["",]))
-    softwareList = []
-    for i in software:
-        softwareList.append([i.name, i.description])
-    done = False
-    if (shutil.get_terminal_size()[0] < 105) or (shutil.get_terminal_size()[0] < 30):
-        print("\x1b[8;30;105t")
-        time.sleep(0.05)
-        #print("Resizing")
-    while done == False:
-        whiptailBox("msgbox", _("Additional Software"), _("In the next window you can select additional software you wish to install. Use space bar to select applications and hit enter when you are finished."), False)
-        result = (whiptailCheckList(_("Extra Software Submenu"), _("Select any software you want to install. Use space bar to select then enter to continue."), softwareList))
-        try:
-            result = result.decode("utf-8")
-        except AttributeError:
-            return
-        result = result.replace('"', '')
-        if result != "Cancel":
-            if result == "":
-                yesno = whiptailBox("yesno", _("Are you sure?"), _("Are you sure you don't want to install any additional software?"), True)
-                if yesno:
-                    savePickled(software)
-                    done = True
-            else:
-                resultList = result.split(" ")
-                yesno = whiptailBox("yesno", _("Are you sure?"), _("Are you sure you want to install this software?") + " \n" + (result.replace(" ", "\n")), True, height=str(7+len(result.split(" "))))
-                if yesno:
-                    for i in software:
-                        if i.name in resultList:
-                            i.customAptPip()
-                            #i.marked = True
-                    done = True
-                    savePickled(software)
+    returnData(imageBuildStatusText())
 
-    if holdOffInstall == False:
-        installSoftwareFromFile()
+def imageBuildStatusText():
+    status = loadImageBuildStatus()
+    state = status.get("state")
+    if state == "building" and imageBuildRunning(status):
+        text = _("Compressing") + " - " + str(status.get("percent", 0)) + "%"
+        if status.get("eta") is not None:
+            text = text + " (" + _("about") + " " + formatDuration(status["eta"]) + " " + _("left") + ")"
+    elif state == "building":
+        text = _("Compression was interrupted")
+    elif state == "done":
+        text = _("Compressed") + " " + time.strftime("%Y-%m-%d %H:%M", time.localtime(status["finished"])) + " " + _("in") + " " + formatDuration(status["duration"]) + " (" + status.get("compressor", "") + ")"
+    elif state == "failed":
+        text = _("Compression failed") + " " + time.strftime("%Y-%m-%d %H:%M", time.localtime(status["finished"]))
+    else:
+        text = _("Not compressed by this version of PiNet yet")
+    return text
 
-def installSoftwareFromFile(packages = None):
+def availableCompressors():
     """
-    Second part of installSoftwareList().
-    Loads the pickle encoded list of softwarePackage objects then if they are marked to be installed, installs then.
+    Returns the compressors the installed mksquashfs supports, from its help text.
     """
-    needCompress = False
-    if packages == None:
-        packages = loadPickled()
-    for i in packages:
-        if i.marked == True:
-            print(_("Installing") + " " + str(i.name))
-            if needCompress == False:
-                ltspChroot("apt-get update")
-            i.installPackage()
-            i.marked = False
-            setConfigParameter("NBDBuildNeeded", "true")
-            needCompress = True
-        else:
-            debug("Not installing " + str(i.name))
-    if needCompress:
-        nbdRun()
-
+    import re
+    try:
+        output = Popen(["mksquashfs", "-help"], stdout=PIPE, stderr=PIPE).communicate()
+    except OSError:
+        return []
+    text = (output[0] + output[1]).decode("utf-8", "replace")
+    if "Compressors available" in text:
+        text = text.split("Compressors available", 1)[1]
+    return re.findall(r"^\t(\w+)(?: \(default\))?\s*$", text, re.MULTILINE)
 
+def measureReadThroughput(image, sampleFiles):
+    """
+    Mounts a squashfs image and reads a sample of files from it with an empty page cache, as a Raspberry Pi would when loading programs.
+    Returns the bytes read per second, or None if the image couldn't be mounted.
+    """
+    import tempfile
+    mountPoint = tempfile.mkdtemp(prefix="pinet-benchmark-")
+    try:
+        if runBash(["mount", "-t", "squashfs", "-o", "loop,ro", image, mountPoint]) != 0:
+            return None
+        try:
+            try:
+                with open("/proc/sys/vm/drop_caches", "w") as dropCaches:
+                    dropCaches.write("3\n")
+            except (OSError, IOError):
+                pass
+            bytesRead = 0
+            start = time.time()
+            for relativePath in sampleFiles:
+                try:
+                    with open(os.path.join(mountPoint, relativePath), "rb") as sample:
+                        for chunk in iter(lambda: sample.read(1048576), b""):
+                            bytesRead = bytesRead + len(chunk)
+                except (OSError, IOError):
+                    continue
+            return bytesRead / max(time.time() - start, 0.001)
+        finally:
+            runBash(["umount", mountPoint])
+    finally:
+        os.rmdir(mountPoint)
 
+def benchmarkCompression(root = "/opt/ltsp/armhf", outputFolder = "/var/tmp/pinet-benchmark", sampleSize = 500):
+    """
+    Compresses the real chroot with each compressor mksquashfs supports, reporting build time, image size and random read throughput for a sample of files.
+    The results are also saved to CompressionBenchmark. Only one test image exists at a time, so it needs about as much free space as the current image.
+    Read speeds are measured on the server, so compare them with each other rather than with a Raspberry Pi.
+    """
+    import stat
+    preferred = ["gzip", "lzo", "lz4", "xz", "zstd", "lzma"]
+    supported = availableCompressors()
+    compressors = [name for name in preferred if name in supported] + [name for name in supported if not name in preferred]
+    if not compressors:
+        print(_("mksquashfs isn't installed, can't benchmark compression"))
+        return
+    regularFiles = [relativePath for relativePath, fullPath, info in iterImageTree(root) if stat.S_ISREG(info.st_mode) and info.st_size > 0]
+    sampleFiles = random.Random(0).sample(regularFiles, min(sampleSize, len(regularFiles))) #Same files for every compressor
+    blockSize, processors = imageBuildSettings()[1:]
+    makeFolder(outputFolder)
+    results = []
+    for compressor in compressors:
+        image = os.path.join(outputFolder, compressor + ".img")
+        print(_("Compressing with") + " " + compressor + "...")
+        start = time.time()
+        result = runMksquashfs(mksquashfsCommand(root, image, compressor, blockSize, processors), lambda percent: print("\r" + str(percent) + "%", end="", flush=True))
+        duration = time.time() - start
+        print("")
+        if result != 0:
+            results.append((compressor, None, None, None))
+            removeFile(image)
+            continue
+        size = os.path.getsize(image)
+        throughput = measureReadThroughput(image, sampleFiles)
+        removeFile(image)
+        results.append((compressor, duration, size, throughput))
+    megabyte = 1024 * 1024
+    lines = [_("Block size") + " " + str(blockSize) + ", " + str(processors) + " " + _("processors") + ", " + str(len(sampleFiles)) + " " + _("files read"),
+             "%-8s %12s %12s %14s" % (_("Method"), _("Build time"), _("Size"), _("Read speed"))]
+    for compressor, duration, size, throughput in results:
+        if duration is None:
+            lines.append("%-8s %12s" % (compressor, _("failed")))
+            continue
+        speed = "n/a" if throughput is None else str(int(throughput / megabyte)) + "MB/s"
+        lines.append("%-8s %12s %12s %14s" % (compressor, formatDuration(duration), str(size // megabyte) + "MB", speed))
+    lines.append(_("Set ImageCompressor and ImageBlockSize in /etc/pinet to change how the image is compressed"))
+    print("\n".join(lines))
+    makeFolder(os.path.dirname(CompressionBenchmark))
+    writeFileAtomic(CompressionBenchmark, "\n".join(lines) + "\n")
 
 def nbdRun():
     """
-    Runs NBD compression tool. Clone of version in main pinet script
+    Runs NBD compression tool. Clone of version in main pinet script.
+    When called from within a pinet session the request is handed back to pinet instead, which runs one compression once the current menu option has finished.
     """
+    session = os.environ.get("PINET_SESSION")
+    if session:
+        setConfigParameter("NBDBuildNeeded", "true")
+        createTextFile("/tmp/pinetNBDRun." + session, "")
+        return
     if getConfigParameter("/etc/pinet", "NBD=") == "true":
         if getConfigParameter("/etc/pinet", "NBDuse=") == "true":
-            print("--------------------------------------------------------")
-            print(_("Compressing the image, this will take roughly 5 minutes"))
-            print("--------------------------------------------------------")
-            runBash("ltsp-update-image /opt/ltsp/armhf")
-            setConfigParameter("NBDBuildNeeded", "false")
+            nbdRebuild()
         else:
             whiptailBox("msgbox", _("WARNING"), _("Auto NBD compressing is disabled, for your changes to push to the Raspberry Pis, run NBD-recompress from main menu."), False)
 
@@ -1207,51 +5315,701 @@ def askExtraStatsInfo():
     sendStats()
 
 
-#------------------------------Main program-------------------------
+#------------------------------System status-------------------------
 
-if len(sys.argv) == 1:
-    print(_("This python script does nothing on its own, it must be passed stuff"))
-else:
-    getReleaseChannel()
-    if sys.argv[1] == "replaceLineOrAdd":
-        replaceLineOrAdd(sys.argv[2], sys.argv[3], sys.argv[4])
-    elif sys.argv[1] == "replaceBitOrAdd":
-        replaceBitOrAdd(sys.argv[2], sys.argv[3], sys.argv[4])
-    elif sys.argv[1] == "CheckInternet":
-        internet_on(sys.argv[2])
-    elif sys.argv[1] == "CheckUpdate":
-        checkUpdate(sys.argv[2])
-    elif sys.argv[1] == "CompareVersion":
-        compareVersions(sys.argv[2], sys.argv[3])
-    elif sys.argv[1] == "updatePiNet":
+def readCPUTimes(stat = "/proc/stat"):
+    """
+    Returns (busy, total) CPU time across all cores from the first line of /proc/stat.
+    Usage is the change in busy divided by the change in total between two readings.
+    """
+    with open(stat) as statFile:
+        fields = [int(field) for field in statFile.readline().split()[1:9]] #guest time is already included in user
+    total = sum(fields)
+    return total - fields[3] - fields[4], total #idle and iowait
+
+def readMemoryUsage(meminfo = "/proc/meminfo"):
+    """
+    Returns (used, total) memory in kB. Like free, it counts memory the kernel can reclaim (the page cache) as free.
+    """
+    values = {}
+    with open(meminfo) as memFile:
+        for line in memFile:
+            name, value = line.split(":", 1)
+            values[name] = int(value.split()[0])
+    total = values.get("MemTotal", 0)
+    available = values.get("MemAvailable")
+    if available is None: #Kernels before 3.14
+        available = values.get("MemFree", 0) + values.get("Buffers", 0) + values.get("Cached", 0)
+    return total - available, total
+
+def readDiskUsage(path = "/"):
+    """
+    Returns (total, used, free) bytes for the filesystem holding path, worked out the same way as df.
+    """
+    info = os.statvfs(path)
+    return info.f_blocks * info.f_frsize, (info.f_blocks - info.f_bfree) * info.f_frsize, info.f_bavail * info.f_frsize
+
+def readIPAddresses(fibTrie = "/proc/net/fib_trie"):
+    """
+    Returns the IPv4 addresses of the server, other than loopback, from the kernel's routing tables.
+    """
+    addresses = []
+    address = None
+    try:
+        with open(fibTrie) as trieFile:
+            for line in trieFile:
+                fields = line.split()
+                if fields[:1] == ["|--"]:
+                    address = fields[1]
+                elif fields[:3] == ["/32", "host", "LOCAL"] and not address.startswith("127.") and not address in addresses:
+                    addresses.append(address)
+    except (OSError, IOError):
+        pass
+    return addresses
+
+def decodeProcAddress(text):
+    """
+    Turns an address from /proc/net/tcp or /proc/net/tcp6 (for example "0100007F:0016") into an (ip, port) tuple.
+    """
+    import socket, struct
+    address, port = text.split(":")
+    if len(address) == 8:
+        ip = socket.inet_ntop(socket.AF_INET, struct.pack("<I", int(address, 16)))
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, b"".join(struct.pack("<I", int(address[i:i + 8], 16)) for i in range(0, 32, 8)))
+        if ip.startswith("::ffff:") and "." in ip:
+            ip = ip[7:]
+    return ip, int(port, 16)
+
+def readTCPConnections(localPort = None, tables = ("/proc/net/tcp", "/proc/net/tcp6")):
+    """
+    Returns a list of (remote ip, remote port, socket inode) for each established TCP connection to localPort, or to any port if localPort is None.
+    """
+    connections = []
+    for table in tables:
+        try:
+            with open(table) as tableFile:
+                next(tableFile)
+                for line in tableFile:
+                    fields = line.split()
+                    if fields[3] == "01" and (localPort is None or int(fields[1].rsplit(":", 1)[1], 16) == localPort):
+                        ip, port = decodeProcAddress(fields[2])
+                        connections.append((ip, port, fields[9]))
+        except (OSError, IOError, StopIteration):
+            pass
+    return connections
+
+def readProcesses(commands):
+    """
+    Returns a dict of pid to (name, process title, set of socket inodes, list of open files) for the running processes whose name is in commands.
+    Only those processes have their open files looked through, so this is cheap enough to run every sample.
+    """
+    processes = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/" + pid + "/comm") as commFile:
+                name = commFile.read().strip()
+            if not name in commands:
+                continue
+            with open("/proc/" + pid + "/cmdline", "rb") as cmdlineFile:
+                title = cmdlineFile.read().replace(b"\0", b" ").decode("utf-8", "replace").strip()
+            sockets = set()
+            files = []
+            fdFolder = "/proc/" + pid + "/fd"
+            for fd in os.listdir(fdFolder):
+                link = os.readlink(os.path.join(fdFolder, fd))
+                if link.startswith("socket:["):
+                    sockets.add(link[8:-1])
+                elif link.startswith("/"):
+                    files.append(link)
+            processes[int(pid)] = (name, title, sockets, files)
+        except (OSError, IOError):
+            continue #The process has gone, or isn't ours to look at
+    return processes
+
+def sshSessionUser(title):
+    """
+    Returns the user from an sshd process title, or None if nobody has logged in over it yet.
+    sshd sets its title to "sshd: user@tty" (or "sshd: user [priv]") once someone has logged in.
+    """
+    import re
+    match = re.match(r"\S+: ([^\s@\[]+)(?:@| \[priv\])", title)
+    if match is None:
+        return None
+    return match.group(1)
+
+def findSocketUsers(inodes, commands = SSHProcessNames):
+    """
+    Returns a dict of socket inode to the user logged in over it, for the sockets in inodes held by ssh processes.
+    Sockets still logging in are left out.
+    """
+    users = {}
+    for name, title, sockets, files in readProcesses(commands).values():
+        user = sshSessionUser(title)
+        if user is not None:
+            for inode in sockets.intersection(inodes):
+                users[inode] = user
+    return users
+
+def formatSize(size):
+    """
+    Returns a size in bytes in the same short form as df -h, for example 4.2G.
+    """
+    for unit in "BKMGT":
+        if size < 1024 or unit == "T":
+            break
+        size = size / 1024.0
+    if unit == "B" or size >= 10:
+        return str(int(round(size))) + unit
+    return "%.1f%s" % (size, unit)
+
+def sparkline(history, field, width, now, span = StatusHistorySize * StatusInterval):
+    """
+    Draws a percentage field of the status history as width characters covering the last span seconds, oldest on the left.
+    Each character is the average of the samples in its slice of time. Slices with no samples (when System-Status wasn't open) are left blank.
+    """
+    levels = u"▁▂▃▄▅▆▇█"
+    try:
+        levels.encode(sys.stdout.encoding or "ascii")
+    except (UnicodeError, LookupError):
+        levels = "_.-=+*#@"
+    totals = [0.0] * width
+    counts = [0] * width
+    start = now - span
+    for sample in history:
+        if sample[0] > start:
+            bucket = min(width - 1, int((sample[0] - start) * width / span))
+            totals[bucket] += sample[field]
+            counts[bucket] += 1
+    line = ""
+    for total, count in zip(totals, counts):
+        if count == 0:
+            line = line + " "
+        else:
+            line = line + levels[int(max(0, min(100, total / count)) * (len(levels) - 1) / 100 + 0.5)]
+    return line
+
+def loadStatusHistory():
+    """
+    Returns the samples saved by the last System-Status from StatusHistoryFile, leaving out any too old to be drawn.
+    """
+    import json
+    try:
+        with open(StatusHistoryFile) as historyFile:
+            samples = json.load(historyFile)
+    except (OSError, IOError, ValueError):
+        return []
+    oldest = time.time() - StatusHistorySize * StatusInterval
+    return [tuple(sample) for sample in samples if sample[0] > oldest]
+
+def saveStatusHistory(history):
+    import json
+    try:
+        makeFolder(os.path.dirname(StatusHistoryFile))
+        writeFileAtomic(StatusHistoryFile, json.dumps(list(history), separators=(",", ":")))
+    except (OSError, IOError):
+        pass
+
+def fileDate(path):
+    try:
+        return time.strftime("%Y-%m-%d", time.localtime(os.path.getmtime(path)))
+    except OSError:
+        return "-"
+
+def systemStatus(version = "", piBoot = None):
+    """
+    Shows the System-Status dashboard, refreshing every StatusInterval seconds until enter is pressed.
+    Everything is read straight from /proc and statvfs, so a refresh is a handful of small file reads instead of starting top, df, netstat and friends.
+    The last hour of CPU and memory samples is kept in a ring buffer and drawn as sparklines. It is saved to StatusHistoryFile on the way out, so reopening System-Status carries on the same graphs.
+    version is the PiNet version, passed in by pinet.
+    """
+    import select
+    from collections import deque
+    if piBoot is None:
+        piBoot = os.path.join(os.path.expanduser("~" + os.environ.get("SUDO_USER", "")), "PiBoot")
+    nbd = getConfigParameter("/etc/pinet", "NBD=") == "true"
+    epoptes = os.path.exists("/var/lib/dpkg/info/epoptes.list")
+    addresses = " ".join(readIPAddresses())
+    history = deque(loadStatusHistory(), StatusHistorySize)
+    sessionUsers = {}
+    lastCPU = readCPUTimes()
+    time.sleep(0.2) #So the first CPU figure has something to compare with
+    try:
+        while True:
+            now = time.time()
+            cpu = readCPUTimes()
+            cpuPercent = 0.0
+            if cpu[1] > lastCPU[1]:
+                cpuPercent = 100.0 * (cpu[0] - lastCPU[0]) / (cpu[1] - lastCPU[1])
+            lastCPU = cpu
+            memoryUsed, memoryTotal = readMemoryUsage()
+            memoryPercent = 100.0 * memoryUsed / memoryTotal if memoryTotal else 0.0
+            history.append((round(now, 1), round(cpuPercent, 1), round(memoryPercent, 1)))
+            connections = readTCPConnections(22)
+            inodes = set(connection[2] for connection in connections)
+            for inode in list(sessionUsers):
+                if not inode in inodes:
+                    del sessionUsers[inode]
+            unknown = [inode for inode in inodes if not inode in sessionUsers]
+            if unknown:
+                sessionUsers.update(findSocketUsers(unknown))
+            diskTotal, diskUsed, diskFree = readDiskUsage()
+            try:
+                teachers = ",".join(grp.getgrnam("teacher").gr_mem)
+            except KeyError:
+                teachers = ""
+            lines = [
+                "           " + _("PiNet System Status"),
+                "---------------------------------------------------",
+                (_("Current version")).ljust(39) + "- " + str(version),
+                (_("Server IP address")).ljust(39) + "- " + addresses,
+                "---------------------------------------------------",
+                (_("Been running version") + " " + str(version) + " " + _("since")).ljust(39) + "- " + fileDate("/usr/local/bin/pinet"),
+                (_("Piboot folder last updated")).ljust(39) + "- " + fileDate(piBoot),
+                (_("Last system-wide update (update-all)")).ljust(39) + "- " + fileDate("/var/lib/apt/periodic/update-success-stamp")]
+            if nbd:
+                lines.append((_("NBD image")).ljust(39) + "- " + imageBuildStatusText())
+            lines = lines + [
+                "----------------",
+                _("Hard Drive Usage"),
+                "----------------",
+                (_("Total space")).ljust(39) + "- " + formatSize(diskTotal),
+                (_("Used space")).ljust(39) + "- " + formatSize(diskUsed),
+                (_("Free space")).ljust(39) + "- " + formatSize(diskFree),
+                "-----",
+                _("Other"),
+                "-----",
+                (_("CPU usage")).ljust(39) + "- " + str(int(round(cpuPercent))) + "%",
+                (_("RAM usage")).ljust(39) + "- " + str(memoryUsed // 1024) + "MB / " + str(memoryTotal // 1024) + "MB",
+                (_("Epoptes installed")).ljust(39) + "- " + str(epoptes),
+                (_("Teacher members")).ljust(39) + "- " + teachers,
+                "-----------------------",
+                _("Last hour"),
+                "-----------------------",
+                (_("CPU")).ljust(5) + "|" + sparkline(history, 1, 45, now) + "|",
+                (_("RAM")).ljust(5) + "|" + sparkline(history, 2, 45, now) + "|",
+                "-----------------------",
+                _("Current active users"),
+                "-----------------------"]
+            for ip, port, inode in sorted(connections):
+                if inode in sessionUsers:
+                    lines.append(ip + ":" + str(port) + " - " + sessionUsers[inode])
+            lines = lines + ["", _("Hit enter to return to the main menu")]
+            sys.stdout.write("\033[H\033[2J" + "\n".join(lines) + "\n")
+            sys.stdout.flush()
+            if select.select([sys.stdin], [], [], max(0, StatusInterval - (time.time() - now)))[0]:
+                sys.stdin.readline()
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        saveStatusHistory(history)
+
+
+#------------------------------Client inventory-------------------------
+
+def processStartTime(pid):
+    """
+    Returns when a process started, as a Unix timestamp.
+    """
+    with open("/proc/" + str(pid) + "/stat") as statFile:
+        ticks = int(statFile.read().rsplit(")", 1)[1].split()[19]) #starttime, counted after the (name) which can hold spaces
+    bootTime = 0
+    with open("/proc/stat") as kernelStat:
+        for line in kernelStat:
+            if line.startswith("btime "):
+                bootTime = int(line.split()[1])
+                break
+    return bootTime + ticks // os.sysconf("SC_CLK_TCK")
+
+def processBytesWritten(pid):
+    """
+    Returns the bytes a process has written (to files and sockets), from /proc/pid/io.
+    """
+    try:
+        with open("/proc/" + str(pid) + "/io") as ioFile:
+            for line in ioFile:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except (OSError, IOError):
+        pass
+    return 0
+
+def readClientAddresses():
+    """
+    Returns a dict of IP address to (MAC address, hostname) for the machines on the network.
+    DHCP leases (from dnsmasq or the ISC DHCP server, if either runs on the server) give both. The kernel's ARP table fills in the MAC address of anything else, so clients given addresses by another DHCP server are still found.
+    """
+    import re
+    addresses = {}
+    for leases in ClientLeaseFiles:
+        try:
+            with open(leases) as leaseFile:
+                text = leaseFile.read()
+        except (OSError, IOError):
+            continue
+        if leases.endswith(".leases") and "lease " in text: #ISC, later leases for an address replace earlier ones
+            for ip, body in re.findall(r"^lease ([0-9.]+) \{(.*?)^\}", text, re.MULTILINE | re.DOTALL):
+                mac = re.search(r"hardware ethernet ([0-9a-fA-F:]+);", body)
+                hostname = re.search(r'client-hostname "([^"]*)";', body)
+                if mac is not None:
+                    addresses[ip] = (mac.group(1).lower(), hostname.group(1) if hostname is not None else "")
+        else: #dnsmasq, "expiry mac ip hostname clientid"
+            for line in text.splitlines():
+                fields = line.split()
+                if len(fields) >= 4:
+                    addresses[fields[2]] = (fields[1].lower(), "" if fields[3] == "*" else fields[3])
+    try:
+        with open("/proc/net/arp") as arpFile:
+            next(arpFile)
+            for line in arpFile:
+                fields = line.split()
+                if fields[2] != "0x0" and fields[3] != "00:00:00:00:00:00" and not fields[0] in addresses:
+                    addresses[fields[0]] = (fields[3].lower(), "")
+    except (OSError, IOError, StopIteration):
+        pass
+    return addresses
+
+def scanClients():
+    """
+    Returns a dict of IP address to details of each Raspberry Pi connected to the server, found from its NBD (image and swap) and ssh (LDM login) connections.
+    Each has the MAC address and hostname (if known), the logged in sessions as (sshd pid, user, start time), the nbd-server processes sending it the image as (pid, start time, bytes written), and the swap in use.
+    """
+    connections = {}
+    for ip, port, inode in readTCPConnections():
+        connections[inode] = ip
+    addresses = readClientAddresses()
+    clients = {}
+    def client(ip):
+        if not ip in clients:
+            mac, hostname = addresses.get(ip, ("", ""))
+            clients[ip] = {"ip": ip, "mac": mac, "hostname": hostname, "sessions": [], "nbd": [], "swap": 0}
+        return clients[ip]
+    for pid, (name, title, sockets, files) in readProcesses(SSHProcessNames + ("nbd-server",)).items():
+        ips = set(connections[inode] for inode in sockets if inode in connections)
+        try:
+            if name in SSHProcessNames:
+                user = sshSessionUser(title)
+                if user is not None and not " [priv]" in title: #The privileged monitor and its session child hold the same connection, count it once
+                    for ip in ips:
+                        client(ip)["sessions"].append((pid, user, processStartTime(pid)))
+            elif not any(path.startswith(ClientSwapFolder + "/") for path in files):
+                for ip in ips:
+                    client(ip)["nbd"].append((pid, processStartTime(pid), processBytesWritten(pid)))
+            else:
+                for ip in ips:
+                    client(ip)
+        except (OSError, IOError):
+            continue #Ended while being looked at
+    for ip, details in clients.items():
+        try:
+            details["swap"] = os.stat(os.path.join(ClientSwapFolder, ip)).st_blocks * 512 #nbdswapd's file is sparse, so this is what has been swapped out
+        except OSError:
+            pass
+    for ip in [ip for ip, details in clients.items() if not details["sessions"] and not details["nbd"] and not details["swap"]]:
+        del clients[ip] #Some other ssh or nbd connection, not a Raspberry Pi
+    return clients
+
+def openClientInventory(inventory = None):
+    """
+    Opens (creating if needed) the SQLite client inventory.
+    Usage is kept as one samples row a minute for each connected client, with the bytes served in that minute and the swap in use. Rows older than ClientDetailDays are folded into one row an hour in hourly.
+    The counters table holds the bytes each nbd-server process had written at the last sample, so the next sample can store the difference.
+    """
+    import sqlite3
+    if inventory is None:
+        inventory = ClientInventory
+    makeFolder(os.path.dirname(inventory))
+    db = sqlite3.connect(inventory)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS clients (id INTEGER PRIMARY KEY, mac TEXT UNIQUE, ip TEXT, hostname TEXT, firstSeen INTEGER, lastSeen INTEGER);
+        CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, client INTEGER, user TEXT, pid INTEGER, started INTEGER, ended INTEGER, served INTEGER, swap INTEGER);
+        CREATE INDEX IF NOT EXISTS sessionsOpen ON sessions (ended, pid);
+        CREATE TABLE IF NOT EXISTS samples (time INTEGER, client INTEGER, served INTEGER, swap INTEGER);
+        CREATE INDEX IF NOT EXISTS samplesTime ON samples (time, client);
+        CREATE TABLE IF NOT EXISTS hourly (time INTEGER, client INTEGER, served INTEGER, swap INTEGER);
+        CREATE INDEX IF NOT EXISTS hourlyTime ON hourly (time);
+        CREATE TABLE IF NOT EXISTS counters (pid INTEGER PRIMARY KEY, started INTEGER, bytes INTEGER);
+    """)
+    return db
+
+def recordClients(inventory = None):
+    """
+    Adds a sample of the connected Raspberry Pis to the client inventory. Run every minute from ClientInventoryCron.
+    Clients are identified by MAC address where it is known (so a Raspberry Pi keeps its history when its IP address changes), otherwise by IP address.
+    """
+    clients = scanClients()
+    now = int(time.time())
+    minute = now - now % 60
+    db = openClientInventory(inventory)
+    with db:
+        counters = {}
+        for pid, started, written in db.execute("SELECT pid, started, bytes FROM counters"):
+            counters[pid] = (started, written)
+        db.execute("DELETE FROM counters")
+        live = set()
+        for ip, details in clients.items():
+            key = details["mac"] or ip
+            row = db.execute("SELECT id FROM clients WHERE mac = ?", (key,)).fetchone()
+            if row is None:
+                clientId = db.execute("INSERT INTO clients (mac, ip, hostname, firstSeen, lastSeen) VALUES (?, ?, ?, ?, ?)", (key, ip, details["hostname"], now, now)).lastrowid
+            else:
+                clientId = row[0]
+                db.execute("UPDATE clients SET ip = ?, hostname = COALESCE(NULLIF(?, ''), hostname), lastSeen = ? WHERE id = ?", (ip, details["hostname"], now, clientId))
+            served = 0
+            for pid, started, written in details["nbd"]:
+                previous = counters.get(pid)
+                if previous is not None and previous[0] == started:
+                    served = served + max(0, written - previous[1])
+                else:
+                    served = served + written #A new connection, everything it has sent is since the last sample
+                db.execute("INSERT OR REPLACE INTO counters (pid, started, bytes) VALUES (?, ?, ?)", (pid, started, written))
+            if db.execute("UPDATE samples SET served = served + ?, swap = MAX(swap, ?) WHERE time = ? AND client = ?", (served, details["swap"], minute, clientId)).rowcount == 0:
+                db.execute("INSERT INTO samples (time, client, served, swap) VALUES (?, ?, ?, ?)", (minute, clientId, served, details["swap"]))
+            for pid, user, started in details["sessions"]:
+                row = db.execute("SELECT id FROM sessions WHERE ended IS NULL AND pid = ? AND started = ?", (pid, started)).fetchone()
+                if row is None:
+                    row = (db.execute("INSERT INTO sessions (client, user, pid, started, served, swap) VALUES (?, ?, ?, ?, 0, 0)", (clientId, user, pid, started)).lastrowid,)
+                db.execute("UPDATE sessions SET served = served + ?, swap = MAX(swap, ?) WHERE id = ?", (served, details["swap"], row[0]))
+                live.add(row[0])
+        for sessionId, in db.execute("SELECT id FROM sessions WHERE ended IS NULL").fetchall():
+            if not sessionId in live:
+                db.execute("UPDATE sessions SET ended = ? WHERE id = ?", (now, sessionId))
+        cutoff = now - now % 3600 - ClientDetailDays * 86400
+        db.execute("INSERT INTO hourly (time, client, served, swap) SELECT time - time % 3600, client, SUM(served), MAX(swap) FROM samples WHERE time < ? GROUP BY time - time % 3600, client", (cutoff,))
+        db.execute("DELETE FROM samples WHERE time < ?", (cutoff,))
+        db.execute("DELETE FROM hourly WHERE time < ?", (now - ClientKeepDays * 86400,))
+    db.close()
+    returnData(len(clients))
+
+def clientRoom(hostname, ip):
+    """
+    Guesses which room a Raspberry Pi is in, for the busiest times report. Hostnames like room12-pi05 give room12, otherwise the /24 subnet is used.
+    """
+    import re
+    room = re.sub(r"[-_.]*(pi)?[-_.]*\d*$", "", hostname or "", flags = re.IGNORECASE)
+    if room:
+        return room
+    return ip.rsplit(".", 1)[0] + ".x"
+
+def listClients(days = 7, inventory = None):
+    """
+    Prints the Raspberry Pis connected now, then the busiest hours of the last few days from the client inventory, by room.
+    """
+    megabyte = 1048576
+    clients = scanClients()
+    print(_("Connected Raspberry Pis") + " - " + str(len(clients)))
+    print("IP".ljust(16) + "MAC".ljust(18) + _("User").ljust(12) + _("Since").ljust(7) + _("Served").rjust(8) + _("Swap").rjust(7))
+    for ip in sorted(clients, key = lambda ip: [int(part) if part.isdigit() else 0 for part in ip.split(".")]):
+        details = clients[ip]
+        sessions = sorted(details["sessions"], key = lambda session: session[2])
+        user = sessions[0][1] if sessions else "-"
+        started = [session[2] for session in sessions] or [nbd[1] for nbd in details["nbd"]]
+        since = time.strftime("%H:%M", time.localtime(min(started))) if started else "-"
+        served = sum(nbd[2] for nbd in details["nbd"])
+        print(ip.ljust(16) + (details["mac"] or "-").ljust(18) + user[:11].ljust(12) + since.ljust(7) + (str(served // megabyte) + "MB").rjust(8) + (str(details["swap"] // megabyte) + "MB").rjust(7))
+    if not os.path.exists(inventory or ClientInventory):
+        return
+    db = openClientInventory(inventory)
+    since = int(time.time()) - int(days) * 86400
+    hours = {}
+    names = {}
+    for clientId, ip, hostname in db.execute("SELECT id, ip, hostname FROM clients"):
+        names[clientId] = clientRoom(hostname, ip)
+    for table in ("samples", "hourly"):
+        for hour, clientId, served, swap in db.execute("SELECT time - time % 3600, client, SUM(served), MAX(swap) FROM " + table + " WHERE time >= ? GROUP BY time - time % 3600, client", (since,)):
+            key = (hour, names.get(clientId, "?"))
+            total = hours.setdefault(key, [0, 0, 0])
+            total[0] = total[0] + 1
+            total[1] = total[1] + served
+            total[2] = total[2] + swap
+    db.close()
+    print("")
+    print(_("Busiest hours of the last") + " " + str(days) + " " + _("days"))
+    print(_("Hour").ljust(18) + _("Room").ljust(18) + _("Pis").rjust(5) + _("Served").rjust(9) + _("Swap").rjust(8))
+    for key, total in sorted(hours.items(), key = lambda item: -item[1][1])[:ClientReportRows]:
+        print(time.strftime("%a %d %b %H:00", time.localtime(key[0])).ljust(18) + key[1][:17].ljust(18) + str(total[0]).rjust(5) + (str(total[1] // megabyte) + "MB").rjust(9) + (str(total[2] // megabyte) + "MB").rjust(8))
+
+
+#------------------------------Server mode-------------------------
+
+#Commands which never need the terminal, so are safe to answer from serveRequests(). Anything else (whiptail menus etc) is run directly by the client instead.
+serverCommands = {"replaceLineOrAdd", "replaceBitOrAdd", "replaceLinesOrAdd", "CheckInternet", "CompareVersion", "triggerInstall",
+                  "checkKernelFileUpdateWeb", "checkKernelUpdater", "installCheckKernelUpdater", "previousImport",
+                  "checkIfFileContainsString", "sendStats", "setConfigParameter", "setConfigParameters", "fixGroups", "fixGroupSingle",
+                  "packageProxyStats", "imageBuildStatus", "syncDirectory",
+                  "writeBootManifest", "checkSharedFolders"}
+
+def serveRequests():
+    """
+    Runs as a long lived coprocess of pinet, so each call doesn't need a new Python interpreter and the config and user data stay loaded.
+    Requests are read from stdin, one JSON object per line, for example {"id": 1, "args": ["CheckInternet", "1"]}.
+    Each gets a single JSON line back on stdout with the same id, a status ("ok", "error" or "unsupported"), the returnData() result and anything printed.
+    Commands not in serverCommands are answered as unsupported, so the client runs them itself.
+    """
+    import json, io, traceback
+    from contextlib import redirect_stdout
+    global serverMode, serverResult
+    requests = os.fdopen(os.dup(0), "r")
+    replies = os.fdopen(os.dup(1), "w")
+    devNull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devNull, 0)
+    os.close(devNull)
+    os.dup2(2, 1) #Output from subprocesses goes to the terminal, not into the reply stream
+    serverMode = True
+    for line in requests:
+        if not line.strip():
+            continue
+        requestID = None
+        status = "ok"
+        output = io.StringIO()
+        serverResult = None
+        try:
+            request = json.loads(line)
+            requestID = request.get("id")
+            args = [str(arg) for arg in request["args"]]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            status = "error"
+            args = []
+        if status == "ok":
+            if not args or args[0] not in serverCommands:
+                status = "unsupported"
+            else:
+                try:
+                    with redirect_stdout(output):
+                        getReleaseChannel()
+                        runCommand([sys.argv[0]] + args)
+                except SystemExit as exit:
+                    if exit.code:
+                        status = "error"
+                except Exception:
+                    status = "error"
+                    traceback.print_exc()
+        reply = {"id": requestID, "status": status, "result": serverResult if serverResult is not None else "", "output": output.getvalue()}
+        replies.write(json.dumps(reply, ensure_ascii=False) + "\n")
+        replies.flush()
+
+def runCommand(argv):
+    """
+    Runs the function for a command line style argument list, where argv[1] is the command name.
+    """
+    if argv[1] == "replaceLineOrAdd":
+        replaceLineOrAdd(argv[2], argv[3], argv[4])
+    elif argv[1] == "replaceBitOrAdd":
+        replaceBitOrAdd(argv[2], argv[3], argv[4])
+    elif argv[1] == "replaceLinesOrAdd":
+        replaceLinesOrAdd(argv[2], list(zip(argv[3::2], argv[4::2])))
+    elif argv[1] == "CheckInternet":
+        internet_on(argv[2])
+    elif argv[1] == "CheckUpdate":
+        checkUpdate(argv[2])
+    elif argv[1] == "refreshReleaseInfo":
+        refreshReleaseInfo()
+    elif argv[1] == "CompareVersion":
+        compareVersions(argv[2], argv[3])
+    elif argv[1] == "updatePiNet":
         updatePiNet()
-    elif sys.argv[1] == "triggerInstall":
+    elif argv[1] == "downloadFile":
+        returnData(0 if downloadFile(argv[2], argv[3], *argv[4:5]) else 1)
+    elif argv[1] == "triggerInstall":
         downloadFile("http://bit.ly/pinetinstall1", "/dev/null")
-    elif sys.argv[1] == "checkKernelFileUpdateWeb":
+    elif argv[1] == "checkKernelFileUpdateWeb":
         checkKernelFileUpdateWeb()
-    elif sys.argv[1] == "checkKernelUpdater":
+    elif argv[1] == "checkKernelUpdater":
         checkKernelUpdater()
-    elif sys.argv[1] == "installCheckKernelUpdater":
+    elif argv[1] == "installCheckKernelUpdater":
         installCheckKernelUpdater()
-    elif sys.argv[1] == "previousImport":
+    elif argv[1] == "previousImport":
         previousImport()
-    elif sys.argv[1] == "importFromCSV":
-        importFromCSV(sys.argv[2], sys.argv[3])
-    elif sys.argv[1] == "checkIfFileContainsString":
-        checkIfFileContains(sys.argv[2], sys.argv[3])
-    elif sys.argv[1] == "initialInstallSoftwareList":
+    elif argv[1] == "importFromCSV":
+        importFromCSV(argv[2], argv[3])
+    elif argv[1] == "checkIfFileContainsString":
+        checkIfFileContains(argv[2], argv[3])
+    elif argv[1] == "initialInstallSoftwareList":
         installSoftwareList(True)
-    elif sys.argv[1] == "installSoftwareList":
+    elif argv[1] == "installSoftwareList":
         installSoftwareList(False)
-    elif sys.argv[1] == "installSoftwareFromFile":
+    elif argv[1] == "installSoftwareFromFile":
         installSoftwareFromFile()
-    elif sys.argv[1] == "sendStats":
+    elif argv[1] == "installSoftwareManifest":
+        installSoftwareManifest()
+    elif argv[1] == "syncDirectory":
+        syncDirectory(argv[2], argv[3], argv[4:])
+    elif argv[1] == "writeBootManifest":
+        writeBootManifest(argv[2])
+    elif argv[1] == "createSDCardImage":
+        createSDCardImage(argv[2], argv[3])
+    elif argv[1] == "createSDCardImages":
+        createSDCardImages(argv[2], argv[3], argv[4].split(","), argv[5:])
+    elif argv[1] == "nbdRebuild":
+        nbdRebuild("force" in argv[2:], wait = "wait" in argv[2:])
+    elif argv[1] == "waitForImageBuild":
+        waitForImageBuild()
+    elif argv[1] == "buildImage":
+        buildImage(*argv[2:3])
+    elif argv[1] == "systemStatus":
+        systemStatus(*argv[2:3])
+    elif argv[1] == "recordClients":
+        recordClients()
+    elif argv[1] == "listClients":
+        listClients(*argv[2:3])
+    elif argv[1] == "imageBuildStatus":
+        imageBuildStatus()
+    elif argv[1] == "benchmarkCompression":
+        benchmarkCompression()
+    elif argv[1] == "packageProxy":
+        runPackageProxy()
+    elif argv[1] == "packageProxyStats":
+        packageProxyStats()
+    elif argv[1] == "sendStats":
         sendStats()
-    elif sys.argv[1] == "checkStatsNotification":
+    elif argv[1] == "checkStatsNotification":
         checkStatsNotification()
-    elif sys.argv[1] == "askExtraStatsInfo":
+    elif argv[1] == "askExtraStatsInfo":
         askExtraStatsInfo()
-    elif sys.argv[1] == "internetFullStatusCheck":
+    elif argv[1] == "internetFullStatusCheck":
         internetFullStatusCheck()
-    elif sys.argv[1] == "setConfigParameter":
-        setConfigParameter(sys.argv[2], sys.argv[3])
+    elif argv[1] == "setConfigParameter":
+        setConfigParameter(argv[2], argv[3])
+    elif argv[1] == "setConfigParameters":
+        setConfigParameters(argv[2:])
+    elif argv[1] == "collectWork":
+        collectWork(argv[2], argv[3] if len(argv) > 3 else "", len(argv) > 4 and argv[4] == "hash")
+    elif argv[1] == "distributeToUsers":
+        distributeToUsers(argv[2], argv[3], argv[4:])
+    elif argv[1] == "backupHomes":
+        sys.exit(0 if backupHomes(*argv[2:5]) else 1)
+    elif argv[1] == "restoreBackup":
+        sys.exit(0 if restoreBackup(argv[2:]) else 1)
+    elif argv[1] == "createMigrationBundle":
+        createMigrationBundle(argv[2])
+    elif argv[1] == "importMigrationBundle":
+        importMigrationBundle(argv[2])
+    elif argv[1] == "addSharedFolder":
+        addSharedFolder(argv[2], argv[3])
+    elif argv[1] == "setSharedFolderAccess":
+        setSharedFolderAccess(argv[2], argv[3])
+    elif argv[1] == "removeSharedFolder":
+        removeSharedFolder(argv[2])
+    elif argv[1] == "reconcileSharedFolders":
+        reconcileSharedFolders()
+    elif argv[1] == "updateSharedBookmarks":
+        updateSharedBookmarks()
+    elif argv[1] == "checkSharedFolders":
+        checkSharedFolders()
+    elif argv[1] == "fixGroups":
+        fixGroups()
+    elif argv[1] == "fixGroupSingle":
+        fixGroupSingle(argv[2])
+
+#------------------------------Main program-------------------------
+
+if len(sys.argv) == 1:
+    print(_("This python script does nothing on its own, it must be passed stuff"))
+elif sys.argv[1] == "serve":
+    serveRequests()
+else:
+    getReleaseChannel()
+    runCommand(sys.argv)
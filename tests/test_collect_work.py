@@ -0,0 +1,73 @@
+import importlib.machinery
+import os
+import shutil
+import tempfile
+import unittest
+
+functions = importlib.machinery.SourceFileLoader("pinetFunctions", os.path.join(os.path.dirname(__file__), "..", "Scripts", "pinet-functions-python.py")).load_module()
+
+
+class collectedFileSymlinkTest(unittest.TestCase):
+    """
+    A symlink planted in a teacher's submitted folder must not send collected work (copied as root) somewhere else.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.teacherHome = os.path.join(self.folder, "teacher")
+        self.outside = os.path.join(self.folder, "outside")
+        os.makedirs(os.path.join(self.teacherHome, "submitted"))
+        os.mkdir(self.outside)
+        self.pupilHome = os.path.join(self.folder, "pupil")
+        os.makedirs(os.path.join(self.pupilHome, "handin", "maths"))
+        self.source = "handin/maths/work.txt"
+        with open(os.path.join(self.pupilHome, self.source), "w") as work:
+            work.write("homework")
+        self.uid, self.gid = os.getuid(), os.getgid()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testCopies(self):
+        functions.copyCollectedFile(self.pupilHome, self.source, os.path.join(self.teacherHome, "submitted"), "bob/maths/work.txt", self.uid, self.gid)
+        with open(os.path.join(self.teacherHome, "submitted", "bob", "maths", "work.txt")) as copy:
+            self.assertEqual(copy.read(), "homework")
+
+    def testSymlinkedFolderRefused(self):
+        os.symlink(self.outside, os.path.join(self.teacherHome, "submitted", "bob"))
+        with self.assertRaises(OSError):
+            functions.copyCollectedFile(self.pupilHome, self.source, os.path.join(self.teacherHome, "submitted"), "bob/work.txt", self.uid, self.gid)
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def testSymlinkedSubmittedRefused(self):
+        os.rmdir(os.path.join(self.teacherHome, "submitted"))
+        os.symlink(self.outside, os.path.join(self.teacherHome, "submitted"))
+        with self.assertRaises(OSError):
+            os.close(functions.openOwnedFolder(self.teacherHome, "submitted/.manifests", self.uid, self.gid))
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def testSymlinkedHandinFolderRefused(self):
+        secret = os.path.join(self.outside, "work.txt")
+        with open(secret, "w") as secretFile:
+            secretFile.write("secret")
+        shutil.rmtree(os.path.join(self.pupilHome, "handin", "maths"))
+        os.symlink(self.outside, os.path.join(self.pupilHome, "handin", "maths"))
+        with self.assertRaises(OSError):
+            functions.copyCollectedFile(self.pupilHome, self.source, os.path.join(self.teacherHome, "submitted"), "bob/work.txt", self.uid, self.gid)
+        self.assertFalse(os.path.exists(os.path.join(self.teacherHome, "submitted", "bob", "work.txt")))
+
+    def testSymlinkedFileReplaced(self):
+        victim = os.path.join(self.outside, "victim")
+        with open(victim, "w") as victimFile:
+            victimFile.write("untouched")
+        os.mkdir(os.path.join(self.teacherHome, "submitted", "bob"))
+        target = os.path.join(self.teacherHome, "submitted", "bob", "work.txt")
+        os.symlink(victim, target)
+        functions.copyCollectedFile(self.pupilHome, self.source, os.path.join(self.teacherHome, "submitted"), "bob/work.txt", self.uid, self.gid)
+        self.assertFalse(os.path.islink(target))
+        with open(victim) as victimFile:
+            self.assertEqual(victimFile.read(), "untouched")
+
+
+if __name__ == "__main__":
+    unittest.main()